@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# python -m watermarkr
+# python -m watermarkr serve, runs the stamping daemon
+# python -m watermarkr farm-worker, stamps units of the farm queue on this node
+# python -m watermarkr resume, resumes the jobs left unfinished by a crash or a cancel
+import sys
+import os
+
+moduleDir = os.path.dirname(os.path.abspath(__file__))
+if moduleDir not in sys.path:
+    sys.path.insert(0, moduleDir)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['serve']:
+        import daemon
+        sys.exit(daemon.main(sys.argv[2:]))
+    if sys.argv[1:2] == ['farm-worker']:
+        import farm
+        sys.exit(farm.main(sys.argv[2:]))
+    import cli
+    if sys.argv[1:2] == ['resume']:
+        sys.exit(cli.resume_main(sys.argv[2:]))
+    sys.exit(cli.main())
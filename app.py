@@ -11,9 +11,34 @@
 # 1.3.0  - Add PDF support
 # 1.4.0  - Add feature: resize media
 # 1.5.0  - Add feature: select overlay image
+# 1.6.0  - Stamp multiple files at once using a pool of worker processes
+# 1.7.0  - Add command line interface, python -m watermarkr
+# 1.8.0  - Build watermark overlay once per job and reuse it for every still of the same size
+# 1.9.0  - Resize and stamp in a single pass, no more resized temp files
+# 1.10.0 - Bring back blend modes (multiply, screen, overlay) with numpy compositing for stills
+# 1.11.0 - Stamp very large tiff in bands to keep memory low
+# 1.12.0 - Skip files already up to date in the output folder, add Rebuild option
+# 1.13.0 - Split long videos on keyframes and encode the segments in parallel
+# 1.14.0 - Stamp PDF with one overlay shared by every page, report progress per page
+# 1.15.0 - Read dropped files in background and add them in batches, UI stays responsive
+# 1.16.0 - Accept dropped folders, image sequences are listed as one item, output keeps folder structure
+# 1.17.0 - Time every stage of every file, write a json/csv report next to the outputs
+# 1.18.0 - Read ahead and write behind through local scratch when files are on a network share
+# 1.19.0 - Job queue, Stamp adds a job and jobs run side by side on a shared pool, cancel per job
+# 1.20.0 - Add stamping daemon, python -m watermarkr serve, keeps the pool warm for the CLI and other tools
+# 1.21.0 - Add Dedup option, identical files are stamped once and linked to the other outputs
+# 1.22.0 - Faster startup, the window shows first and the stamping backends load in background
+# 1.23.0 - Add preview of the stamped result for the selected item, follows the sliders
+# 1.24.0 - Estimate the cost of each file, order files on the workers by cost, progress weighted by cost
+# 1.25.0 - Memory budget, files are stamped at once only while they fit, too big files use a low memory path
+# 1.26.0 - Add Farm option, the job is split into units stamped by the farm nodes, python -m watermarkr farm-worker
+# 1.27.0 - Add output encoding profiles, fast review / balanced / archive
+# 1.28.0 - Progress is coalesced and shown at a fixed rate with throughput and time left
+# 1.29.0 - Cancel stops files being stamped within a second, outputs are written whole or not at all,
+#          unfinished jobs are offered to resume on the next start, temp files of a crash are removed
 
 _title = 'Watermarkr'
-_version = '1.5.0'
+_version = '1.29.0'
 _des = ''
 uiName = 'Watermarkr'
 
@@ -28,19 +53,17 @@ from functools import partial
 from datetime import datetime, timedelta
 from collections import OrderedDict, defaultdict
 import subprocess
+import threading
+import traceback
+from multiprocessing.pool import ThreadPool
 
 core = '%s/core' % os.environ.get('RFSCRIPT')
 sys.path.append(core)
 
-# import config
-import rf_config as config
-from rf_utils import log_utils
 from rf_utils.ui import stylesheet
 
-user = '%s-%s' % (config.Env.localuser, getpass.getuser()) or 'unknown'
-logFile = log_utils.name(uiName, user)
-logger = log_utils.init_logger(logFile)
-logger.setLevel(logging.DEBUG)
+# file logger is set up by load_backends(), once the window shows
+logger = logging.getLogger(uiName)
 
 # QT
 os.environ['QT_PREFERRED_BINDING'] = os.pathsep.join(['PySide', 'PySide2'])
@@ -48,18 +71,26 @@ from Qt import QtCore
 from Qt import QtWidgets
 from Qt import QtGui
 
-from rf_utils import file_utils
 from rf_utils.widget.file_widget import Icon
 from rf_utils.widget import display_widget
-from rf_utils.pipeline import watermark
-from rf_utils.pipeline import convert_lib
+
+import intake
+import recovery
+import validate
+
+# loaded by load_backends()
+config = None
+file_utils = None
+engine = None
+jobs = None
+preview = None
+progress = None
+_backend_lock = threading.Lock()
 
 moduleDir = os.path.dirname(sys.modules[__name__].__file__).replace('\\', '/')
 appName = os.path.splitext(os.path.basename(sys.modules[__name__].__file__))[0]
 
-SUPPORT_FORMAT = ('.jpg', '.tif', '.tiff', '.png', '.pdf', '.mov', '.mp4')
-NON_RESIZEABLE_FORMAT = ('.pdf')
-WATERMARK_PATH = '{}/core/rf_template/default/watermark/watermark_2K_internal.png'.format(os.environ['RFSCRIPT'])
+from defaults import SUPPORT_FORMAT, WATERMARK_PATH, OPACITY_RANGE, BLEND_MODES, ORDERS, DEFAULT_ORDER, FARM_DIR, PROFILES, DEFAULT_PROFILE
 MIN_OPACITY = 0.05  # opacity slider min
 MAX_OPACITY = 0.50  # opacity slider max
 MIN_SIZE = 1  # resize slider min
@@ -68,86 +99,171 @@ DEFAULT_SIZE = 8
 SIZE_STEP = 512
 
 DEFAULT_OPACITY = 0.12  # default opacity slider value
-OPACITY_RANGE = (0.075, 0.15)  # range for auto opacity
-
-class StampThread(QtCore.QThread):
-    mediaStamped = QtCore.Signal(tuple)
-    stampFinished = QtCore.Signal(tuple)
-    progressStamped = QtCore.Signal(tuple)
-    __stop = False
-
-    def __init__(self, input_paths, text, output_paths, overlay_path, opacity, resize, callback_func=None, parent=None):
-        super(StampThread, self).__init__(parent=parent)
-        self.input_paths = input_paths
-        self.text = text
-        self.output_paths = output_paths
-        self.overlay_path = overlay_path
-        self.opacity = opacity
-        self.resize = resize
-        self.callback_func = callback_func
-        self.results = []
+INTAKE_WORKERS = 8  # threads reading file size of dropped files
+INTAKE_BATCH_SIZE = 200  # max items added to the list at once
+INTAKE_BATCH_INTERVAL = 0.1  # sec, max wait before adding what has been read
+BACKEND_LOAD_DELAY = 200  # msec after the window shows, lets it paint before the imports compete for the GIL
+PREVIEW_HEIGHT = 200  # height of the preview pane
+MAX_MEMORY_GB = 256  # memory budget spin box max
+PROGRESS_RATE = 20.0  # progress updates a second shown at most
+
+
+def load_backends():
+    # config, file logger and the stamping engine with its imaging / video / pdf libraries.
+    # Slow to import and not needed to show the window, BackendThread loads them in background
+    # and anything that needs them earlier waits here for it.
+    global config, file_utils, engine, jobs, preview, progress, logger
+    with _backend_lock:
+        if jobs is not None:
+            return
+        import rf_config as config
+        from rf_utils import log_utils
+        from rf_utils import file_utils
+
+        user = '%s-%s' % (config.Env.localuser, getpass.getuser()) or 'unknown'
+        logFile = log_utils.name(uiName, user)
+        logger = log_utils.init_logger(logFile)
+        logger.setLevel(logging.DEBUG)
+
+        import engine
+        import preview
+        import progress
+        import jobs
+
+
+class PreviewThread(QtCore.QThread):
+    previewRendered = QtCore.Signal(tuple)
+
+    # renders the latest request only, requests made while one renders replace each other
+    # so a slider drag never queues up work
+    def __init__(self, parent=None):
+        super(PreviewThread, self).__init__(parent=parent)
+        self._request = None
         self._stop = False
+        self._cond = threading.Condition()
+
+    def request(self, **kwargs):
+        with self._cond:
+            self._request = kwargs
+            self._cond.notify()
 
     def stop(self):
-        self._stop = True
-        return 0
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+
+    def run(self):
+        load_backends()
+        cache = preview.ProxyCache()
+        while True:
+            with self._cond:
+                while self._request is None and not self._stop:
+                    self._cond.wait()
+                if self._stop:
+                    return
+                request, self._request = self._request, None
+            try:
+                text = engine.get_overlay_text(request.pop('name'), request.pop('task'))
+                image, opacity, full_size, output_size = preview.render_entry(cache, text=text, **request)
+                width, height = image.size
+                qimage = QtGui.QImage(image.tobytes('raw', 'RGB'), width, height, width * 3, QtGui.QImage.Format_RGB888).copy()
+                info = '{}x{} > {}x{}, opacity {:.1f}%'.format(full_size[0], full_size[1], output_size[0], output_size[1], opacity * 100)
+            except Exception as e:
+                logger.debug(traceback.format_exc())
+                qimage = None
+                info = 'No preview: {}'.format(e)
+            self.previewRendered.emit((qimage, info))
+
+
+class BackendThread(QtCore.QThread):
+    # jobs stamped before the backends were loaded start once they are,
+    # jobs a crash or a cancel left unfinished are found then
+    backendsLoaded = QtCore.Signal()
+    checkpointsFound = QtCore.Signal(list)
 
     def run(self):
         start_time = time.time()
-        num_files = len(self.input_paths)
-        temp_files = []
-        for i, input_path in enumerate(self.input_paths):
-            output_path = self.output_paths[i]
-            if self.resize != None and os.path.splitext(input_path)[-1].lower() not in NON_RESIZEABLE_FORMAT:
-                # do the resize
-                resize_result = convert_lib.limit_media_size(input_path, limit_size=self.resize, output_path=None)
-                if resize_result:
-                    input_path = resize_result
-                    temp_files.append(input_path)
-                    print('Resized to temp: {}'.format(input_path))
-            result = watermark.add_watermark_with_text(input_path=input_path, 
-                                                overlay_path=self.overlay_path, 
-                                                text=self.text, 
-                                                output_path=output_path, 
-                                                opacity=self.opacity,
-                                                callback_func=self.callback_func)
-            
-            if self._stop:
-                break
-
-            self.results.append(result)
-            self.mediaStamped.emit((i, result))
-            progress = (i+1, num_files)
-            self.progressStamped.emit(progress)
-
-        if self._stop:
-            self.input_paths = []
-            self.output_paths = []
-            self.text = None
-            self._stop = False
-        else:
-            time_taken = time.time() - start_time
-            self.stampFinished.emit((self.results, time_taken))
-        if temp_files:
-            for tf in temp_files:
-                os.remove(tf)
-            print('{} Temp files removed.'.format(len(temp_files)))
-        return 0
+        load_backends()
+        logger.debug('Backends loaded in {:.3f} sec'.format(time.time() - start_time))
+        self.backendsLoaded.emit()
+        recovery.cleanup_temp()
+        checkpoints = recovery.list_checkpoints()
+        if checkpoints:
+            self.checkpointsFound.emit(checkpoints)
+
+class JobSignals(QtCore.QObject):
+    # progress snapshots come from the progress stream thread, at most PROGRESS_RATE a second,
+    # the signal brings them to the UI thread
+    jobProgress = QtCore.Signal(dict)
+
+    def emit_progress(self, snapshot):
+        self.jobProgress.emit(snapshot)
+
+
+def get_file_info(args):
+    # the cost of the files is probed here so the job doesn't wait for it
+    path, rel_dir = args
+    engine.cost.estimate_entry(path)
+    if intake.is_sequence(path):
+        return path, rel_dir, intake.get_readable_size(intake.get_size(path))
+    return path, rel_dir, file_utils.get_readable_filesize(path)
+
+
+class IntakeThread(QtCore.QThread):
+    filesChecked = QtCore.Signal(list)
+
+    # paths can be files or folders, folders are walked as results come in
+    def __init__(self, paths, parent=None):
+        super(IntakeThread, self).__init__(parent=parent)
+        self.paths = paths
+        self._stop = False
+
+    def stop(self):
+        self._stop = True
+
+    def run(self):
+        # stat files on a thread pool (network share), send results in batches
+        load_backends()
+        pool = ThreadPool(INTAKE_WORKERS)
+        batch = []
+        last_emit = time.time()
+        try:
+            for result in pool.imap(get_file_info, intake.scan(self.paths, SUPPORT_FORMAT), chunksize=16):
+                if self._stop:
+                    break
+                batch.append(result)
+                if len(batch) >= INTAKE_BATCH_SIZE or time.time() - last_emit > INTAKE_BATCH_INTERVAL:
+                    self.filesChecked.emit(batch)
+                    batch = []
+                    last_emit = time.time()
+            if batch and not self._stop:
+                self.filesChecked.emit(batch)
+        finally:
+            pool.terminate()
+            pool.join()
 
 
 class Watermarkr(QtWidgets.QMainWindow):
-    subprogress = QtCore.Signal(tuple)
-
     def __init__(self, parent=None):
         # setup Window
         super(Watermarkr, self).__init__(parent)
 
         # app vars
-        self.thread = None
+        self.job_signals = JobSignals()
+        self.job_queue = None  # once the backends are loaded
+        self.backend_thread = None
+        self.pending_jobs = []  # settings of jobs stamped before the backends were loaded
+        self.preview_thread = None  # started with the first preview
+        self.job_items = {}  # job id -> item in the job list
+        self.job_snapshots = {}  # job id -> latest progress snapshot of running jobs
+        self.progress_stream = None
+        self.intake_threads = []
+        self.intake_paths = set()  # paths dropped but not in the list yet
+        self.icon_cache = {}
 
         # ui vars
         self.w = 550
-        self.h = 645
+        self.h = 960
         self.app_icon = '{}/icons/app_icon.png'.format(moduleDir)
         self.logo_icon = '{}/icons/riff_logo.png'.format(moduleDir)
         self.refresh_icon = '{}/icons/clear_icon.png'.format(moduleDir)
@@ -240,6 +356,41 @@ class Watermarkr(QtWidgets.QMainWindow):
         self.drop_widget.setColumnWidth(1, 75)
         self.drop_layout.addWidget(self.drop_widget)
 
+        # preview of the selected item
+        self.preview_label = QtWidgets.QLabel()
+        self.preview_label.setAlignment(QtCore.Qt.AlignCenter)
+        self.preview_label.setFixedHeight(PREVIEW_HEIGHT)
+        self.preview_label.setStyleSheet('background-color: rgb(30, 30, 30)')
+        self.main_layout.addWidget(self.preview_label)
+        self.preview_info_label = QtWidgets.QLabel()
+        self.preview_info_label.setAlignment(QtCore.Qt.AlignCenter)
+        self.preview_info_label.setStyleSheet('color: rgb(150, 150, 150)')
+        self.main_layout.addWidget(self.preview_info_label)
+
+        # job layout
+        self.job_layout = QtWidgets.QHBoxLayout()
+        self.job_layout.setSpacing(5)
+        self.main_layout.addLayout(self.job_layout)
+        # job list
+        self.job_widget = QtWidgets.QTreeWidget()
+        self.job_widget.setFocusPolicy(QtCore.Qt.ClickFocus)
+        self.job_widget.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
+        self.job_widget.setRootIsDecorated(False)
+        self.job_widget.setMaximumHeight(110)
+        self.job_widget.setColumnCount(3)
+        header = self.job_widget.headerItem()
+        header.setText(0, 'Job')
+        header.setText(1, 'Files')
+        header.setText(2, 'Status')
+        self.job_widget.setColumnWidth(0, 240)
+        self.job_widget.setColumnWidth(1, 75)
+        self.job_layout.addWidget(self.job_widget)
+        # cancel button
+        self.cancel_button = QtWidgets.QPushButton('Cancel')
+        self.cancel_button.setToolTip('Cancel selected jobs, files being stamped stop within a second, the job can be resumed on the next start')
+        self.cancel_button.setFocusPolicy(QtCore.Qt.ClickFocus)
+        self.job_layout.addWidget(self.cancel_button, 0, QtCore.Qt.AlignTop)
+
         # browse layout
         self.browse_layout = QtWidgets.QHBoxLayout()
         self.browse_layout.setSpacing(9)
@@ -257,6 +408,22 @@ class Watermarkr(QtWidgets.QMainWindow):
         self.browse_button.setFocusPolicy(QtCore.Qt.ClickFocus)
         self.browse_layout.addWidget(self.browse_button)
 
+        # rebuild checkbox
+        self.rebuild_checkbox = QtWidgets.QCheckBox('Rebuild')
+        self.rebuild_checkbox.setToolTip('Stamp every file again, even the ones already up to date in the output folder')
+        self.browse_layout.addWidget(self.rebuild_checkbox)
+
+        # dedup checkbox
+        self.dedup_checkbox = QtWidgets.QCheckBox('Dedup')
+        self.dedup_checkbox.setToolTip('Stamp identical files once, the other copies are linked to the first output')
+        self.browse_layout.addWidget(self.dedup_checkbox)
+
+        # farm checkbox, only with a farm queue folder set up
+        self.farm_checkbox = QtWidgets.QCheckBox('Farm')
+        self.farm_checkbox.setToolTip('Send the job to the farm nodes watching {}'.format(FARM_DIR))
+        self.farm_checkbox.setVisible(bool(FARM_DIR))
+        self.browse_layout.addWidget(self.farm_checkbox)
+
         # watermark path
         self.watermark_layout = QtWidgets.QHBoxLayout()
         self.watermark_layout.setSpacing(9)
@@ -346,6 +513,37 @@ class Watermarkr(QtWidgets.QMainWindow):
 
         self.slider_layout.addRow('Resize: ', self.size_layout)
 
+        # blend mode
+        self.blend_comboBox = QtWidgets.QComboBox()
+        self.blend_comboBox.setMaximumHeight(20)
+        self.blend_comboBox.addItems([mode.capitalize() for mode in BLEND_MODES])
+        self.slider_layout.addRow('Blend: ', self.blend_comboBox)
+
+        # order of the files on the workers
+        self.order_comboBox = QtWidgets.QComboBox()
+        self.order_comboBox.setMaximumHeight(20)
+        self.order_comboBox.addItems(['Longest first', 'Shortest first', 'As listed'])
+        self.order_comboBox.setCurrentIndex(ORDERS.index(DEFAULT_ORDER))
+        self.order_comboBox.setToolTip('Longest first finishes the whole job sooner, shortest first gives the first outputs sooner')
+        self.slider_layout.addRow('Order: ', self.order_comboBox)
+
+        # output encoding profile
+        self.profile_comboBox = QtWidgets.QComboBox()
+        self.profile_comboBox.setMaximumHeight(20)
+        self.profile_comboBox.addItems(['Fast review', 'Balanced', 'Archive'])
+        self.profile_comboBox.setCurrentIndex(PROFILES.index(DEFAULT_PROFILE))
+        self.profile_comboBox.setToolTip('Fast review encodes quickly at review quality, archive takes longer for the smallest full quality files')
+        self.slider_layout.addRow('Encoding: ', self.profile_comboBox)
+
+        # memory budget of the files stamped at once, 0 is half of the physical memory
+        self.memory_spinBox = QtWidgets.QSpinBox()
+        self.memory_spinBox.setMaximumHeight(20)
+        self.memory_spinBox.setRange(0, MAX_MEMORY_GB)
+        self.memory_spinBox.setSuffix(' GB')
+        self.memory_spinBox.setSpecialValueText('Auto')
+        self.memory_spinBox.setToolTip('Files are only stamped at once while they fit in this much memory, bigger files use less memory but take longer')
+        self.slider_layout.addRow('Memory: ', self.memory_spinBox)
+
         # progress bars
         self.mainProgressBar = QtWidgets.QProgressBar()
         self.mainProgressBar.setTextVisible(True)
@@ -413,6 +611,20 @@ class Watermarkr(QtWidgets.QMainWindow):
         self.opacity_slider.valueChanged.connect(self.opacity_slider_changed)
         self.resize_slider.valueChanged.connect(self.resize_slider_changed)
         self.resize_checkbox.toggled.connect(self.resize_toggled)
+        self.cancel_button.clicked.connect(self.cancel_job)
+        self.memory_spinBox.valueChanged.connect(self.memory_changed)
+        self.job_signals.jobProgress.connect(self.job_event)
+
+        # preview follows the selection and every stamp setting
+        self.drop_widget.itemSelectionChanged.connect(self.update_preview)
+        self.opacity_slider.valueChanged.connect(self.update_preview)
+        self.adaptive_checkbox.toggled.connect(self.update_preview)
+        self.resize_slider.valueChanged.connect(self.update_preview)
+        self.resize_checkbox.toggled.connect(self.update_preview)
+        self.blend_comboBox.currentIndexChanged.connect(self.update_preview)
+        self.watermark_lineEdit.editingFinished.connect(self.update_preview)
+        self.reciever_lineEdit.editingFinished.connect(self.update_preview)
+        self.task_lineEdit.editingFinished.connect(self.update_preview)
 
         # actions
         self.del_action = QtWidgets.QAction(self.drop_widget)
@@ -420,10 +632,10 @@ class Watermarkr(QtWidgets.QMainWindow):
         self.drop_widget.addAction(self.del_action)
         self.del_action.triggered.connect(self.del_item)
 
-        # self.esc_action = QtWidgets.QAction(self.drop_widget)
-        # self.esc_action.setShortcut(QtGui.QKeySequence(QtCore.Qt.Key_Escape))
-        # self.addAction(self.esc_action)
-        # self.esc_action.triggered.connect(self.stop_process)
+        self.esc_action = QtWidgets.QAction(self.job_widget)
+        self.esc_action.setShortcut(QtGui.QKeySequence(QtCore.Qt.Key_Escape))
+        self.job_widget.addAction(self.esc_action)
+        self.esc_action.triggered.connect(self.cancel_job)
 
     def opacity_slider_changed(self, value):
         self.opacity_lineEdit.setText('{}%'.format(value))
@@ -439,19 +651,61 @@ class Watermarkr(QtWidgets.QMainWindow):
         self.resize_lineEdit.setEnabled(checked)
         self.resize_slider.setEnabled(checked)
 
-    # def stop_process(self):
-    #     if not self.thread and self.thread.isRunning():
-    #         return
-    #     self.thread.stop()
-    #     # self.thread.exit()
-    #     self.thread.wait()
-    #     self.thread = None
+    def get_memory_budget(self):
+        return self.memory_spinBox.value() * 1024 ** 3 or None
+
+    def memory_changed(self, value):
+        # applies to the files sent from now on
+        if self.job_queue is not None:
+            self.job_queue.memory_budget = engine.cost.get_memory_budget(self.get_memory_budget())
 
-    #     self.statusBar.showMessage('Process stopped by user')
-    #     self.mainProgressBar.setValue(0)
-    #     self.subProgressBar.setValue(0)
-    #     QtWidgets.QApplication.restoreOverrideCursor()
-    #     self.enable_ui(value=True)
+    def get_opacity(self):
+        if self.adaptive_checkbox.isChecked():
+            return OPACITY_RANGE
+        return self.opacity_slider.value() * 0.01
+
+    def get_resize(self):
+        if self.resize_checkbox.isChecked():
+            return int(self.resize_lineEdit.text())
+        return None
+
+    def update_preview(self, *args):
+        items = self.drop_widget.selectedItems()
+        if not items:
+            self.preview_label.clear()
+            self.preview_info_label.clear()
+            return
+        if self.preview_thread is None:
+            self.preview_thread = PreviewThread(parent=self)
+            self.preview_thread.previewRendered.connect(self.show_preview)
+            self.preview_thread.start()
+        self.preview_thread.request(entry=items[0].data(QtCore.Qt.UserRole, 0),
+                                    overlay_path=self.watermark_lineEdit.text(),
+                                    name=self.reciever_lineEdit.text(),
+                                    task=self.task_lineEdit.text(),
+                                    opacity=self.get_opacity(),
+                                    resize=self.get_resize(),
+                                    blend_mode=BLEND_MODES[self.blend_comboBox.currentIndex()])
+
+    def show_preview(self, result):
+        qimage, info = result
+        if not self.drop_widget.selectedItems():
+            return
+        if qimage is None:
+            self.preview_label.clear()
+        else:
+            pixmap = QtGui.QPixmap.fromImage(qimage)
+            self.preview_label.setPixmap(pixmap.scaled(self.preview_label.size(), QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation))
+        self.preview_info_label.setText(info)
+
+    def cancel_job(self):
+        if self.job_queue is None:
+            return  # no job started yet
+        items = self.job_widget.selectedItems()
+        for item in items:
+            self.job_queue.cancel(item.data(QtCore.Qt.UserRole, 0))
+        if items:
+            self.statusBar.showMessage('Cancelling {} jobs...'.format(len(items)))
 
     def dest_edit(self):
         path = self.dest_lineEdit.text().replace('\\', '/')
@@ -475,37 +729,40 @@ class Watermarkr(QtWidgets.QMainWindow):
                 pass
 
     def clear_item(self):
+        for intake_thread in self.intake_threads:
+            intake_thread.stop()
+        self.intake_threads = []
+        self.intake_paths.clear()
         self.drop_widget.clear()
 
     def file_dropped(self, paths):
-        existing_paths = self.get_current_paths()
-        i = 0
+        # set based duplicate check, files being added by an intake thread count as existing
+        existing_paths = set(self.get_current_paths())
+        existing_paths.update(self.intake_paths)
         unsupported_files = []
         duplicated_files = []
+        new_paths = []
         for path in paths:
             logger.info('Dropped: {}'.format(path))
             fn, ext = os.path.splitext(path)
-            if ext.lower() not in SUPPORT_FORMAT:
+            if not os.path.isdir(path) and ext.lower() not in SUPPORT_FORMAT:
                 unsupported_files.append(path)
             elif path in existing_paths:
                 duplicated_files.append(path)
             else:
-                baseName = os.path.basename(path)
-                item = QtWidgets.QTreeWidgetItem(self.drop_widget)
-                # filename
-                item.setText(0, baseName)
-                # file size
-                item.setText(1,  file_utils.get_readable_filesize(path))
-                # icon
-                iconWidget = QtGui.QIcon()
-                iconPath = Icon.extMap.get(ext.lower(), Icon.extMap['unknown'])
-                iconWidget.addPixmap(QtGui.QPixmap(iconPath), QtGui.QIcon.Normal, QtGui.QIcon.Off)
-                item.setIcon(0, iconWidget)
-                # data
-                item.setData(QtCore.Qt.UserRole, 0, path)
-                # tooltip
-                item.setToolTip(0, path)
-                i += 1
+                existing_paths.add(path)
+                new_paths.append(path)
+
+        if new_paths:
+            # file size is read in background, items are added in batches as results come
+            self.intake_paths.update(new_paths)
+            intake_thread = IntakeThread(paths=new_paths, parent=self)
+            intake_thread.filesChecked.connect(partial(self.add_items, intake_thread))
+            intake_thread.finished.connect(partial(self.intake_finished, intake_thread))
+            self.intake_threads.append(intake_thread)
+            self.statusBar.showMessage('Adding {} files...'.format(len(new_paths)))
+            intake_thread.start()
+
         if unsupported_files or duplicated_files:
             err_msg = 'Not all dropped files are valid, '
             if unsupported_files:
@@ -524,6 +781,49 @@ class Watermarkr(QtWidgets.QMainWindow):
             qmsgBox.setIcon(QtWidgets.QMessageBox.Critical)
             qmsgBox.exec_()
 
+    def add_items(self, intake_thread, results):
+        if intake_thread not in self.intake_threads:  # cleared while reading
+            return
+        # files found in dropped folders may already be in the list
+        existing_paths = set(self.get_current_paths())
+        items = []
+        for path, rel_dir, size in results:
+            if path in existing_paths:
+                continue
+            existing_paths.add(path)
+            self.intake_paths.discard(path)
+            baseName = os.path.basename(path)
+            item = QtWidgets.QTreeWidgetItem()
+            # filename, a sequence shows its frame range
+            item.setText(0, baseName)
+            # file size
+            item.setText(1, size)
+            # icon
+            item.setIcon(0, self.get_icon(intake.get_extension(path)))
+            # data
+            item.setData(QtCore.Qt.UserRole, 0, path)
+            item.setData(QtCore.Qt.UserRole + 1, 0, rel_dir)
+            # tooltip
+            item.setToolTip(0, path)
+            items.append(item)
+        self.drop_widget.addTopLevelItems(items)
+
+    def intake_finished(self, intake_thread):
+        if intake_thread in self.intake_threads:
+            self.intake_threads.remove(intake_thread)
+        self.intake_paths.difference_update(intake_thread.paths)
+        if not self.intake_threads:
+            self.statusBar.showMessage('{} files ready.'.format(self.drop_widget.topLevelItemCount()))
+
+    def get_icon(self, ext):
+        # one icon per extension
+        if ext not in self.icon_cache:
+            iconWidget = QtGui.QIcon()
+            iconPath = Icon.extMap.get(ext, Icon.extMap['unknown'])
+            iconWidget.addPixmap(QtGui.QPixmap(iconPath), QtGui.QIcon.Normal, QtGui.QIcon.Off)
+            self.icon_cache[ext] = iconWidget
+        return self.icon_cache[ext]
+
     def get_current_paths(self):
         rootItem = self.drop_widget.invisibleRootItem()
         paths = []
@@ -533,6 +833,15 @@ class Watermarkr(QtWidgets.QMainWindow):
             paths.append(path)
         return paths
 
+    def get_current_rel_dirs(self):
+        # output sub folder of each item, empty for files dropped directly
+        rootItem = self.drop_widget.invisibleRootItem()
+        rel_dirs = []
+        for i in range(rootItem.childCount()):
+            item = rootItem.child(i)
+            rel_dirs.append(item.data(QtCore.Qt.UserRole + 1, 0) or '')
+        return rel_dirs
+
     def browse_directory(self):
         dirpath = QtWidgets.QFileDialog.getExistingDirectory(parent=self, 
                                                             caption='Browse Output Directory',
@@ -552,16 +861,10 @@ class Watermarkr(QtWidgets.QMainWindow):
         task = self.task_lineEdit.text()
         paths = self.get_current_paths()
         overlay_path = self.watermark_lineEdit.text()  # overlay path 
-        if not name or not task or not paths:
+        errors = validate.check_inputs(name, task, paths, overlay_path)
+        if errors:
             err_msg = 'Invalid inputs,\n'
-            if not name or not file_utils.is_ascii(text=name):
-                err_msg += '- Please fill the name of reciever in English\n'
-            if not task or not file_utils.is_ascii(text=task):
-                err_msg += '- Please fill task name in English\n'
-            if not paths:
-                err_msg += '- No files to stamp watermark'
-            if not overlay_path or not os.path.exists(overlay_path):
-                err_msg += '- Overlay image doesn\'t exist'
+            err_msg += '\n'.join('- {}'.format(error) for error in errors)
 
             qmsgBox = QtWidgets.QMessageBox(self)
             qmsgBox.setText(err_msg)
@@ -578,116 +881,216 @@ class Watermarkr(QtWidgets.QMainWindow):
 
         return name, task, paths, output_dir, overlay_path
 
-    def thread_stamp(self, input_paths, text, output_paths, overlay_path, opacity, resize): 
-        self.thread = StampThread(input_paths=input_paths, 
-                                text=text, 
-                                output_paths=output_paths,
-                                overlay_path=overlay_path,
-                                opacity=opacity,
-                                resize=resize,
-                                callback_func=self.emit_subprogress, 
-                                parent=self)
-
-        # call update progress to update UI
-        self.subProgressBar.setValue(0)
-        self.update_main_progress((0, len(input_paths)))
-
-        self.thread.progressStamped.connect(self.update_main_progress)
-        self.thread.mediaStamped.connect(self.reset_progress_ui)
-        self.thread.stampFinished.connect(self.stamp_finished)
-        self.subprogress.connect(self.update_sub_progress)
-        self.thread.start()
-
-    def update_main_progress(self, results, *args, **kwargs):
-        current, total = results
-        # update statubar text
-        status_text = 'Working on file: ({}/{})...'.format(current+1, total)
+    def add_job_item(self, job):
+        item = QtWidgets.QTreeWidgetItem()
+        item.setText(0, job.name)
+        item.setToolTip(0, job.report_dir or job.name)
+        item.setData(QtCore.Qt.UserRole, 0, job.id)
+        self.job_widget.addTopLevelItem(item)
+        self.job_items[job.id] = item
+        self.update_job_item(job)
+
+    def update_job_item(self, job):
+        item = self.job_items.get(job.id)
+        if item is None:
+            return
+        item.setText(1, '{}/{}'.format(job.num_done, job.num_files))
+        status = job.state.capitalize()
+        if job.state == jobs.RUNNING and job.cancel_requested:
+            status = 'Cancelling'
+        elif job.waiting_memory:
+            status = 'Waiting for memory'
+        elif job.is_finished():
+            status += ' in {:.1f} sec'.format(job.get_time_taken())
+        if job.num_skipped:
+            status += ', {} up to date'.format(job.num_skipped)
+        if job.errors:
+            status += ', {} failed'.format(len(job.errors))
+        item.setText(2, status)
+
+    def job_event(self, snapshot):
+        job = self.job_queue.jobs.get(snapshot['job'])
+        if job is None:
+            return
+        self.update_job_item(job)
+        if snapshot['state'] in progress.FINAL_STATES:
+            self.job_snapshots.pop(job.id, None)
+            self.job_finished(job)
+        else:
+            self.job_snapshots[job.id] = snapshot
+        self.update_progress()
+
+    def update_progress(self):
+        # main progress is every active job together weighted by estimated cost,
+        # sub progress follows the selected or first running job
+        active_jobs = self.job_queue.get_active_jobs()
+        if not active_jobs:
+            self.reset_progress_ui()
+            return
+        snapshots = [self.job_snapshots[job.id] for job in active_jobs if job.id in self.job_snapshots]
+        num_done = sum(job.num_done for job in active_jobs)
+        num_files = sum(job.num_files for job in active_jobs)
+        total_cost = sum(job.total_cost for job in active_jobs)
+        if total_cost:
+            main_progress = sum(job.done_cost for job in active_jobs) / total_cost
+        else:
+            main_progress = num_done / float(max(num_files, 1))
+        status_text = 'Working on {} jobs: ({}/{})...'.format(len(active_jobs), min(num_done + 1, num_files), num_files)
+        if snapshots:
+            # jobs share the workers, all of them are done when the slowest is
+            etas = [snapshot['eta'] for snapshot in snapshots]
+            status_text += ' {:.1f} files/s, {} left'.format(sum(snapshot['files_per_sec'] for snapshot in snapshots),
+                                                            progress.format_eta(None if None in etas else max(etas)))
+        if any(job.waiting_memory for job in active_jobs):
+            status_text += ' waiting for memory, {:.1f} of {:.1f} GB in use'.format(self.job_queue.memory_used / 1024.0 ** 3,
+                                                                                   self.job_queue.memory_budget / 1024.0 ** 3)
         self.statusBar.showMessage(status_text)
-        # select the item in the list
-        self.drop_widget.setCurrentItem(self.drop_widget.topLevelItem(current))
-        # update progressbar
-        self.mainProgressBar.setValue((current/float(total))*100)
-
-    def emit_subprogress(self, callback_result, *args, **kwargs):
-        self.subprogress.emit(callback_result)
+        self.mainProgressBar.setValue(int(main_progress * 100))
 
-    def update_sub_progress(self, callback_result, *args, **kwargs):
-        current, total = callback_result
-        percent = (float(current)/float(total)) * 100.0
-        self.subProgressBar.setValue(int(percent))
+        selected_ids = [item.data(QtCore.Qt.UserRole, 0) for item in self.job_widget.selectedItems()]
+        job = next((job for job in active_jobs if job.id in selected_ids), active_jobs[0])
+        if job.sub_progress:
+            current, total = job.sub_progress
+            self.subProgressBar.setValue(int(float(current) / float(max(total, 1)) * 100.0))
 
     def reset_progress_ui(self, *args):
         self.mainProgressBar.setValue(0)
         self.subProgressBar.setValue(0)
 
-    def stamp_finished(self, results, *args, **kwargs):
-        paths, time_taken = results
-        self.statusBar.showMessage('Finished in {} sec'.format(time_taken))
-        self.reset_progress_ui()
-        QtWidgets.QApplication.restoreOverrideCursor()
-
-        qmsgBox = QtWidgets.QMessageBox(self)
-        qmsgBox.setText('Stamp finished, please check your result.')
-        qmsgBox.setWindowTitle('Success')
-        qmsgBox.addButton('  OK  ', QtWidgets.QMessageBox.AcceptRole)
-        qmsgBox.setIcon(QtWidgets.QMessageBox.Information)
-        qmsgBox.exec_()
+    def job_finished(self, job):
+        status_text = '{} {} in {:.1f} sec'.format(job.name, job.state, job.get_time_taken())
+        if job.num_skipped:
+            status_text += ', {} files already up to date'.format(job.num_skipped)
+        if job.report.num_linked:
+            status_text += ', {} identical files linked, saved {:.1f} sec'.format(job.report.num_linked, job.report.saved_wall)
+        self.statusBar.showMessage(status_text)
 
-        self.enable_ui(value=True)
+        if job.errors:
+            err_msg = 'Stamp finished with errors, {}\n\n- Failed Files\n    '.format(job.name)
+            err_msg += '\n    '.join([os.path.basename(path or '') for path, error in job.errors])
+            qmsgBox = QtWidgets.QMessageBox(self)
+            qmsgBox.setText(err_msg)
+            qmsgBox.setWindowTitle('Stamp Error')
+            qmsgBox.addButton('  OK  ', QtWidgets.QMessageBox.AcceptRole)
+            qmsgBox.setIcon(QtWidgets.QMessageBox.Critical)
+            qmsgBox.show()
 
     def stamp(self):
-        # check for user input first
+        if self.intake_threads:
+            self.statusBar.showMessage('Please wait, still adding files...')
+            return
+        # check for user input first, it doesn't need the backends
         name, task, input_paths, output_dir, overlay_path = self.check_user_inputs()
-        if self.adaptive_checkbox.isChecked():
-            opacity = OPACITY_RANGE
-        else:
-            opacity = self.opacity_slider.value() * 0.01
-
-        resize = None
-        if self.resize_checkbox.isChecked():
-            resize = int(self.resize_lineEdit.text())
-
-        QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
-        self.enable_ui(value=False)
-        self.statusBar.showMessage('Preparing to process...')
+        job_kwargs = dict(name=name,
+                          task=task,
+                          input_paths=input_paths,
+                          output_dir=output_dir,
+                          overlay_path=overlay_path,
+                          opacity=self.get_opacity(),
+                          resize=self.get_resize(),
+                          rel_dirs=self.get_current_rel_dirs(),
+                          blend_mode=BLEND_MODES[self.blend_comboBox.currentIndex()],
+                          force=self.rebuild_checkbox.isChecked(),
+                          dedup=self.dedup_checkbox.isChecked(),
+                          order=ORDERS[self.order_comboBox.currentIndex()],
+                          profile=PROFILES[self.profile_comboBox.currentIndex()],
+                          farm_dir=FARM_DIR if self.farm_checkbox.isChecked() else None)
+        if jobs is None or self.pending_jobs:
+            # the UI isn't blocked on the backends, the job starts once they are loaded
+            self.pending_jobs.append(job_kwargs)
+            self.statusBar.showMessage('Job {} - {} starts once the stamping engine is loaded...'.format(name, task))
+            return
+        self.submit_job(job_kwargs)
+
+    def submit_job(self, job_kwargs):
+        # the job runs in background, the UI stays free for the next one
+        job = jobs.make_job(**job_kwargs)
+        self.add_job_item(job)
+        self.get_job_queue().submit(job)
+        self.statusBar.showMessage('Job added: {}'.format(job.name))
+
+    def backends_loaded(self):
+        pending_jobs, self.pending_jobs = self.pending_jobs, []
+        for job_kwargs in pending_jobs:
+            self.submit_job(job_kwargs)
+
+    def offer_resume(self, checkpoints):
+        # Resume, Later keeps them for the next start, Discard forgets them
+        names = [checkpoint['name'] for path, checkpoint in checkpoints]
+        qmsgBox = QtWidgets.QMessageBox(self)
+        qmsgBox.setText('{} jobs didn\'t finish last time\n\n    {}\n\nResume them? Files already stamped are skipped.'.format(len(names), '\n    '.join(names)))
+        qmsgBox.setWindowTitle('Resume Jobs')
+        resume_button = qmsgBox.addButton('  Resume  ', QtWidgets.QMessageBox.AcceptRole)
+        qmsgBox.addButton('  Later  ', QtWidgets.QMessageBox.RejectRole)
+        discard_button = qmsgBox.addButton('  Discard  ', QtWidgets.QMessageBox.DestructiveRole)
+        qmsgBox.setIcon(QtWidgets.QMessageBox.Question)
+        qmsgBox.exec_()
+        if qmsgBox.clickedButton() == discard_button:
+            for path, checkpoint in checkpoints:
+                recovery.remove_checkpoint(path)
+            return
+        if qmsgBox.clickedButton() != resume_button:
+            return
+        job_queue = self.get_job_queue()
+        for path, checkpoint in checkpoints:
+            try:
+                job = jobs.resume_job(path, checkpoint)
+            except Exception:
+                logger.error('Failed to resume {}: {}'.format(checkpoint['name'], traceback.format_exc()))
+                recovery.remove_checkpoint(path)
+                continue
+            if job is None:
+                continue  # resumed by another Watermarkr
+            self.add_job_item(job)
+            job_queue.submit(job)
+        self.statusBar.showMessage('Resumed {} jobs'.format(len(checkpoints)))
+
+    def showEvent(self, event):
+        super(Watermarkr, self).showEvent(event)
+        if self.backend_thread is None:
+            self.backend_thread = BackendThread(parent=self)
+            self.backend_thread.backendsLoaded.connect(self.backends_loaded)
+            self.backend_thread.checkpointsFound.connect(self.offer_resume)
+            QtCore.QTimer.singleShot(BACKEND_LOAD_DELAY, self.backend_thread.start)
+
+    def get_job_queue(self):
+        # waits for the backends if Stamp is pressed before they are loaded
+        if self.job_queue is None:
+            load_backends()
+            self.progress_stream = progress.ProgressStream(self.job_signals.emit_progress, rate=PROGRESS_RATE)
+            self.job_queue = jobs.JobQueue(callback_func=self.progress_stream.job_event, memory_budget=self.get_memory_budget())
+        return self.job_queue
+
+    def closeEvent(self, event):
+        # files being stamped are dropped, outputs already done stay in the manifest
+        num_jobs = len(self.pending_jobs)
+        if self.job_queue is not None:
+            num_jobs += len(self.job_queue.get_active_jobs())
+        if num_jobs:
+            qmsgBox = QtWidgets.QMessageBox(self)
+            qmsgBox.setText('{} jobs are still running\n\nClose and cancel them? Jobs already started can be resumed on the next start.'.format(num_jobs))
+            qmsgBox.setWindowTitle('Close Watermarkr')
+            close_button = qmsgBox.addButton('  Close  ', QtWidgets.QMessageBox.AcceptRole)
+            qmsgBox.addButton('  Keep Running  ', QtWidgets.QMessageBox.RejectRole)
+            qmsgBox.setIcon(QtWidgets.QMessageBox.Warning)
+            qmsgBox.exec_()
+            if qmsgBox.clickedButton() != close_button:
+                event.ignore()
+                return
+        if self.job_queue is not None:
+            self.job_queue.shutdown()
+        if self.backend_thread is not None:
+            self.backend_thread.wait()
+        if self.preview_thread is not None:
+            self.preview_thread.stop()
+            self.preview_thread.wait()
+        super(Watermarkr, self).closeEvent(event)
 
-        rootItem = self.drop_widget.invisibleRootItem()
-        # prepare text
-        overlay_text = 'For {} - {} - {}'.format(name, task, datetime.strftime(datetime.today(), '%y/%m/%d'))
-        folder_name = '{}_{}'.format(name, datetime.strftime(datetime.today(), '%y%m%d'))
-        output_name_dir = '{}/{}'.format(output_dir, folder_name)
-        if not os.path.exists(output_name_dir):
-            os.makedirs(output_name_dir)
-
-        # prepare output paths
-        output_paths = []
-        for i, path in enumerate(input_paths):
-            baseName = os.path.basename(path)
-            output_path = '{}/{}'.format(output_name_dir, baseName)
-            output_paths.append(output_path)
-        
-        self.thread_stamp(input_paths=input_paths, 
-                        text=overlay_text, 
-                        output_paths=output_paths, 
-                        overlay_path=overlay_path, 
-                        opacity=opacity, 
-                        resize=resize)
-    
-    def enable_ui(self, value):
-        self.reciever_lineEdit.setEnabled(value)
-        self.task_lineEdit.setEnabled(value)
-        self.drop_widget.setEnabled(value)
-        self.dest_lineEdit.setEnabled(value)
-        self.browse_button.setEnabled(value)  
-        self.delete_button.setEnabled(value)
-        self.refresh_button.setEnabled(value)
-        self.stamp_button.setEnabled(value) 
-   
 def show():
     app = QtWidgets.QApplication(sys.argv)
+    stylesheet.set_default(app)
     myApp = Watermarkr()
     myApp.show()
-    stylesheet.set_default(app)
     # draw_widget background
     myApp.drop_widget.setStyleSheet('background-image:url("{}/icons/bg.png");'.format(moduleDir))
 
@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Watermarkr benchmarks, fixtures are generated locally.
+# usage: python benchmark.py --json result.json composite --sizes 2K 4K --repeat 5
+#        python benchmark.py --json result.json stamp --formats jpg tif pdf mov --workers 1 4 8
+#        python benchmark.py startup --budget 1.5, exits with 1 when the window takes longer to paint
+#        python benchmark.py --json result.json profiles --formats jpg png tif pdf mov, or --inputs on real media
+
+import sys
+import os
+import re
+import json
+import time
+import shutil
+import socket
+import platform
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from datetime import datetime
+from collections import OrderedDict, defaultdict
+
+import overlay
+import composite
+import pdf
+
+SIZES = OrderedDict([('2K', (2048, 1080)), ('4K', (4096, 2160)), ('8K', (8192, 4320))])
+STILL_FORMATS = ('jpg', 'png', 'tif')
+FORMATS = STILL_FORMATS + ('pdf', 'mov', 'mp4')
+OVERLAY_SIZE = (2048, 1080)
+OPACITY = 0.12
+OPACITY_RANGE = (0.075, 0.15)
+TEXT = 'For Benchmark - Comp - 00/00/00'
+RESIZE = 1024  # resize limit of the resize on cases, below every fixture size
+PDF_PAGE_SIZE = (842, 595)  # A4 landscape in points
+VIDEO_DURATION = 2.0  # sec of each video fixture
+VIDEO_FPS = 24
+STARTUP_BUDGET = 1.5  # sec from python start to the first paint of the window
+# modules that must not be imported before the window paints
+BACKEND_MODULES = ('engine', 'jobs', 'preview', 'progress', 'cost', 'farm', 'rf_config', 'rf_utils.file_utils', 'rf_utils.pipeline.watermark',
+                   'rf_utils.pipeline.convert_lib', 'numpy', 'fitz')
+
+# run in a fresh interpreter next to app.py, prints the timings as json
+STARTUP_SCRIPT = '''
+import sys, time, json
+start = time.time()
+import app
+import_sec = time.time() - start
+from Qt import QtWidgets
+qapp = QtWidgets.QApplication(sys.argv)
+app.stylesheet.set_default(qapp)
+window = app.Watermarkr()
+eager = [name for name in %r if name in sys.modules]
+window.show()
+window.repaint()
+qapp.processEvents()
+paint_sec = time.time() - start
+app.load_backends()
+backends_sec = time.time() - start - paint_sec
+sys.stdout.write(json.dumps({'import_sec': import_sec, 'paint_sec': paint_sec, 'backends_sec': backends_sec, 'eager': eager}))
+sys.stdout.flush()
+''' % (BACKEND_MODULES, )
+
+
+def make_image(size):
+    # noisy gradient so nothing is trivially compressible
+    np = composite.np
+    width, height = size
+    x = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None, None]
+    noise = np.random.RandomState(0).randint(0, 32, (height, width, 3)).astype(np.float32)
+    array = (x * 0.5 + y * 0.3 + noise) % 256
+    return overlay.Image.fromarray(array.astype(np.uint8))
+
+
+def make_overlay(path, size=OVERLAY_SIZE):
+    # white logo-ish block with soft alpha in the middle, transparent around it
+    image = overlay.Image.new('RGBA', size, (0, 0, 0, 0))
+    width, height = size
+    box = overlay.Image.new('RGBA', (width // 2, height // 2), (255, 255, 255, 160))
+    image.paste(box, (width // 4, height // 4))
+    image.save(path)
+    return path
+
+
+def make_pdf(path, pages):
+    # pages of text and shapes, close to a vector storyboard
+    fitz = pdf.fitz
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page(width=PDF_PAGE_SIZE[0], height=PDF_PAGE_SIZE[1])
+        page.draw_rect(fitz.Rect(40, 40, PDF_PAGE_SIZE[0] - 40, PDF_PAGE_SIZE[1] - 40), color=(0.2, 0.2, 0.2), fill=(0.9, 0.9, 0.85))
+        page.insert_text((60, 80), 'Benchmark page {}'.format(i + 1), fontsize=24)
+    doc.save(path)
+    doc.close()
+    return path
+
+
+def make_video(path, size, ffmpeg):
+    # test pattern with a sine audio track
+    width, height = size
+    cmd = [ffmpeg, '-y', '-v', 'error',
+        '-f', 'lavfi', '-i', 'testsrc2=size={}x{}:rate={}'.format(width, height, VIDEO_FPS),
+        '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000',
+        '-t', str(VIDEO_DURATION), '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-shortest', path]
+    subprocess.check_call(cmd)
+    return path
+
+
+def make_fixtures(workdir, sizes, formats, count, pages):
+    # count files of every format and size, returns [(format, size name, [paths], pixels, frames)]
+    import engine
+    fixtures = []
+    for fmt in formats:
+        if fmt == 'pdf':
+            if not pdf.is_available():
+                print('Skipped pdf, PyMuPDF is not available')
+                continue
+            paths = [make_pdf(os.path.join(workdir, 'doc_{:03d}.pdf'.format(i)), pages) for i in range(count)]
+            fixtures.append((fmt, '{}p'.format(pages), paths, 0, pages * count))
+            continue
+        for size_name in sizes:
+            size = SIZES[size_name]
+            if fmt in STILL_FORMATS:
+                image = make_image(size)
+                paths = []
+                for i in range(count):
+                    path = os.path.join(workdir, '{}_{:03d}.{}'.format(size_name, i, fmt))
+                    image.save(path)
+                    paths.append(path)
+                fixtures.append((fmt, size_name, paths, size[0] * size[1] * count, 0))
+            else:
+                if not engine.video.is_available():
+                    print('Skipped {}, ffmpeg/ffprobe are not available'.format(fmt))
+                    break
+                paths = [make_video(os.path.join(workdir, '{}_{:03d}.{}'.format(size_name, i, fmt)), size, engine.video.FFMPEG)
+                        for i in range(count)]
+                frames = int(VIDEO_DURATION * VIDEO_FPS) * count
+                fixtures.append((fmt, size_name, paths, size[0] * size[1] * frames, frames))
+    return fixtures
+
+
+def timeit(func, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def bench_composite(sizes, repeat, workdir):
+    # current PIL alpha_composite path vs numpy blend modes, per megapixel
+    overlay_path = make_overlay(os.path.join(workdir, 'overlay.png'))
+    results = []
+    for size_name in sizes:
+        image = make_image(SIZES[size_name])
+        megapixels = image.size[0] * image.size[1] / 1000000.0
+        prepared = overlay.get_prepared_overlay(overlay_path, TEXT, OPACITY, image.size)
+        prepared.get_arrays()
+
+        cases = [('pil', 'normal', lambda: prepared.composite(image))]
+        for mode in composite.BLEND_MODES[1:]:
+            cases.append(('numpy', mode, lambda mode=mode: overlay.composite_image(image, overlay_path, TEXT, OPACITY, blend_mode=mode)))
+        cases.append(('pil', 'auto_opacity', lambda: overlay.auto_opacity(image, (0.075, 0.15))))
+        cases.append(('numpy', 'auto_opacity', lambda: composite.mean_luminance(composite.np.asarray(image))))
+
+        for path, mode, func in cases:
+            sec = timeit(func, repeat)
+            results.append(OrderedDict([('bench', 'composite'),
+                                        ('size', size_name),
+                                        ('path', path),
+                                        ('mode', mode),
+                                        ('sec', round(sec, 4)),
+                                        ('mp_per_sec', round(megapixels / sec, 2))]))
+    return results
+
+
+def bench_stamp(sizes, formats, workers, count, pages, repeat, workdir):
+    # the path StampThread takes, engine.StampEngine.imap over the fixtures of one format and size,
+    # with resize on/off, fixed/auto opacity and each number of workers
+    import engine
+    overlay_path = make_overlay(os.path.join(workdir, 'overlay.png'))
+    fixture_dir = os.path.join(workdir, 'fixtures')
+    os.makedirs(fixture_dir)
+    results = []
+    for fmt, size_name, paths, pixels, frames in make_fixtures(fixture_dir, sizes, formats, count, pages):
+        for resize in (None, RESIZE):
+            if resize and fmt == 'pdf':
+                continue
+            for opacity_name, opacity in (('fixed', OPACITY), ('auto', OPACITY_RANGE)):
+                for num_workers in workers:
+                    output_dir = os.path.join(workdir, 'output')
+                    times = []
+                    peak_rss = 0
+                    for i in range(repeat):
+                        shutil.rmtree(output_dir, ignore_errors=True)
+                        os.makedirs(output_dir)
+                        output_paths = engine.get_output_paths(paths, output_dir)
+                        stamp_engine = engine.StampEngine(workers=num_workers)
+                        start = time.time()
+                        for index, result in stamp_engine.imap(input_paths=paths,
+                                                               output_paths=output_paths,
+                                                               text=TEXT,
+                                                               overlay_path=overlay_path,
+                                                               opacity=opacity,
+                                                               resize=resize):
+                            pass
+                        times.append(time.time() - start)
+                        # peak of the worker processes, or of this process when stamped serially
+                        peak_rss = max([peak_rss] + [r['process_peak_rss'] or 0 for r in stamp_engine.report.records])
+                    sec = min(times)
+                    results.append(OrderedDict([('bench', 'stamp'),
+                                                ('format', fmt),
+                                                ('size', size_name),
+                                                ('resize', resize or 0),
+                                                ('opacity', opacity_name),
+                                                ('workers', num_workers),
+                                                ('files', len(paths)),
+                                                ('sec', round(sec, 4)),
+                                                ('files_per_sec', round(len(paths) / sec, 2)),
+                                                ('mp_per_sec', round(pixels / 1000000.0 / sec, 2)),
+                                                ('frames_per_sec', round(frames / sec, 2)),
+                                                ('peak_rss_mb', round(peak_rss / 1048576.0, 1))]))
+                    print('{format} {size} resize={resize} opacity={opacity} workers={workers}: {sec}s'.format(**results[-1]))
+    return results
+
+
+def get_input_fixtures(inputs):
+    # real media grouped by format, same shape as make_fixtures
+    groups = defaultdict(list)
+    for path in inputs:
+        groups[os.path.splitext(path)[-1].lower().lstrip('.')].append(os.path.abspath(path))
+    return [(fmt, 'input', paths, 0, 0) for fmt, paths in sorted(groups.items())]
+
+
+def bench_profiles(sizes, formats, workers, count, pages, repeat, workdir, inputs=None):
+    # time and output size of every encoding profile, relative to balanced (what was written before profiles)
+    import engine
+    overlay_path = make_overlay(os.path.join(workdir, 'overlay.png'))
+    if inputs:
+        fixtures = get_input_fixtures(inputs)
+    else:
+        fixture_dir = os.path.join(workdir, 'fixtures')
+        os.makedirs(fixture_dir)
+        fixtures = make_fixtures(fixture_dir, sizes, formats, count, pages)
+    results = []
+    for fmt, size_name, paths, pixels, frames in fixtures:
+        input_bytes = sum(os.path.getsize(path) for path in paths)
+        rows = OrderedDict()
+        for profile in engine.PROFILES:
+            output_dir = os.path.join(workdir, 'output')
+            times = []
+            for i in range(repeat):
+                shutil.rmtree(output_dir, ignore_errors=True)
+                os.makedirs(output_dir)
+                output_paths = engine.get_output_paths(paths, output_dir)
+                stamp_engine = engine.StampEngine(workers=workers)
+                start = time.time()
+                for index, result in stamp_engine.imap(input_paths=paths,
+                                                       output_paths=output_paths,
+                                                       text=TEXT,
+                                                       overlay_path=overlay_path,
+                                                       opacity=OPACITY,
+                                                       resize=None,
+                                                       profile=profile):
+                    pass
+                times.append(time.time() - start)
+            output_bytes = sum(os.path.getsize(path) for path in output_paths)
+            sec = min(times)
+            rows[profile] = OrderedDict([('bench', 'profiles'),
+                                         ('format', fmt),
+                                         ('size', size_name),
+                                         ('profile', profile),
+                                         ('files', len(paths)),
+                                         ('sec', round(sec, 4)),
+                                         ('files_per_sec', round(len(paths) / sec, 2)),
+                                         ('output_mb', round(output_bytes / 1048576.0, 2)),
+                                         ('output_ratio', round(output_bytes / float(max(input_bytes, 1)), 3))])
+        for profile, row in rows.items():
+            row['time_vs_balanced'] = round(row['sec'] / max(rows['balanced']['sec'], 1e-6), 2)
+            row['size_vs_balanced'] = round(row['output_mb'] / max(rows['balanced']['output_mb'], 1e-6), 2)
+            results.append(row)
+            print('{format} {size} {profile}: {sec}s, {output_mb} MB'.format(**row))
+    return results
+
+
+def bench_startup(budget, repeat):
+    # import of app.py and first paint of the window, each run in a fresh interpreter.
+    # Offscreen so it runs the same on a workstation and a headless build node.
+    env = dict(os.environ)
+    env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for i in range(repeat):
+        try:
+            output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT], cwd=app_dir, env=env)
+        except subprocess.CalledProcessError:
+            sys.exit('Startup script failed, see the error above')
+        runs.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+    paint_sec = min(run['paint_sec'] for run in runs)
+    eager = sorted(set(name for run in runs for name in run['eager']))
+    result = OrderedDict([('bench', 'startup'),
+                          ('import_sec', round(min(run['import_sec'] for run in runs), 4)),
+                          ('paint_sec', round(paint_sec, 4)),
+                          ('backends_sec', round(min(run['backends_sec'] for run in runs), 4)),
+                          ('budget_sec', budget),
+                          ('eager', ' '.join(eager) or '-'),
+                          ('passed', paint_sec <= budget and not eager)])
+    return [result]
+
+
+def get_version():
+    # version from the app changelog, app.py imports Qt so it is read as text
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+    with open(app_path, 'r') as f:
+        match = re.search(r"^_version = '(.+)'", f.read(), re.MULTILINE)
+    return match.group(1) if match else None
+
+
+def get_machine_info():
+    # stored with the results to compare runs between releases and farm nodes
+    return OrderedDict([('version', get_version()),
+                        ('host', socket.gethostname()),
+                        ('platform', platform.platform()),
+                        ('python', platform.python_version()),
+                        ('cpu_count', multiprocessing.cpu_count()),
+                        ('date', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))])
+
+
+def print_results(results):
+    if not results:
+        return
+    keys = list(results[0].keys())
+    print('  '.join('{:>12}'.format(k) for k in keys))
+    for row in results:
+        print('  '.join('{:>12}'.format(row[k]) for k in keys))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='benchmark', description='Watermarkr benchmarks.')
+    parser.add_argument('--json', help='write results to this json file')
+    subparsers = parser.add_subparsers(dest='bench')
+
+    composite_parser = subparsers.add_parser('composite', help='still compositing throughput per megapixel')
+    composite_parser.add_argument('--sizes', nargs='+', choices=list(SIZES.keys()), default=['2K', '4K'])
+    composite_parser.add_argument('--repeat', type=int, default=3)
+
+    stamp_parser = subparsers.add_parser('stamp', help='files, megapixels and frames per second through the stamp engine')
+    stamp_parser.add_argument('--sizes', nargs='+', choices=list(SIZES.keys()), default=['2K', '4K'])
+    stamp_parser.add_argument('--formats', nargs='+', choices=FORMATS, default=list(STILL_FORMATS))
+    stamp_parser.add_argument('--workers', nargs='+', type=int, default=[1, multiprocessing.cpu_count()])
+    stamp_parser.add_argument('--count', type=int, default=8, help='files of each format and size')
+    stamp_parser.add_argument('--pages', type=int, default=20, help='pages of each pdf')
+    stamp_parser.add_argument('--repeat', type=int, default=1)
+
+    profiles_parser = subparsers.add_parser('profiles', help='time and output size of every encoding profile')
+    profiles_parser.add_argument('--sizes', nargs='+', choices=list(SIZES.keys()), default=['2K', '4K'])
+    profiles_parser.add_argument('--formats', nargs='+', choices=FORMATS, default=list(FORMATS))
+    profiles_parser.add_argument('--inputs', nargs='+', help='real media to use instead of generated fixtures')
+    profiles_parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    profiles_parser.add_argument('--count', type=int, default=8, help='files of each format and size')
+    profiles_parser.add_argument('--pages', type=int, default=20, help='pages of each pdf')
+    profiles_parser.add_argument('--repeat', type=int, default=1)
+
+    startup_parser = subparsers.add_parser('startup', help='time to the first paint of the window, fails over budget or when backends load before it')
+    startup_parser.add_argument('--budget', type=float, default=STARTUP_BUDGET, help='sec (default: {})'.format(STARTUP_BUDGET))
+    startup_parser.add_argument('--repeat', type=int, default=3)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.bench != 'startup' and (not overlay.is_available() or not composite.is_available()):
+        parser.error('PIL and numpy are required to run benchmarks')
+
+    workdir = tempfile.mkdtemp(prefix='watermarkr_bench_')
+    try:
+        if args.bench == 'composite':
+            results = bench_composite(args.sizes, args.repeat, workdir)
+        elif args.bench == 'stamp':
+            results = bench_stamp(args.sizes, args.formats, args.workers, args.count, args.pages, args.repeat, workdir)
+        elif args.bench == 'profiles':
+            results = bench_profiles(args.sizes, args.formats, args.workers, args.count, args.pages, args.repeat, workdir, inputs=args.inputs)
+        elif args.bench == 'startup':
+            results = bench_startup(args.budget, args.repeat)
+        else:
+            parser.error('choose a benchmark')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(OrderedDict([('machine', get_machine_info()), ('results', results)]), f, indent=4)
+    if any(not result.get('passed', True) for result in results):
+        print('Startup over budget or backends loaded before the first paint')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
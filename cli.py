@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Watermarkr command line, stamps files without loading Qt.
+# usage: python -m watermarkr -n Vendor -t Comp shot_010.mov "plates/*.tif" D:/plates/shot_020 -o D:/delivery
+# The same command run again after a crash or Ctrl+C resumes, outputs up to date are skipped.
+
+import sys
+import os
+import glob
+import time
+import argparse
+import threading
+import logging
+
+import engine
+import manifest
+import intake
+import daemon
+import jobs
+import farm
+import progress
+import recovery
+import validate
+
+logger = logging.getLogger(__name__)
+
+LOG_RATE = 1.0  # progress lines a second at most, every file is logged at debug level
+
+
+def log_snapshot(snapshot):
+    logger.info(progress.format_snapshot(snapshot))
+
+
+def read_manifest(manifest_path):
+    # one path per line, empty lines and lines starting with # are ignored
+    paths = []
+    with open(manifest_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                paths.append(line)
+    return paths
+
+
+def collect_inputs(inputs, manifest=None):
+    # expand globs (cmd.exe doesn't), drop duplicates and keep the order
+    # folders are walked with numbered frames collapsed into sequences, rel_dirs keep their structure
+    patterns = list(inputs)
+    if manifest:
+        patterns += read_manifest(manifest)
+
+    input_paths = []
+    rel_dirs = []
+    unsupported_files = []
+    existing_paths = set()
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        for path in matches:
+            path = path.replace('\\', '/')
+            if os.path.isdir(path):
+                entries = intake.scan([path], engine.SUPPORT_FORMAT)
+            elif not os.path.isfile(path) or not engine.is_supported(path):
+                unsupported_files.append(path)
+                continue
+            else:
+                entries = [(path, '')]
+            for entry, rel_dir in entries:
+                if entry not in existing_paths:
+                    existing_paths.add(entry)
+                    input_paths.append(entry)
+                    rel_dirs.append(rel_dir)
+    return input_paths, rel_dirs, unsupported_files
+
+
+def stamp_with_daemon(client, args, input_paths, rel_dirs, opacity):
+    # the daemon runs somewhere else, paths are sent absolute
+    start_time = time.time()
+    stream = progress.ProgressStream(log_snapshot, rate=LOG_RATE)
+
+    def log_event(data):
+        if data['event'] == jobs.FILE_DONE:
+            logger.debug(data.get('output'))
+        stream.update(data['job'], **data)
+
+    data = client.stamp(callback_func=log_event,
+                        inputs=[os.path.abspath(path).replace('\\', '/') for path in input_paths],
+                        rel_dirs=rel_dirs,
+                        name=args.name,
+                        task=args.task,
+                        output=os.path.abspath(args.output).replace('\\', '/'),
+                        overlay=os.path.abspath(args.overlay),
+                        opacity=opacity,
+                        resize=args.resize,
+                        blend=args.blend,
+                        tile_threshold=int(args.tile_threshold * 1000000),
+                        flatten_pdf=args.flatten_pdf,
+                        force=args.force,
+                        dedup=args.dedup,
+                        order=args.order,
+                        encoding=args.encoding,
+                        report=not args.no_report,
+                        pipelined={'auto': None, 'on': True, 'off': False}[args.pipeline])
+    if data is not None and data['event'] == jobs.FINISHED:
+        stream.update(data['job'], **data)
+    stream.close()
+    if data is None or data['event'] == 'error':
+        logger.error('Daemon failed: {}'.format(data and data.get('message')))
+        return 1
+    for path, error in data['errors']:
+        logger.error('Failed to stamp {}: {}'.format(path, error))
+    logger.info('Finished in {} sec (daemon)'.format(time.time() - start_time))
+    return 1 if data['errors'] else 0
+
+
+def stamp_on_farm(args, input_paths, output_paths, overlay_text, opacity, output_name_dir):
+    # this machine coordinates, the farm nodes (or local stand-ins with --farm-local) stamp
+    start_time = time.time()
+    finished = threading.Event()
+    stream = progress.ProgressStream(log_snapshot, rate=LOG_RATE)
+
+    def log_event(job, event):
+        if event == jobs.FILE_DONE:
+            logger.debug(job.last_file[1])
+        stream.job_event(job, event)
+        if event == jobs.FINISHED:
+            finished.set()
+
+    processes = farm.start_local_workers(args.farm, args.farm_local, workers=args.workers) if args.farm_local else []
+    job_queue = jobs.JobQueue(callback_func=log_event)
+    try:
+        job = job_queue.submit(jobs.Job(name='{} - {}'.format(args.name, args.task),
+                                        input_paths=input_paths,
+                                        output_paths=output_paths,
+                                        text=overlay_text,
+                                        overlay_path=args.overlay,
+                                        opacity=opacity,
+                                        resize=args.resize,
+                                        blend_mode=args.blend,
+                                        tile_threshold=int(args.tile_threshold * 1000000),
+                                        flatten_pdf=args.flatten_pdf,
+                                        job_manifest=manifest.JobManifest(output_name_dir),
+                                        force=args.force,
+                                        report_dir=None if args.no_report else output_name_dir,
+                                        dedup=args.dedup,
+                                        order=args.order,
+                                        farm_dir=args.farm,
+                                        profile=args.encoding))
+        while not finished.wait(1.0):
+            pass
+    finally:
+        job_queue.shutdown()
+        stream.close()
+        farm.stop_local_workers(processes)
+    for path, error in job.errors:
+        logger.error('Failed to stamp {}: {}'.format(path, error))
+    logger.info('Finished in {} sec (farm)'.format(time.time() - start_time))
+    return 1 if job.errors or job.state != jobs.DONE else 0
+
+
+def resume_main(argv=None):
+    # jobs of the UI or the daemon left unfinished, stamped here until done
+    parser = argparse.ArgumentParser(prog='watermarkr resume', description='Resume Watermarkr jobs left unfinished by a crash or a cancel.')
+    parser.add_argument('--list', action='store_true', help='only list the unfinished jobs')
+    parser.add_argument('--discard', action='store_true', help='forget the unfinished jobs, their outputs are left as they are')
+    parser.add_argument('-w', '--workers', type=int, help='number of files stamped at once (default: {})'.format(engine.DEFAULT_WORKERS))
+    parser.add_argument('--video-workers', type=int, help='number of videos stamped at once (default: {})'.format(engine.DEFAULT_VIDEO_WORKERS))
+    parser.add_argument('--memory', type=float, metavar='MB', help='memory budget of the files stamped at once (default: half of the physical memory)')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    recovery.cleanup_temp()
+
+    checkpoints = recovery.list_checkpoints()
+    if not checkpoints:
+        logger.info('No unfinished jobs')
+        return 0
+    for path, checkpoint in checkpoints:
+        logger.info('{} ({} entries) -> {}'.format(checkpoint['name'], len(checkpoint['inputs']), checkpoint['manifest_dir']))
+        if args.discard:
+            recovery.remove_checkpoint(path)
+    if args.list or args.discard:
+        return 0
+
+    start_time = time.time()
+    stream = progress.ProgressStream(log_snapshot, rate=LOG_RATE)
+    finished = set()
+
+    def log_event(job, event):
+        if event == jobs.FILE_DONE:
+            logger.debug(job.last_file[1])
+        stream.job_event(job, event)
+        if event == jobs.FINISHED:
+            finished.add(job.id)
+
+    memory_budget = int(args.memory * 1024 ** 2) if args.memory else None
+    job_queue = jobs.JobQueue(workers=args.workers, video_workers=args.video_workers, callback_func=log_event, memory_budget=memory_budget)
+    resumed = []
+    try:
+        for path, checkpoint in checkpoints:
+            job = jobs.resume_job(path, checkpoint)
+            if job is not None:
+                resumed.append(job_queue.submit(job))
+        while len(finished) < len(resumed):
+            time.sleep(1.0)
+    finally:
+        job_queue.shutdown()
+        stream.close()
+    for job in resumed:
+        for path, error in job.errors:
+            logger.error('Failed to stamp {}: {}'.format(path, error))
+    logger.info('Resumed {} jobs in {} sec'.format(len(resumed), time.time() - start_time))
+    return 1 if any(job.errors or job.state != jobs.DONE for job in resumed) else 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='watermarkr', description='Stamp watermark on media files.')
+    parser.add_argument('inputs', nargs='*', help='files, folders or glob patterns to stamp')
+    parser.add_argument('-m', '--manifest', help='text file listing input paths, one per line')
+    parser.add_argument('-n', '--name', required=True, help='name of the receiver')
+    parser.add_argument('-t', '--task', required=True, help='task of the receiver')
+    parser.add_argument('-o', '--output', default=os.path.expanduser('~/Desktop'), help='output directory (default: Desktop)')
+    parser.add_argument('--overlay', default=engine.WATERMARK_PATH, help='overlay image')
+    opacity_group = parser.add_mutually_exclusive_group()
+    opacity_group.add_argument('--opacity', type=float, help='fixed opacity, 0.0 - 1.0')
+    opacity_group.add_argument('--auto', nargs=2, type=float, metavar=('MIN', 'MAX'), default=engine.OPACITY_RANGE,
+                            help='auto opacity range (default: {} {})'.format(*engine.OPACITY_RANGE))
+    parser.add_argument('--resize', type=int, help='limit media size to this many pixels')
+    parser.add_argument('--blend', choices=engine.BLEND_MODES, default=engine.DEFAULT_BLEND_MODE, help='overlay blend mode for stills (default: normal)')
+    parser.add_argument('--tile-threshold', type=float, default=engine.tiled.TILE_PIXEL_THRESHOLD / 1000000.0,
+                        help='tiff larger than this many megapixels are stamped in bands (default: {:g})'.format(engine.tiled.TILE_PIXEL_THRESHOLD / 1000000.0))
+    parser.add_argument('--flatten-pdf', action='store_true', help='rasterize pdf pages with the overlay burnt in')
+    parser.add_argument('--encoding', choices=engine.PROFILES, default=engine.DEFAULT_PROFILE,
+                        help='output encoding, fast for review proxies, archive for the smallest files (default: {})'.format(engine.DEFAULT_PROFILE))
+    parser.add_argument('-f', '--force', action='store_true', help='stamp everything again, even outputs that are up to date')
+    parser.add_argument('--dedup', action='store_true', help='stamp identical input files once, link the other outputs to it')
+    parser.add_argument('--order', choices=engine.cost.ORDERS, default=engine.cost.DEFAULT_ORDER,
+                        help='files sent to the workers longest first (shortest total time), shortest first (early results) or as listed (default: {})'.format(engine.cost.DEFAULT_ORDER))
+    parser.add_argument('-w', '--workers', type=int, help='number of files stamped at once (default: {})'.format(engine.DEFAULT_WORKERS))
+    parser.add_argument('--video-workers', type=int, help='number of videos stamped at once (default: {})'.format(engine.DEFAULT_VIDEO_WORKERS))
+    parser.add_argument('--memory', type=float, metavar='MB', help='memory budget of the files stamped at once (default: half of the physical memory)')
+    parser.add_argument('--pipeline', choices=('auto', 'on', 'off'), default='auto',
+                        help='read-ahead / write-behind through local scratch (default: auto, on for network paths)')
+    parser.add_argument('--daemon', action='store_true', help='send the job to a running daemon (python -m watermarkr serve), stamp here if none is running')
+    parser.add_argument('--port', type=int, help='port of the daemon')
+    parser.add_argument('--farm', metavar='DIR', help='split the job into units stamped by the farm nodes watching this shared folder')
+    parser.add_argument('--farm-local', type=int, default=0, metavar='N', help='start N farm workers on this machine for the job, to test without nodes')
+    parser.add_argument('--no-report', action='store_true', help='don\'t write the timing report next to the outputs')
+    parser.add_argument('--profile', metavar='PROF', help='stamp only the first file under cProfile, write the stats to this file')
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    recovery.cleanup_temp()
+
+    if args.opacity is not None:
+        opacity = args.opacity
+    else:
+        opacity = tuple(args.auto)
+
+    input_paths, rel_dirs, unsupported_files = collect_inputs(args.inputs, manifest=args.manifest)
+    for path in unsupported_files:
+        logger.warning('Skipped, unsupported or missing: {}'.format(path))
+    errors = validate.check_inputs(args.name, args.task, input_paths, args.overlay)
+    if errors:
+        parser.error(', '.join(errors))
+    if args.farm_local and not args.farm:
+        parser.error('--farm-local needs a farm folder, --farm DIR')
+
+    overlay_text = engine.get_overlay_text(args.name, args.task)
+    output_name_dir = engine.get_output_name_dir(args.output.replace('\\', '/'), args.name)
+    if not os.path.exists(output_name_dir):
+        os.makedirs(output_name_dir)
+    output_paths = engine.get_output_paths(input_paths, output_name_dir, rel_dirs=rel_dirs)
+
+    if args.daemon:
+        client = daemon.Client(port=args.port or daemon.DEFAULT_PORT)
+        if client.ping():
+            return stamp_with_daemon(client, args, input_paths, rel_dirs, opacity)
+        logger.warning('No daemon running, stamping here')
+
+    if args.farm:
+        return stamp_on_farm(args, input_paths, output_paths, overlay_text, opacity, output_name_dir)
+
+    if args.profile:
+        input_path, output_path = next(engine.iter_files(input_paths, output_paths))
+        output_dir = os.path.dirname(output_path)
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        engine.profile_media(args.profile,
+                            input_path=input_path,
+                            output_path=output_path,
+                            text=overlay_text,
+                            overlay_path=args.overlay,
+                            opacity=opacity,
+                            resize=args.resize,
+                            blend_mode=args.blend,
+                            tile_threshold=int(args.tile_threshold * 1000000),
+                            flatten_pdf=args.flatten_pdf,
+                            profile=args.encoding)
+        return 0
+
+    start_time = time.time()
+    num_files = engine.count_files(input_paths)
+    pipelined = {'auto': None, 'on': True, 'off': False}[args.pipeline]
+    memory_budget = int(args.memory * 1024 ** 2) if args.memory else None
+    stamp_engine = engine.StampEngine(workers=args.workers, video_workers=args.video_workers, pipelined=pipelined, memory_budget=memory_budget)
+    stream = progress.ProgressStream(log_snapshot, rate=LOG_RATE)
+    done_cost = 0.0
+    for num_done, (i, result) in enumerate(stamp_engine.imap(input_paths=input_paths,
+                                                            output_paths=output_paths,
+                                                            text=overlay_text,
+                                                            overlay_path=args.overlay,
+                                                            opacity=opacity,
+                                                            resize=args.resize,
+                                                            blend_mode=args.blend,
+                                                            tile_threshold=int(args.tile_threshold * 1000000),
+                                                            flatten_pdf=args.flatten_pdf,
+                                                            job_manifest=manifest.JobManifest(output_name_dir),
+                                                            force=args.force,
+                                                            dedup=args.dedup,
+                                                            order=args.order,
+                                                            profile=args.encoding,
+                                                            callback_func=lambda sub: stream.update(0, sub=sub)), 1):
+        done_cost += stamp_engine.costs.get(i, 0.0)
+        logger.debug(stamp_engine.files[i][1])
+        stream.update(0, done=num_done, total=num_files, done_cost=done_cost, total_cost=stamp_engine.total_cost,
+                      last_file=stamp_engine.files[i], state=jobs.RUNNING)
+    stream.update(0, state=jobs.DONE)
+    stream.close()
+
+    stamp_engine.report.log(logger)
+    if not args.no_report:
+        if stamp_engine.report.records:
+            json_path, csv_path = stamp_engine.report.write(output_name_dir)
+            logger.info('Report written to {}'.format(json_path))
+        else:
+            # everything was up to date, the report of the run that stamped them is kept
+            logger.info('Nothing stamped, report not written')
+    logger.info('Finished in {} sec'.format(time.time() - start_time))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# NumPy compositing for stills, luminance analysis and blend modes as whole-array operations.
+# Only the bounding box of the overlay is touched, the rest of the image is left as is.
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from defaults import BLEND_MODES, DEFAULT_BLEND_MODE
+
+LUMA_WEIGHTS = (0.2126, 0.7152, 0.0722)  # rec.709
+LUMINANCE_STEP = 8  # auto opacity looks at every Nth pixel in both directions
+BAND_ROWS = 32  # rows blended at a time
+
+
+def is_available():
+    return np is not None
+
+
+def mean_luminance(array):
+    # mean luminance (0.0 - 1.0) of a HxW or HxWxC uint8 array
+    sample = array[::LUMINANCE_STEP, ::LUMINANCE_STEP]
+    if sample.ndim == 2:
+        return float(sample.mean()) / 255.0
+    rgb = sample[..., :3].astype(np.float32)
+    return float(np.dot(rgb, np.array(LUMA_WEIGHTS, dtype=np.float32)).mean()) / 255.0
+
+
+def div255(array):
+    # rounded array / 255 for uint16 products of two uint8 values, in place
+    array += 128
+    array += array >> 8
+    array >>= 8
+    return array
+
+
+def multiply255(a, b):
+    # uint8 * uint8 / 255 as uint16
+    result = a.astype(np.uint16)
+    result *= b
+    return div255(result)
+
+
+def blend(base, over, mode):
+    # base and over are uint8 arrays, returns the blended colour as uint16 in 0 - 255
+    if mode == 'multiply':
+        return multiply255(base, over)
+    if mode == 'screen':
+        result = multiply255(255 - base, 255 - over)
+        return np.subtract(255, result, out=result)
+    if mode == 'overlay':
+        # multiply the darks, screen the lights, both doubled.
+        # 255 - x is x ^ 255 for 0 - 255 so the light half is flipped with xor instead of a branch
+        flip = base >> 7
+        flip *= 255
+        result = multiply255(base ^ flip, over ^ flip)
+        result <<= 1
+        result ^= flip
+        return result
+    return over.astype(np.uint16)
+
+
+def split_layer(layer):
+    # RGBA overlay layer (PIL) -> (bbox, rgb, alpha) cropped to where the layer isn't transparent
+    bbox = layer.getbbox()
+    if not bbox:
+        return None, None, None
+    array = np.asarray(layer.crop(bbox))
+    return bbox, np.ascontiguousarray(array[..., :3]), np.ascontiguousarray(array[..., 3:])
+
+
+def composite(array, bbox, over_rgb, over_alpha, mode=DEFAULT_BLEND_MODE):
+    # blend overlay into HxWx3/4 uint8 array in place, integer math only
+    # result = (base * (255 - alpha) + blend * alpha) / 255
+    if bbox is None:
+        return array
+    left, top, right, bottom = bbox
+    # work in bands of rows so the temporary arrays stay in cache
+    for start in range(0, bottom - top, BAND_ROWS):
+        end = min(start + BAND_ROWS, bottom - top)
+        region = array[top + start:top + end, left:right, :3]
+        alpha = over_alpha[start:end]
+
+        result = blend(region, over_rgb[start:end], mode)
+        result *= alpha
+        base = region.astype(np.uint16)
+        base *= 255 - alpha
+        result += base
+        region[...] = div255(result)
+    return array
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Cost model, a rough stamping time and peak memory of each file from what can be probed cheaply:
+# image header for stills, ffprobe for videos, page count for pdf, file size otherwise.
+# Cost units are megapixels of still jpeg stamping, only the ratio between files matters.
+# Used to order the tasks of a job on the workers, to weight progress and to keep the memory
+# of the files stamped at once under a budget.
+
+import os
+import heapq
+import logging
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+import overlay
+import intake
+import tiled
+import video
+import pdf
+from defaults import ORDERS, DEFAULT_ORDER
+
+logger = logging.getLogger(__name__)
+
+FILE_COST = 0.5  # open, write and close of any file
+STILL_WEIGHTS = {'.jpg': 1.0, '.png': 2.0, '.tif': 1.2, '.tiff': 1.2}  # per megapixel, png compresses slowly
+VIDEO_FRAME_WEIGHT = 0.3  # per megapixel of every frame, decode + encode
+PDF_PAGE_COST = 0.2  # pdf pages share one overlay image
+PDF_FLATTEN_PAGE_COST = 4.0  # rasterized pages
+SIZE_WEIGHT = 0.5  # per MB, when nothing else can be probed
+PROBE_THREADS = 8  # files probed at once, probing is mostly waiting on the disk
+
+MEMORY_BUDGET_RATIO = 0.5  # default budget, part of the physical memory, the rest is left to other apps
+DEFAULT_MEMORY_BUDGET = 4 * 1024 ** 3  # when the physical memory can't be read
+FILE_MEMORY = 16 * 1024 ** 2  # buffers and metadata of any file
+RGBA_COPIES = 3  # rgba frames alive while compositing: converted input, overlay layer, result
+VIDEO_BUFFER_FRAMES = 60  # frames held by one ffmpeg, decoder + x264 lookahead
+FALLBACK_MEMORY_RATIO = 10  # memory per byte of file for formats that can't be probed
+PROBE_CACHE_SIZE = 20000  # probed files kept, a few long jobs worth of headers
+SEQUENCE_CACHE_SIZE = 1000  # sequences whose frames reuse one probe
+SEQUENCE_SIZE_RATIO = 1.5  # a frame reuses the sequence probe only within this file size ratio
+
+
+# Least recently used cache shared by the probe threads of every job
+class ProbeCache(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self.items.pop(key, None)
+            if value is not None:
+                self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self.items.pop(key, None)
+            while len(self.items) >= self.maxsize:
+                self.items.popitem(last=False)
+            self.items[key] = value
+
+    def clear(self):
+        with self._lock:
+            self.items.clear()
+
+
+_probes = ProbeCache(PROBE_CACHE_SIZE)  # (path, size, mtime) -> info
+_sequence_infos = ProbeCache(SEQUENCE_CACHE_SIZE)  # (dir, prefix, ext) -> (file size, still info)
+
+
+def get_bits(mode):
+    # bits per channel of a PIL mode
+    if mode.startswith('I;16'):
+        return 16
+    if mode in ('I', 'F'):
+        return 32
+    return 8
+
+
+def is_same_frame_size(size, other_size):
+    # frames of one resolution stay close in file size, a 2K and a 16K plate don't
+    small, large = sorted((size, other_size))
+    return large <= small * SEQUENCE_SIZE_RATIO
+
+
+def probe_still(path, size):
+    # frames of a sequence share the probe of a frame of about the same file size
+    directory, filename = os.path.split(path)
+    parts = intake.split_frame(filename)
+    key = (directory, parts[0], parts[2]) if parts else None
+    cached = _sequence_infos.get(key) if key is not None else None
+    if cached is not None and is_same_frame_size(size, cached[0]):
+        return cached[1]
+    with overlay.Image.open(path) as image:
+        info = {'kind': 'still',
+                'width': image.size[0],
+                'height': image.size[1],
+                'channels': len(image.getbands()),
+                'bits': get_bits(image.mode)}
+    if key is not None:
+        _sequence_infos.put(key, (size, info))
+    return info
+
+
+def probe_pdf(path):
+    # page count and the size of the first page in points
+    doc = pdf.fitz.open(path)
+    try:
+        rect = doc[0].rect if len(doc) else None
+        return {'kind': 'pdf',
+                'pages': len(doc),
+                'width': rect.width if rect else 0,
+                'height': rect.height if rect else 0}
+    finally:
+        doc.close()
+
+
+def probe(path):
+    # header info of a file, {'kind': 'still' | 'video' | 'pdf' | 'other', 'size', 'ext', ...}
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime)
+    info = _probes.get(key)
+    if info is not None:
+        return info
+    ext = os.path.splitext(path)[-1].lower()
+    try:
+        if ext in STILL_WEIGHTS and overlay.is_available():
+            info = probe_still(path, stat.st_size)
+        elif video.is_video(path):
+            info = dict(video.probe(path), kind='video')
+        elif pdf.can_stamp(path):
+            info = probe_pdf(path)
+        else:
+            info = {'kind': 'other'}
+    except Exception as e:
+        logger.debug('Failed to probe {}: {}'.format(path, e))
+        info = {'kind': 'other'}
+    info = dict(info, size=stat.st_size, ext=ext)
+    _probes.put(key, info)
+    return info
+
+
+def estimate(path, flatten_pdf=False):
+    # cost of stamping a file, falls back to its size when it can't be probed
+    try:
+        info = probe(path)
+    except OSError:
+        return FILE_COST
+    if info['kind'] == 'still':
+        return FILE_COST + info['width'] * info['height'] / 1000000.0 * STILL_WEIGHTS[info['ext']]
+    if info['kind'] == 'video':
+        return FILE_COST + info['frames'] * info['width'] * info['height'] / 1000000.0 * VIDEO_FRAME_WEIGHT
+    if info['kind'] == 'pdf':
+        return FILE_COST + info['pages'] * (PDF_FLATTEN_PAGE_COST if flatten_pdf else PDF_PAGE_COST)
+    return FILE_COST + info['size'] / 1048576.0 * SIZE_WEIGHT
+
+
+def estimate_memory(path, resize=None, flatten_pdf=False, low_memory=False):
+    # peak bytes a worker needs to stamp a file, with low_memory on its low memory path
+    try:
+        info = probe(path)
+    except OSError:
+        return FILE_MEMORY
+    if info['kind'] == 'still':
+        width, height = info['width'], info['height']
+        if low_memory and tiled.can_stamp(path, resize=resize, tile_threshold=0):
+            # bands of the whole width, the rest of the tiff stays on disk
+            return FILE_MEMORY + width * tiled.TILE_BAND_ROWS * (info['channels'] + 4 * RGBA_COPIES)
+        decoded = width * height * info['channels'] * info['bits'] // 8
+        out_width, out_height = overlay.get_limited_size((width, height), resize)
+        return FILE_MEMORY + decoded + out_width * out_height * 4 * RGBA_COPIES
+    if info['kind'] == 'video':
+        width, height = video.get_output_size(info['width'], info['height'], resize=resize)
+        num_segments = 1 if low_memory else max(1, min(video.SEGMENT_WORKERS, int(info['duration'] // video.MIN_SEGMENT_DURATION)))
+        frames = (info['width'] * info['height'] + width * height) * 3 // 2  # yuv420 in and out
+        return FILE_MEMORY + width * height * 4 + num_segments * frames * VIDEO_BUFFER_FRAMES
+    if info['kind'] == 'pdf':
+        dpi = pdf.FLATTEN_DPI if flatten_pdf else pdf.OVERLAY_DPI
+        page = int(info['width'] * dpi / 72.0) * int(info['height'] * dpi / 72.0)
+        return FILE_MEMORY + info['size'] * 2 + page * (3 + 4 * RGBA_COPIES if flatten_pdf else 4)
+    return FILE_MEMORY + info['size'] * FALLBACK_MEMORY_RATIO
+
+
+def get_memory_budget(limit=None):
+    # bytes the files stamped at once may use together, limit overrides the default
+    if limit:
+        return limit
+    env_limit = os.environ.get('WATERMARKR_MEMORY_BUDGET')  # MB
+    if env_limit:
+        return int(float(env_limit) * 1024 ** 2)
+    if psutil is not None:
+        return int(psutil.virtual_memory().total * MEMORY_BUDGET_RATIO)
+    return DEFAULT_MEMORY_BUDGET
+
+
+def estimate_entry(entry, flatten_pdf=False):
+    # whole cost of a dropped entry, every frame of a sequence
+    return sum(estimate(path, flatten_pdf=flatten_pdf) for path in intake.iter_paths(entry))
+
+
+def _map_tasks(func, tasks, threads=PROBE_THREADS):
+    # {index: func(task)} of engine tasks, probed side by side
+    def get_value(task):
+        return task[0], func(task)
+
+    if len(tasks) <= 1:
+        return dict(get_value(task) for task in tasks)
+    pool = ThreadPool(min(threads, len(tasks)))
+    try:
+        return dict(pool.map(get_value, tasks, chunksize=16))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def estimate_tasks(tasks, threads=PROBE_THREADS):
+    # {index: cost} of engine tasks
+    def get_cost(task):
+        return estimate(task[1]['input_path'], flatten_pdf=task[1].get('flatten_pdf', False))
+    return _map_tasks(get_cost, tasks, threads=threads)
+
+
+def fit_memory(tasks, budget, threads=PROBE_THREADS):
+    # {index: peak bytes} of engine tasks. A task that needs more than the whole budget
+    # is switched to its low memory path (tiff in bands, one ffmpeg per video),
+    # if that still doesn't fit it will run when nothing else does.
+    def get_memory(task):
+        kwargs = task[1]
+        memory = estimate_memory(kwargs['input_path'], resize=kwargs.get('resize'), flatten_pdf=kwargs.get('flatten_pdf', False))
+        if memory > budget:
+            logger.info('{} needs about {:.0f} MB, over the memory budget, stamped on its low memory path'.format(kwargs['input_path'], memory / 1048576.0))
+            kwargs['low_memory'] = True
+            memory = estimate_memory(kwargs['input_path'], resize=kwargs.get('resize'), flatten_pdf=kwargs.get('flatten_pdf', False), low_memory=True)
+        return memory
+    return _map_tasks(get_memory, tasks, threads=threads)
+
+
+def plan(tasks, costs, workers, video_workers=None, order=DEFAULT_ORDER):
+    # order tasks for a pool of workers that takes them in turn.
+    # Simulates the pool, each free worker gets the longest (or shortest) task it can start right away,
+    # a video only goes to a worker when a video slot is free, so workers don't sit waiting on the video lock.
+    if order == 'input' or len(tasks) <= 1:
+        return list(tasks)
+    longest = order == 'longest'
+    pending = sorted(tasks, key=lambda task: (-costs[task[0]] if longest else costs[task[0]], task[0]))
+    video_workers = max(1, min(video_workers or workers, workers))
+    worker_times = [0.0] * max(1, workers)
+    video_times = [0.0] * video_workers
+    planned = []
+    while pending:
+        now = heapq.heappop(worker_times)
+        pick = None
+        for n, task in enumerate(pending):
+            if not video.is_video(task[1]['input_path']) or video_times[0] <= now:
+                pick = n
+                break
+        if pick is None:
+            pick = 0  # only videos left, the worker waits for a slot
+        task = pending.pop(pick)
+        end = now + costs[task[0]]
+        if video.is_video(task[1]['input_path']):
+            start = max(now, heapq.heappop(video_times))
+            end = start + costs[task[0]]
+            heapq.heappush(video_times, end)
+        heapq.heappush(worker_times, end)
+        planned.append(task)
+    return planned
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Watermarkr daemon, a local stamping service that keeps the worker pool warm between requests.
+# Requests and events are json, one per line, over a localhost TCP socket.
+# Every request carries the token the daemon writes at start to ~/.watermarkr/daemon_{port}.token,
+# a file only its user can read (mode 600, the profile folder on Windows), other users are refused.
+# Stamp requests are checked like the inputs of the UI and the CLI before anything is written.
+# usage: python -m watermarkr serve --port 47215
+#
+# {"cmd": "stamp", "token": "...", "inputs": [...], "name": "Vendor", "task": "Comp", "output": "D:/delivery"}
+#   -> {"event": "started", ...} {"event": "file", ...} {"event": "progress", ...} ... {"event": "finished", ...}
+#   events are progress snapshots coalesced to PUBLISH_RATE a second, "event" is the latest one they cover
+# {"cmd": "ping"} / {"cmd": "status"} / {"cmd": "cancel", "job": 3} / {"cmd": "shutdown"}
+
+import os
+import sys
+import hmac
+import json
+import socket
+import logging
+import binascii
+import argparse
+import threading
+
+try:
+    import SocketServer as socketserver
+    import Queue as queue
+except ImportError:
+    import socketserver
+    import queue
+
+import engine
+import jobs
+import progress
+import recovery
+import validate
+
+logger = logging.getLogger(__name__)
+
+HOST = '127.0.0.1'  # local requests only
+DEFAULT_PORT = int(os.environ.get('WATERMARKR_PORT', 47215))
+CONNECT_TIMEOUT = 0.5  # sec, a daemon that doesn't answer this fast is treated as not running
+EVENT_TIMEOUT = 1.0  # sec, how often a request handler checks its client is still there
+TOKEN_DIR = os.path.join(os.path.expanduser('~'), '.watermarkr')
+TOKEN_BYTES = 32
+
+
+def get_token_path(port):
+    return os.path.join(TOKEN_DIR, 'daemon_{}.token'.format(port))
+
+
+def write_token(port):
+    # new random token, readable by this user only, written before the daemon takes requests
+    token = binascii.hexlify(os.urandom(TOKEN_BYTES)).decode('ascii')
+    if not os.path.isdir(TOKEN_DIR):
+        os.makedirs(TOKEN_DIR, 0o700)
+    path = get_token_path(port)
+    if os.path.exists(path):
+        os.remove(path)  # the mode is only set when the file is created
+    with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as f:
+        f.write(token)
+    return token
+
+
+def read_token(port):
+    # None if no daemon of this user wrote one
+    try:
+        with open(get_token_path(port), 'r') as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def remove_token(port, token):
+    # only the token of this daemon, another one may have taken the port since
+    if read_token(port) == token:
+        try:
+            os.remove(get_token_path(port))
+        except OSError:
+            pass
+
+
+def get_event(job, snapshot):
+    # progress snapshot of a job, with the errors themselves once it is finished
+    data = dict(snapshot)
+    if data['last_file']:
+        data['input'], data['output'] = data['last_file']
+    if data['event'] == jobs.FINISHED:
+        data['errors'] = job.errors
+        data['linked'] = job.report.num_linked
+    return data
+
+
+class StampHandler(socketserver.StreamRequestHandler):
+    def send(self, data):
+        self.wfile.write((json.dumps(data) + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+    def handle(self):
+        for line in iter(self.rfile.readline, b''):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line.decode('utf-8'))
+                if not self.is_authorized(request):
+                    logger.warning('Refused a request without the daemon token from {}'.format(self.client_address))
+                    self.send({'event': 'error', 'message': 'Not authorized, wrong or missing daemon token'})
+                    return
+                cmd = request.get('cmd')
+                if cmd == 'stamp':
+                    self.stamp(request)
+                elif cmd == 'ping':
+                    self.send({'event': 'pong', 'pid': os.getpid(), 'workers': self.server.job_queue.workers})
+                elif cmd == 'status':
+                    self.send({'event': 'status', 'jobs': [get_event(job, progress.get_job_fields(job, jobs.PROGRESS)) for job in self.server.job_queue.get_active_jobs()]})
+                elif cmd == 'cancel':
+                    self.server.job_queue.cancel(request.get('job'))
+                    self.send({'event': 'cancelled', 'job': request.get('job')})
+                elif cmd == 'shutdown':
+                    self.send({'event': 'shutdown'})
+                    threading.Thread(target=self.server.shutdown).start()
+                    return
+                else:
+                    self.send({'event': 'error', 'message': 'Unknown command: {}'.format(cmd)})
+            except socket.error:
+                return
+            except Exception as e:
+                logger.exception('Request failed')
+                self.send({'event': 'error', 'message': str(e)})
+
+    def is_authorized(self, request):
+        token = request.get('token') if isinstance(request, dict) else None
+        if not isinstance(token, type(self.server.token)):
+            return False
+        return hmac.compare_digest(token.encode('utf-8'), self.server.token.encode('ascii'))
+
+    def stamp(self, request):
+        # events of the job are streamed back until it finishes, the job goes on if the client leaves
+        name = request.get('name')
+        task = request.get('task')
+        input_paths = request.get('inputs') or []
+        rel_dirs = request.get('rel_dirs')
+        output_dir = request.get('output') or os.path.expanduser('~/Desktop')
+        overlay_path = request.get('overlay') or engine.WATERMARK_PATH
+        errors = validate.check_inputs(name, task, input_paths, overlay_path)
+        errors += validate.check_paths(input_paths, rel_dirs=rel_dirs, output_dir=output_dir)
+        if errors:
+            self.send({'event': 'error', 'message': ', '.join(errors)})
+            return
+        opacity = request.get('opacity', engine.OPACITY_RANGE)
+        job = jobs.make_job(name=name,
+                            task=task,
+                            input_paths=input_paths,
+                            output_dir=output_dir,
+                            overlay_path=overlay_path,
+                            opacity=tuple(opacity) if isinstance(opacity, list) else opacity,
+                            resize=request.get('resize'),
+                            rel_dirs=rel_dirs,
+                            blend_mode=request.get('blend') or engine.DEFAULT_BLEND_MODE,
+                            tile_threshold=request.get('tile_threshold') or engine.tiled.TILE_PIXEL_THRESHOLD,
+                            flatten_pdf=request.get('flatten_pdf', False),
+                            force=request.get('force', False),
+                            report=request.get('report', True),
+                            pipelined=request.get('pipelined'),
+                            dedup=request.get('dedup', False),
+                            order=request.get('order') or engine.cost.DEFAULT_ORDER,
+                            farm_dir=request.get('farm'),
+                            profile=request.get('encoding') or engine.DEFAULT_PROFILE)
+        events = queue.Queue()
+        self.server.listeners[job.id] = events
+        self.server.job_queue.submit(job)
+        try:
+            while True:
+                try:
+                    data = events.get(timeout=EVENT_TIMEOUT)
+                except queue.Empty:
+                    continue
+                self.send(data)
+                if data['event'] == jobs.FINISHED:
+                    return
+        finally:
+            self.server.listeners.pop(job.id, None)
+
+
+class StampServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, workers=None, video_workers=None, memory_budget=None):
+        socketserver.ThreadingTCPServer.__init__(self, address, StampHandler)
+        self.port = self.server_address[1]
+        self.token = write_token(self.port)
+        self.listeners = {}  # job id -> event queue of the connection waiting for it
+        self.progress_stream = progress.ProgressStream(self.publish)
+        self.job_queue = jobs.JobQueue(workers=workers, video_workers=video_workers, callback_func=self.progress_stream.job_event, memory_budget=memory_budget)
+        self.job_queue.start(warm=True)
+
+    def publish(self, snapshot):
+        job = self.job_queue.jobs.get(snapshot['job'])
+        events = self.listeners.get(snapshot['job'])
+        if job is not None and events is not None:
+            events.put(get_event(job, snapshot))
+
+    def server_close(self):
+        socketserver.ThreadingTCPServer.server_close(self)
+        remove_token(self.port, self.token)
+        self.job_queue.shutdown()
+        self.progress_stream.close()
+
+
+# Client of a running daemon, for the CLI and other pipeline tools of the same user.
+class Client(object):
+    def __init__(self, port=DEFAULT_PORT, host=HOST):
+        self.address = (host, port)
+
+    def request(self, request):
+        # yields the events answering the request, a stamp answers until its job is finished
+        request = dict(request, token=read_token(self.address[1]))
+        sock = socket.create_connection(self.address, timeout=CONNECT_TIMEOUT)
+        sock.settimeout(None)
+        try:
+            f = sock.makefile('rb')
+            sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+            for line in iter(f.readline, b''):
+                data = json.loads(line.decode('utf-8'))
+                yield data
+                if request.get('cmd') != 'stamp' or data['event'] in (jobs.FINISHED, 'error'):
+                    return
+        finally:
+            sock.close()
+
+    def ping(self):
+        # reply of the daemon, None if no daemon of this user is running
+        try:
+            data = next(self.request({'cmd': 'ping'}))
+        except (socket.error, StopIteration, ValueError):
+            return None
+        if data.get('event') != 'pong':
+            logger.warning('Daemon refused the request: {}'.format(data.get('message')))
+            return None
+        return data
+
+    def stamp(self, callback_func=None, **request):
+        # returns the finished event, callback_func gets every event before that
+        request['cmd'] = 'stamp'
+        data = None
+        for data in self.request(request):
+            if callback_func and data['event'] not in (jobs.FINISHED, 'error'):
+                callback_func(data)
+        return data
+
+    def cancel(self, job_id):
+        return next(self.request({'cmd': 'cancel', 'job': job_id}))
+
+    def shutdown(self):
+        return next(self.request({'cmd': 'shutdown'}))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='watermarkr serve', description='Run the local Watermarkr stamping daemon.')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='localhost port (default: {})'.format(DEFAULT_PORT))
+    parser.add_argument('-w', '--workers', type=int, help='number of files stamped at once (default: {})'.format(engine.DEFAULT_WORKERS))
+    parser.add_argument('--video-workers', type=int, help='number of videos stamped at once (default: {})'.format(engine.DEFAULT_VIDEO_WORKERS))
+    parser.add_argument('--memory', type=float, metavar='MB', help='memory budget of the files stamped at once (default: half of the physical memory)')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    recovery.cleanup_temp()
+
+    memory_budget = int(args.memory * 1024 ** 2) if args.memory else None
+    server = StampServer((HOST, args.port), workers=args.workers, video_workers=args.video_workers, memory_budget=memory_budget)
+    logger.info('Watermarkr daemon listening on {}:{}'.format(HOST, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Stamp defaults and supported formats.
+# Kept free of imaging, video and pdf imports so the UI can read them before the stamping backends are loaded.
+
+import os
+
+SUPPORT_FORMAT = ('.jpg', '.tif', '.tiff', '.png', '.pdf', '.mov', '.mp4')
+NON_RESIZEABLE_FORMAT = ('.pdf', )
+VIDEO_FORMAT = ('.mov', '.mp4')
+
+WATERMARK_PATH = '{}/core/rf_template/default/watermark/watermark_2K_internal.png'.format(os.environ.get('RFSCRIPT'))
+OPACITY_RANGE = (0.075, 0.15)  # range for auto opacity
+
+BLEND_MODES = ('normal', 'multiply', 'screen', 'overlay')
+DEFAULT_BLEND_MODE = 'normal'
+
+ORDERS = ('longest', 'shortest', 'input')  # longest first for the shortest total time, shortest first for early results
+DEFAULT_ORDER = 'longest'
+
+# output encoding, each format maps a profile to its encoder settings (overlay, pdf and video modules).
+# fast for review proxies looked at once, balanced is what was always written, archive for the smallest files
+PROFILES = ('fast', 'balanced', 'archive')
+DEFAULT_PROFILE = 'balanced'
+
+FARM_DIR = os.environ.get('WATERMARKR_FARM_DIR')  # shared queue folder of the farm nodes, farm mode is off without it
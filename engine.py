@@ -0,0 +1,569 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Stamping engine, runs resize + watermark of each media on a pool of worker processes.
+# Kept free of any Qt import so it can be used outside of the Watermarkr UI.
+
+import sys
+import os
+import shutil
+import logging
+import multiprocessing
+from datetime import datetime
+from collections import OrderedDict
+
+core = '%s/core' % os.environ.get('RFSCRIPT')
+if core not in sys.path:
+    sys.path.append(core)
+
+from rf_utils.pipeline import watermark
+from rf_utils.pipeline import convert_lib
+
+import overlay
+import manifest
+import intake
+import report
+import pipeline
+import cost
+import tiled
+import video
+import pdf
+import recovery
+from defaults import SUPPORT_FORMAT, NON_RESIZEABLE_FORMAT, VIDEO_FORMAT, WATERMARK_PATH, OPACITY_RANGE, BLEND_MODES, DEFAULT_BLEND_MODE, PROFILES, DEFAULT_PROFILE
+
+logger = logging.getLogger(__name__)
+
+CPU_COUNT = multiprocessing.cpu_count()
+DEFAULT_WORKERS = CPU_COUNT  # number of files stamped at the same time
+DEFAULT_VIDEO_WORKERS = max(1, CPU_COUNT // 4)  # ffmpeg is multi-threaded itself, keep video jobs low
+POLL_INTERVAL = 0.1  # sec, how often the parent checks for sub progress while waiting for results
+CANCEL_SLOTS = 64  # cancelled job ids a pool holds at once, the oldest slot is reused
+CANCELLED = 'cancelled'  # error of a task stopped by the cancel of its job, in place of a traceback
+
+# worker process globals, set by _init_worker
+_video_lock = None
+_progress_queue = None
+_cancelled_jobs = None
+
+
+# Raised from the progress callback of a stamp once its job is cancelled, the stamp stops
+# at its next frame / page / band and its ffmpeg, page renderers and partial output go with it.
+class StampCancelled(Exception):
+    pass
+
+
+def get_overlay_text(name, task, date=None):
+    date = date or datetime.today()
+    return 'For {} - {} - {}'.format(name, task, datetime.strftime(date, '%y/%m/%d'))
+
+
+def get_output_name_dir(output_dir, name, date=None):
+    date = date or datetime.today()
+    folder_name = '{}_{}'.format(name, datetime.strftime(date, '%y%m%d'))
+    return '{}/{}'.format(output_dir, folder_name)
+
+
+def get_output_paths(input_paths, output_name_dir, rel_dirs=None):
+    # entries from a dropped folder keep their folder structure under output_name_dir,
+    # a sequence entry maps to its output pattern path, e.g. output_name_dir/plates/shot_####.jpg
+    output_paths = []
+    for i, path in enumerate(input_paths):
+        baseName = os.path.basename(intake.split_entry(path)[0])
+        rel_dir = rel_dirs[i] if rel_dirs else ''
+        if rel_dir:
+            output_path = '{}/{}/{}'.format(output_name_dir, rel_dir, baseName)
+        else:
+            output_path = '{}/{}'.format(output_name_dir, baseName)
+        output_paths.append(output_path)
+    return output_paths
+
+
+def iter_files(input_paths, output_paths):
+    # (input, output) of every file, sequence entries are expanded frame by frame
+    for input_path, output_path in zip(input_paths, output_paths):
+        if not intake.is_sequence(input_path):
+            yield input_path, output_path
+            continue
+        output_dir = os.path.dirname(output_path)
+        for frame_path in intake.iter_paths(input_path):
+            yield frame_path, '{}/{}'.format(output_dir, os.path.basename(frame_path))
+
+
+def count_files(input_paths):
+    return sum(intake.count(path) for path in input_paths)
+
+
+def is_supported(path):
+    return intake.get_extension(path) in SUPPORT_FORMAT
+
+
+def is_video(path):
+    return os.path.splitext(path)[-1].lower() in VIDEO_FORMAT
+
+
+def stamp_media(input_path, output_path, text, overlay_path, opacity, resize, blend_mode=DEFAULT_BLEND_MODE, tile_threshold=tiled.TILE_PIXEL_THRESHOLD, flatten_pdf=False, low_memory=False, profile=DEFAULT_PROFILE, callback_func=None):
+    # written to a partial file next to the output then renamed over it, a stamp that fails,
+    # is cancelled or dies leaves the previous output as it was
+    partial_path = recovery.get_partial_path(output_path)
+    try:
+        result = _stamp_media(input_path, partial_path, text, overlay_path, opacity, resize, blend_mode=blend_mode, tile_threshold=tile_threshold,
+                              flatten_pdf=flatten_pdf, low_memory=low_memory, profile=profile, callback_func=callback_func)
+        if os.path.exists(partial_path):
+            recovery.replace(partial_path, output_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    return output_path if result == partial_path else result
+
+
+def _stamp_media(input_path, output_path, text, overlay_path, opacity, resize, blend_mode=DEFAULT_BLEND_MODE, tile_threshold=tiled.TILE_PIXEL_THRESHOLD, flatten_pdf=False, low_memory=False, profile=DEFAULT_PROFILE, callback_func=None):
+    # resize (optional) then stamp watermark on a single media, returns the result of watermark.
+    # low_memory streams what can be streamed, any tiff that can be is stamped in bands, videos use one ffmpeg.
+    # profile picks the encoder settings, tiffs stamped in bands keep the layout of their input
+    # and the rf watermark fallback writes with its own settings
+    if os.path.splitext(input_path)[-1].lower() in NON_RESIZEABLE_FORMAT:
+        resize = None
+    if low_memory:
+        tile_threshold = 0
+
+    # single pass, resize and overlay without writing a resized temp media
+    if tiled.can_stamp(input_path, resize=resize, tile_threshold=tile_threshold):
+        # very large tiff, stamp in bands to bound memory
+        return tiled.stamp_tiled(input_path=input_path,
+                                output_path=output_path,
+                                overlay_path=overlay_path,
+                                text=text,
+                                opacity=opacity,
+                                blend_mode=blend_mode,
+                                callback_func=callback_func)
+    elif overlay.can_stamp(input_path):
+        # stills use the prepared overlay cached in this process
+        result = overlay.stamp_image(input_path=input_path,
+                                    output_path=output_path,
+                                    overlay_path=overlay_path,
+                                    text=text,
+                                    opacity=opacity,
+                                    resize=resize,
+                                    blend_mode=blend_mode,
+                                    profile=profile,
+                                    callback_func=callback_func)
+        if result is not None:
+            return result
+    elif pdf.can_stamp(input_path):
+        # overlay shared by every page
+        return pdf.stamp_pdf(input_path=input_path,
+                            output_path=output_path,
+                            overlay_path=overlay_path,
+                            text=text,
+                            opacity=opacity,
+                            flatten=flatten_pdf,
+                            profile=profile,
+                            callback_func=callback_func)
+    elif video.can_stamp(input_path):
+        return video.stamp_video(input_path=input_path,
+                                output_path=output_path,
+                                overlay_path=overlay_path,
+                                text=text,
+                                opacity=opacity,
+                                resize=resize,
+                                segment_workers=1 if low_memory else None,
+                                profile=profile,
+                                callback_func=callback_func)
+
+    # fallback, resize to temp then stamp with rf watermark.
+    # the temp is in a folder of this process, removed on the next start if the process dies
+    temp_dir = None
+    temp_file = None
+    if resize is not None:
+        # do the resize
+        temp_dir = recovery.mkdtemp('resize')
+        with report.stage('resize'):
+            resize_result = convert_lib.limit_media_size(input_path, limit_size=resize, output_path=os.path.join(temp_dir, os.path.basename(input_path)))
+        if resize_result:
+            input_path = resize_result
+            temp_file = resize_result
+            logger.debug('Resized to temp: {}'.format(input_path))
+    try:
+        # rf watermark reads, composites and writes in one call
+        with report.stage('composite'):
+            result = watermark.add_watermark_with_text(input_path=input_path,
+                                                    overlay_path=overlay_path,
+                                                    text=text,
+                                                    output_path=output_path,
+                                                    opacity=opacity,
+                                                    callback_func=callback_func)
+    finally:
+        if temp_file and os.path.exists(temp_file):
+            os.remove(temp_file)
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    return result
+
+
+def get_link_count(path):
+    try:
+        return os.stat(path).st_nlink
+    except OSError:
+        return 0
+
+
+def build_tasks(input_paths, output_paths, stamp_kwargs, job_manifest=None, force=False):
+    # expand entries to files and make output folders, files up to date in the job manifest are skipped.
+    # returns files [(input, output)], tasks [(index, stamp_media kwargs)], skipped [index], manifest params
+    params = None
+    if job_manifest is not None:
+        extra_params = {}
+        if stamp_kwargs.get('profile', DEFAULT_PROFILE) != DEFAULT_PROFILE:
+            # the default writes what was written before profiles, outputs stamped then stay up to date
+            extra_params['profile'] = stamp_kwargs['profile']
+        params = manifest.get_params(stamp_kwargs['text'], stamp_kwargs['overlay_path'], stamp_kwargs['opacity'], stamp_kwargs['resize'],
+                                    blend_mode=stamp_kwargs['blend_mode'], flatten_pdf=stamp_kwargs['flatten_pdf'], **extra_params)
+    files = []
+    tasks = []
+    skipped = []
+    output_dirs = set()
+    for i, (input_path, output_path) in enumerate(iter_files(input_paths, output_paths)):
+        files.append((input_path, output_path))
+        output_dir = os.path.dirname(output_path)
+        if output_dir not in output_dirs:
+            output_dirs.add(output_dir)
+            if not os.path.exists(output_dir):
+                os.makedirs(output_dir)
+            else:
+                recovery.remove_partials(output_dir)
+        if params is not None and not force and job_manifest.is_up_to_date(input_path, output_path, params):
+            skipped.append(i)
+            continue
+        if get_link_count(output_path) > 1:
+            # linked by dedup, writing over it would change the other outputs too
+            os.remove(output_path)
+        kwargs = dict(stamp_kwargs)
+        kwargs['input_path'] = input_path
+        kwargs['output_path'] = output_path
+        if params is not None:
+            kwargs['hash_input'] = True  # the worker hashes the input for the manifest while it has it at hand
+        tasks.append((i, kwargs))
+    return files, tasks, skipped, params
+
+
+def get_content_key(kwargs):
+    # inputs with the same key give the same output, the quick hash only picks candidates
+    input_path = kwargs['input_path']
+    return (os.path.splitext(input_path)[-1].lower(),
+            os.path.splitext(kwargs['output_path'])[-1].lower(),
+            os.path.getsize(input_path),
+            manifest.quick_hash(input_path))
+
+
+def dedup_tasks(tasks):
+    # byte-identical inputs of a job are stamped once, the first of them in task order.
+    # returns tasks left to stamp and {stamped index: [indexes whose output is linked from it]}
+    candidates = OrderedDict()
+    for task in tasks:
+        try:
+            key = get_content_key(task[1])
+        except (IOError, OSError):
+            key = task[0]  # unreadable input, left to fail on its own
+        candidates.setdefault(key, []).append(task)
+
+    unique = []
+    duplicates = {}
+    for group in candidates.values():
+        if len(group) == 1:
+            unique.append(group[0])
+            continue
+        # quick hash only reads the ends of a file, the full content decides
+        groups = OrderedDict()
+        for task in group:
+            groups.setdefault(manifest.file_hash(task[1]['input_path']), []).append(task)
+        for same in groups.values():
+            unique.append(same[0])
+            if len(same) > 1:
+                duplicates[same[0][0]] = [i for i, kwargs in same[1:]]
+    unique.sort(key=lambda task: task[0])
+    return unique, duplicates
+
+
+def link_output(source_path, output_path):
+    # hard link to the stamped output when the file system allows it, copy otherwise
+    if os.path.abspath(source_path) == os.path.abspath(output_path):
+        return output_path
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    link = getattr(os, 'link', None)  # not on Windows with python 2
+    if link is not None:
+        try:
+            link(source_path, output_path)
+            return output_path
+        except OSError:
+            pass
+    shutil.copyfile(source_path, output_path)
+    return output_path
+
+
+def make_cancel_slots():
+    # shared with the workers of a pool, job ids written here cancel their files being stamped
+    return multiprocessing.Array('l', CANCEL_SLOTS)
+
+
+def is_cancelled(index):
+    # tasks of a job queue are indexed (job id, file index)
+    if _cancelled_jobs is None or not isinstance(index, tuple):
+        return False
+    return index[0] in _cancelled_jobs[:]
+
+
+def _init_worker(video_lock, progress_queue, cancelled_jobs=None):
+    global _video_lock, _progress_queue, _cancelled_jobs
+    _video_lock = video_lock
+    _progress_queue = progress_queue
+    _cancelled_jobs = cancelled_jobs
+
+
+def track_media(hash_input=False, **kwargs):
+    # stamp_media with a report record of the file, returns (result, record dict).
+    # with hash_input the record has the full content hash of the input, read before it is stamped
+    with report.track(kwargs['input_path'], kwargs['output_path']) as record:
+        if hash_input:
+            with report.stage('read'):
+                record.input_hash = manifest.file_hash(kwargs['input_path'])
+        result = stamp_media(**kwargs)
+    return result, record.to_dict()
+
+
+def pop_input_hash(record):
+    # the hash goes to the manifest, not to the report
+    return record.pop('input_hash', None) if record is not None else None
+
+
+def profile_media(profile_path, **kwargs):
+    # stamp one media in this process under cProfile, stats dumped to profile_path
+    return report.profile(stamp_media, profile_path, **kwargs)
+
+
+def _stamp_task(args):
+    index, kwargs = args
+
+    def send_progress(callback_result, *args, **kw):
+        # stamps call it every frame, page or band, the cancel is checked here
+        if is_cancelled(index):
+            raise StampCancelled()
+        if _progress_queue is not None:
+            _progress_queue.put((index, callback_result))
+
+    kwargs['callback_func'] = send_progress if _progress_queue is not None or _cancelled_jobs is not None else None
+    if _video_lock is not None and is_video(kwargs['input_path']):
+        with _video_lock:
+            if is_cancelled(index):
+                raise StampCancelled()
+            return (index, ) + track_media(**kwargs)
+    if is_cancelled(index):
+        raise StampCancelled()
+    return (index, ) + track_media(**kwargs)
+
+
+# Stamp a list of media, N files at once.
+# Results are yielded as (index, result) in order of completion, index refers to self.files,
+# the (input, output) of every file once sequences are expanded.
+# Files are sent to the workers in the given order of cost, self.costs has the estimated cost of each one stamped.
+# memory_budget: bytes the files stamped at once may use together, None for cost.get_memory_budget()
+# pipelined: read-ahead / write-behind through local scratch, None turns it on when inputs or outputs are on a share
+class StampEngine(object):
+    def __init__(self, workers=None, video_workers=None, pipelined=None, memory_budget=None):
+        self.workers = max(1, workers or DEFAULT_WORKERS)
+        self.video_workers = max(1, min(video_workers or DEFAULT_VIDEO_WORKERS, self.workers))
+        self.pipelined = pipelined
+        self.memory_budget = cost.get_memory_budget(memory_budget)
+        self._stop = False
+        self.files = []
+        self.num_skipped = 0
+        self.costs = {}  # index -> estimated cost, files skipped or linked cost nothing
+        self.total_cost = 0.0
+        self.memory = {}  # index -> estimated peak bytes
+        self.num_memory_waits = 0
+        self.input_hashes = {}  # index -> content hash of the stamped input, for the manifest
+        self.report = report.JobReport()
+
+    def stop(self):
+        self._stop = True
+
+    def imap(self, input_paths, output_paths, text, overlay_path, opacity, resize, blend_mode=DEFAULT_BLEND_MODE, tile_threshold=tiled.TILE_PIXEL_THRESHOLD, flatten_pdf=False, callback_func=None, job_manifest=None, force=False, dedup=False, order=cost.DEFAULT_ORDER, profile=DEFAULT_PROFILE):
+        # with a job manifest, outputs already up to date are yielded right away without stamping,
+        # with dedup, identical inputs are stamped once and their other outputs linked to it
+        self._stop = False
+        self.num_skipped = 0
+        self.input_hashes = {}
+        self.report = report.JobReport()
+        stamp_kwargs = {'text': text,
+                        'overlay_path': overlay_path,
+                        'opacity': opacity,
+                        'resize': resize,
+                        'blend_mode': blend_mode,
+                        'tile_threshold': tile_threshold,
+                        'flatten_pdf': flatten_pdf,
+                        'profile': profile}
+        self.files, tasks, skipped, params = build_tasks(input_paths, output_paths, stamp_kwargs, job_manifest=job_manifest, force=force)
+        self.num_skipped = len(skipped)
+        self.report.num_skipped = len(skipped)
+        if skipped:
+            logger.info('{} files up to date, skipped'.format(len(skipped)))
+        duplicates = {}
+        if dedup and len(tasks) > 1:
+            tasks, duplicates = dedup_tasks(tasks)
+            if duplicates:
+                logger.info('{} identical files, stamped once'.format(sum(len(v) for v in duplicates.values())))
+        self.costs = cost.estimate_tasks(tasks)
+        self.total_cost = sum(self.costs.values())
+        self.memory = cost.fit_memory(tasks, self.memory_budget)
+        self.num_memory_waits = 0
+        tasks = cost.plan(tasks, self.costs, self.workers, self.video_workers, order=order)
+
+        io_pipeline = None
+        if tasks and self.is_pipelined(tasks):
+            io_pipeline = pipeline.IOPipeline()
+            logger.debug('Pipelined I/O through {}'.format(io_pipeline.scratch_dir))
+
+        num_workers = min(self.workers, len(tasks))
+        if num_workers <= 1:
+            results = self._imap_serial(tasks, callback_func, io_pipeline)
+        else:
+            results = self._imap_pool(tasks, num_workers, callback_func, io_pipeline)
+        if io_pipeline is not None:
+            results = self._imap_io(results, io_pipeline)
+        if duplicates:
+            results = self._imap_dedup(results, duplicates)
+        if job_manifest is not None:
+            results = self._imap_manifest(results, skipped, job_manifest, params)
+        return self._imap_report(results)
+
+    def is_pipelined(self, tasks):
+        if self.pipelined is not None:
+            return self.pipelined
+        index, kwargs = tasks[0]
+        return pipeline.is_remote(kwargs['input_path']) or pipeline.is_remote(kwargs['output_path'])
+
+    def _imap_io(self, results, io_pipeline):
+        # results are yielded once their output is moved to its destination
+        try:
+            for i, result in results:
+                io_pipeline.write(i, result)
+                for i, result, error in io_pipeline.iter_written():
+                    if error is not None:
+                        raise error
+                    yield i, result
+            for i, result, error in io_pipeline.iter_written(wait=True):
+                if error is not None:
+                    raise error
+                yield i, result
+        finally:
+            io_pipeline.close()
+
+    def _add_record(self, index, record):
+        # with pipelined I/O the worker saw scratch paths
+        self.input_hashes[index] = pop_input_hash(record)
+        record['input'], record['output'] = self.files[index]
+        self.report.add(record)
+
+    def _imap_dedup(self, results, duplicates):
+        # duplicates are yielded right after the output they are linked to
+        for i, result in results:
+            yield i, result
+            source_path = self.files[i][1]
+            for j in duplicates.get(i, ()):
+                self.input_hashes[j] = self.input_hashes.get(i)
+                output_path = link_output(source_path, self.files[j][1])
+                self.report.add_duplicate(self.files[j], source_path)
+                yield j, output_path
+
+    def _imap_report(self, results):
+        try:
+            for i, result in results:
+                yield i, result
+        finally:
+            self.report.finish()
+
+    def _imap_manifest(self, results, skipped, job_manifest, params):
+        try:
+            for i in skipped:
+                yield i, self.files[i][1]
+            for i, result in results:
+                input_path, output_path = self.files[i]
+                if os.path.exists(output_path):
+                    job_manifest.update(input_path, output_path, params, content_hash=self.input_hashes.pop(i, None))
+                    job_manifest.save(force=False)
+                yield i, result
+        finally:
+            job_manifest.save()
+
+    def _imap_serial(self, tasks, callback_func, io_pipeline=None):
+        for i, kwargs in (io_pipeline.prefetch(tasks) if io_pipeline else tasks):
+            if self._stop:
+                break
+            result, record = track_media(callback_func=callback_func, **kwargs)
+            self._add_record(i, record)
+            yield i, result
+
+    def _imap_pool(self, tasks, num_workers, callback_func, io_pipeline=None):
+        video_lock = multiprocessing.Semaphore(self.video_workers)
+        progress_queue = multiprocessing.Queue() if callback_func else None
+        pool = multiprocessing.Pool(processes=num_workers,
+                                    initializer=_init_worker,
+                                    initargs=(video_lock, progress_queue))
+        pending = set(i for i, kwargs in tasks)
+        file_progress = OrderedDict()  # index -> latest callback result, in the order the files started
+        memory_budget = pipeline.ByteBudget(self.memory_budget)
+        try:
+            admitted = self._admit(io_pipeline.prefetch(tasks) if io_pipeline else tasks, memory_budget)
+            iterator = pool.imap_unordered(_stamp_task, admitted, chunksize=1)
+            while pending and not self._stop:
+                try:
+                    index, result, record = iterator.next(POLL_INTERVAL)
+                except multiprocessing.TimeoutError:
+                    self._forward_progress(progress_queue, pending, file_progress, callback_func)
+                    continue
+                self._add_record(index, record)
+                memory_budget.release(self.memory.get(index, 0))
+                pending.discard(index)
+                self._forward_progress(progress_queue, pending, file_progress, callback_func)
+                yield index, result
+        finally:
+            memory_budget.close()
+            if pending:
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+
+    def _admit(self, tasks, memory_budget):
+        # tasks go to the pool only while the memory of the files being stamped fits the budget,
+        # runs on the task thread of the pool
+        for index, kwargs in tasks:
+            memory = self.memory.get(index, 0)
+            if memory_budget.used and memory_budget.used + memory > memory_budget.limit:
+                self.num_memory_waits += 1
+                logger.info('Waiting for memory, {:.0f} of {:.0f} MB in use, next file needs {:.0f} MB'.format(
+                    memory_budget.used / 1048576.0, memory_budget.limit / 1048576.0, memory / 1048576.0))
+            if not memory_budget.acquire(memory):
+                return
+            yield index, kwargs
+
+    def _forward_progress(self, progress_queue, pending, file_progress, callback_func):
+        # sub progress follows the file that started first among the ones still stamping,
+        # when it is done the next one takes over from its latest progress
+        if progress_queue is None:
+            return
+        current = next(iter(file_progress), None)
+        updated = set()
+        while not progress_queue.empty():
+            try:
+                index, callback_result = progress_queue.get_nowait()
+            except Exception:
+                break
+            if index in pending:
+                file_progress[index] = callback_result
+                updated.add(index)
+        for index in [index for index in file_progress if index not in pending]:
+            del file_progress[index]
+        followed = next(iter(file_progress), None)
+        if followed is not None and (followed in updated or followed != current):
+            callback_func(file_progress[followed])
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Farm mode, a job split into work units on a shared folder that farm nodes stamp in turn.
+# The coordinator (the machine that got the job) writes the units, every node runs a farm worker
+# that claims units by moving them, stamps them on its own pool and writes the results back.
+# Only renames are relied on, no locks, so the queue works on any share every node can write.
+# usage: python -m watermarkr farm-worker --farm //server/watermarkr_farm
+#
+# {farm}/{job id}/job.json               stamp settings of the job, the overlay is copied next to it
+# {farm}/{job id}/todo/unit_00001.json   [[index, input, output], ...] waiting for a node
+# {farm}/{job id}/claimed/unit_00001.json   taken by a node, its mtime is the lease, renewed while it runs
+# {farm}/{job id}/done/unit_00001.json   {'node', 'files': [[index, output, error], ...], 'records': [...]}
+#
+# A unit whose lease isn't renewed for LEASE_TIMEOUT goes back to todo, another node stamps it again.
+# Lease age is measured on the coordinator's clock from the last mtime change it saw,
+# so the clocks of the nodes don't need to agree.
+
+import sys
+import os
+import json
+import time
+import shutil
+import signal
+import socket
+import logging
+import argparse
+import threading
+import subprocess
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import engine
+import jobs
+import recovery
+from defaults import FARM_DIR
+
+logger = logging.getLogger(__name__)
+
+LEASE_TIMEOUT = 60.0  # sec without a lease renewal before a unit is given to another node
+LEASE_INTERVAL = 10.0  # sec between lease renewals of a node
+FARM_POLL_INTERVAL = 1.0  # sec between scans of the queue folders, they may be on a slow share
+UNIT_COST = 50.0  # estimated cost of a unit (cost.py units), cheap files are packed together up to it
+MIN_UNITS = 16  # a small job still gets this many units (when it has the files), so every node gets some
+MAX_UNIT_FILES = 200  # files of a unit at most
+NODE_UNITS = 2  # units a node stamps at once, the next one keeps its pool busy while the last files finish
+JOB_FILE = 'job.json'
+UNIT_EXT = '.json'
+TODO = 'todo'
+CLAIMED = 'claimed'
+DONE = 'done'
+
+
+def get_node_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def write_json(path, data):
+    # written aside then renamed, a reader never sees half a file
+    temp_path = '{}.{}.tmp'.format(path, get_node_name().replace(':', '_'))
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+    try:
+        os.rename(temp_path, path)
+    except OSError:
+        # windows doesn't rename over an existing file
+        if not os.path.exists(path):
+            raise
+        os.remove(path)
+        os.rename(temp_path, path)
+
+
+def read_json(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def is_unit(filename):
+    return filename.startswith('unit_') and filename.endswith(UNIT_EXT)
+
+
+def list_units(directory):
+    try:
+        return sorted(filename for filename in os.listdir(directory) if is_unit(filename))
+    except OSError:
+        return []
+
+
+def make_units(tasks, costs, unit_cost=UNIT_COST, max_files=MAX_UNIT_FILES):
+    # consecutive tasks packed into units of about unit_cost, a file costlier than that is a unit of its own.
+    # tasks are kept in their (planned) order so the costly units are claimed first
+    unit_cost = min(unit_cost, sum(costs.get(task[0], 0.0) for task in tasks) / MIN_UNITS)
+    units = []
+    unit = []
+    unit_total = 0.0
+    for task in tasks:
+        task_cost = costs.get(task[0], 0.0)
+        if unit and (unit_total + task_cost > unit_cost or len(unit) >= max_files):
+            units.append(unit)
+            unit = []
+            unit_total = 0.0
+        unit.append(task)
+        unit_total += task_cost
+    if unit:
+        units.append(unit)
+    return units
+
+
+# One job on the farm queue. Writes the units, then poll() collects the results nodes wrote back
+# and gives units with an expired lease to the next node. Used from the JobQueue scheduler thread.
+class Coordinator(object):
+    def __init__(self, farm_dir, name, tasks, costs, stamp_kwargs, unit_cost=UNIT_COST):
+        self.job_dir = '{}/{}_{}_{}'.format(farm_dir.replace('\\', '/').rstrip('/'), time.strftime('%y%m%d_%H%M%S'),
+                                            socket.gethostname(), os.getpid())
+        suffix = 1
+        job_dir = self.job_dir
+        while os.path.exists(job_dir):
+            suffix += 1
+            job_dir = '{}_{}'.format(self.job_dir, suffix)
+        self.job_dir = job_dir
+        self.pending = set()  # unit names not done yet
+        self.unit_tasks = {}  # unit name -> indexes of its files
+        self.leases = {}  # claimed unit name -> (mtime seen, local time it was seen)
+        self.num_reclaimed = 0
+        self.num_dropped = 0  # files of units cancelled before a node took them
+        self.cancelled = False
+        self._last_poll = 0.0
+
+        for name_dir in (TODO, CLAIMED, DONE):
+            os.makedirs('{}/{}'.format(self.job_dir, name_dir))
+        # nodes read the overlay from the share, the coordinator's path may not exist there
+        stamp = dict(stamp_kwargs)
+        overlay_path = '{}/overlay{}'.format(self.job_dir, os.path.splitext(stamp['overlay_path'])[-1])
+        shutil.copyfile(stamp['overlay_path'], overlay_path)
+        stamp['overlay_path'] = overlay_path
+        write_json('{}/{}'.format(self.job_dir, JOB_FILE), {'name': name, 'coordinator': get_node_name(), 'stamp': stamp})
+
+        for n, unit in enumerate(make_units(tasks, costs, unit_cost=unit_cost), 1):
+            unit_name = 'unit_{:05d}{}'.format(n, UNIT_EXT)
+            write_json('{}/{}/{}'.format(self.job_dir, TODO, unit_name),
+                       [[i, kwargs['input_path'], kwargs['output_path']] for i, kwargs in unit])
+            self.pending.add(unit_name)
+            self.unit_tasks[unit_name] = [i for i, kwargs in unit]
+        logger.info('Job {} split into {} units on {}'.format(name, len(self.pending), self.job_dir))
+
+    def is_finished(self):
+        return not self.pending
+
+    def poll(self, force=False):
+        # [(index, record or None, error or None)] of the files of units done since the last poll
+        now = time.time()
+        if not force and now - self._last_poll < FARM_POLL_INTERVAL:
+            return []
+        self._last_poll = now
+        results = []
+        for unit_name in list_units('{}/{}'.format(self.job_dir, DONE)):
+            if unit_name not in self.pending:
+                continue
+            try:
+                data = read_json('{}/{}/{}'.format(self.job_dir, DONE, unit_name))
+            except (IOError, OSError, ValueError) as e:
+                logger.warning('Failed to read result of {}: {}'.format(unit_name, e))
+                continue
+            self.pending.discard(unit_name)
+            self.leases.pop(unit_name, None)
+            records = dict((record['output'], record) for record in data.get('records', []))
+            for i, output_path, error in data['files']:
+                results.append((i, records.get(output_path), error))
+            logger.debug('{} done by {}'.format(unit_name, data.get('node')))
+            # a reclaimed unit may still be waiting for a second node
+            for name_dir in (TODO, CLAIMED):
+                try:
+                    os.remove('{}/{}/{}'.format(self.job_dir, name_dir, unit_name))
+                except OSError:
+                    pass
+        self._check_leases(now)
+        return results
+
+    def _check_leases(self, now):
+        claimed = set(list_units('{}/{}'.format(self.job_dir, CLAIMED)))
+        for unit_name in list(self.leases):
+            if unit_name not in claimed:
+                del self.leases[unit_name]
+        for unit_name in claimed:
+            if unit_name not in self.pending:
+                continue
+            path = '{}/{}/{}'.format(self.job_dir, CLAIMED, unit_name)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            seen = self.leases.get(unit_name)
+            if seen is None or seen[0] != mtime:
+                self.leases[unit_name] = (mtime, now)
+                continue
+            if now - seen[1] < LEASE_TIMEOUT:
+                continue
+            del self.leases[unit_name]
+            if self.cancelled:
+                self._drop(unit_name)
+                continue
+            try:
+                os.rename(path, '{}/{}/{}'.format(self.job_dir, TODO, unit_name))
+            except OSError:
+                continue  # finished or renewed meanwhile
+            self.num_reclaimed += 1
+            logger.warning('Lease of {} expired, given back to the queue'.format(unit_name))
+
+    def _drop(self, unit_name):
+        self.pending.discard(unit_name)
+        self.num_dropped += len(self.unit_tasks[unit_name])
+
+    def cancel(self):
+        # units no node has taken are dropped, the ones being stamped finish
+        self.cancelled = True
+        for unit_name in list_units('{}/{}'.format(self.job_dir, TODO)):
+            try:
+                os.remove('{}/{}/{}'.format(self.job_dir, TODO, unit_name))
+            except OSError:
+                continue  # just claimed
+            self._drop(unit_name)
+
+    def close(self):
+        shutil.rmtree(self.job_dir, ignore_errors=True)
+
+
+# Farm node, claims units of any job on the farm folder and stamps them on a local JobQueue,
+# so the node keeps its own worker count, video slots and memory budget.
+class FarmWorker(object):
+    def __init__(self, farm_dir, workers=None, video_workers=None, memory_budget=None, max_units=NODE_UNITS):
+        self.farm_dir = farm_dir.replace('\\', '/').rstrip('/')
+        self.node = get_node_name()
+        self.max_units = max(1, max_units)
+        self.units = {}  # local job id -> (job dir, unit name, [[index, input, output]])
+        self.num_units = 0
+        self._finished = queue.Queue()
+        self._wake = threading.Event()
+        self._last_renew = 0.0
+        self._stop = False
+        self.job_queue = jobs.JobQueue(workers=workers, video_workers=video_workers, memory_budget=memory_budget,
+                                       callback_func=self._job_event)
+
+    def _job_event(self, job, event):
+        if event == jobs.FINISHED:
+            self._finished.put(job)
+            self._wake.set()
+
+    def stop(self):
+        self._stop = True
+        self._wake.set()
+
+    def run(self):
+        self.job_queue.start(warm=True)
+        logger.info('Farm node {} watching {}'.format(self.node, self.farm_dir))
+        try:
+            while not self._stop:
+                self._report_finished()
+                self._renew_leases()
+                if len(self.units) < self.max_units and self._claim():
+                    continue
+                self._wake.wait(FARM_POLL_INTERVAL)
+                self._wake.clear()
+        finally:
+            self.job_queue.shutdown()
+            # units left claimed are reclaimed by their coordinator once the lease expires
+        return self.num_units
+
+    def _claim(self):
+        # first unit of the oldest job, the rename fails if another node was faster
+        try:
+            job_names = sorted(os.listdir(self.farm_dir))
+        except OSError as e:
+            logger.warning('Failed to list {}: {}'.format(self.farm_dir, e))
+            return False
+        for job_name in job_names:
+            job_dir = '{}/{}'.format(self.farm_dir, job_name)
+            for unit_name in list_units('{}/{}'.format(job_dir, TODO)):
+                claimed_path = '{}/{}/{}'.format(job_dir, CLAIMED, unit_name)
+                try:
+                    os.rename('{}/{}/{}'.format(job_dir, TODO, unit_name), claimed_path)
+                except OSError:
+                    continue
+                try:
+                    os.utime(claimed_path, None)
+                    self._submit(job_dir, unit_name, read_json(claimed_path))
+                except Exception as e:
+                    logger.error('Failed to start {} of {}: {}'.format(unit_name, job_dir, e))
+                    continue
+                return True
+        return False
+
+    def _submit(self, job_dir, unit_name, files):
+        stamp = read_json('{}/{}'.format(job_dir, JOB_FILE))['stamp']
+        if isinstance(stamp['opacity'], list):
+            stamp['opacity'] = tuple(stamp['opacity'])
+        job = jobs.Job(name='{} {}'.format(os.path.basename(job_dir), unit_name),
+                       input_paths=[input_path for i, input_path, output_path in files],
+                       output_paths=[output_path for i, input_path, output_path in files],
+                       **stamp)
+        self.units[job.id] = (job_dir, unit_name, files)
+        self.job_queue.submit(job)
+        logger.info('{} of {} claimed, {} files'.format(unit_name, os.path.basename(job_dir), len(files)))
+
+    def _renew_leases(self):
+        now = time.time()
+        if now - self._last_renew < LEASE_INTERVAL:
+            return
+        self._last_renew = now
+        for job_dir, unit_name, files in self.units.values():
+            try:
+                os.utime('{}/{}/{}'.format(job_dir, CLAIMED, unit_name), None)
+            except OSError:
+                pass  # reclaimed or already done elsewhere, the result is still written
+
+    def _report_finished(self):
+        while True:
+            try:
+                job = self._finished.get_nowait()
+            except queue.Empty:
+                return
+            job_dir, unit_name, files = self.units.pop(job.id)
+            errors = dict(job.errors)
+            if job.state == jobs.FAILED:
+                failed = errors.get(None)
+                errors = dict((input_path, failed) for i, input_path, output_path in files)
+            data = {'node': self.node,
+                    'files': [[i, output_path, errors.get(input_path)] for i, input_path, output_path in files],
+                    'records': job.report.records}
+            try:
+                write_json('{}/{}/{}'.format(job_dir, DONE, unit_name), data)
+                os.remove('{}/{}/{}'.format(job_dir, CLAIMED, unit_name))
+            except (IOError, OSError) as e:
+                logger.warning('Failed to report {} of {}: {}'.format(unit_name, job_dir, e))
+            self.num_units += 1
+            logger.info('{} of {} done in {:.1f} sec, {} errors'.format(unit_name, os.path.basename(job_dir),
+                                                                       job.get_time_taken(), len(job.errors)))
+
+
+def start_local_workers(farm_dir, num_nodes, workers=None):
+    # farm worker processes on this machine standing in for nodes
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    cmd = [sys.executable, '-m', os.path.basename(module_dir), 'farm-worker', '--farm', farm_dir]
+    if workers:
+        cmd += ['--workers', str(workers)]
+    return [subprocess.Popen(cmd, cwd=os.path.dirname(module_dir)) for n in range(num_nodes)]
+
+
+def stop_local_workers(processes):
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+    for process in processes:
+        process.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='watermarkr farm-worker', description='Stamp work units of the Watermarkr farm queue.')
+    parser.add_argument('--farm', default=FARM_DIR, required=not FARM_DIR, help='shared farm queue folder (default: $WATERMARKR_FARM_DIR)')
+    parser.add_argument('-w', '--workers', type=int, help='number of files stamped at once (default: {})'.format(engine.DEFAULT_WORKERS))
+    parser.add_argument('--video-workers', type=int, help='number of videos stamped at once (default: {})'.format(engine.DEFAULT_VIDEO_WORKERS))
+    parser.add_argument('--memory', type=float, metavar='MB', help='memory budget of the files stamped at once (default: half of the physical memory)')
+    parser.add_argument('--units', type=int, default=NODE_UNITS, help='units stamped at once (default: {})'.format(NODE_UNITS))
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    recovery.cleanup_temp()
+
+    memory_budget = int(args.memory * 1024 ** 2) if args.memory else None
+    worker = FarmWorker(args.farm, workers=args.workers, video_workers=args.video_workers,
+                        memory_budget=memory_budget, max_units=args.units)
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Intake of dropped paths, folders are walked lazily and numbered frames collapsed into sequences.
+# A sequence is one entry string: '{dir}/{prefix}####{ext} [{frame ranges}]',
+# e.g. 'D:/plates/shot_####.jpg [1001-1050,1052-1100]', frames are only expanded when stamping.
+# A frame number follows a delimiter (shot_1001, shot.1001) or is the whole name, versions like
+# render_v001 / render_v002 stay separate files.
+# Frames of one width keep it as padding, unpadded frames (f_8 .. f_100) make one '#' sequence.
+
+import os
+import re
+
+SEQUENCE_PATTERN = re.compile(r'^(?P<prefix>(?:.*[._-])?)(?P<frame>\d+)(?P<ext>\.[^.]+)$')
+PADDING_PATTERN = re.compile(r'^(?P<head>.*?)(?P<padding>#+)(?P<tail>[^#]*)$')  # last run of # in a file name
+MIN_SEQUENCE_LENGTH = 2  # numbered files in a folder needed to make a sequence
+PADDING_CHAR = '#'
+
+
+def split_frame(filename):
+    # 'shot_1001.jpg' -> ('shot_', '1001', '.jpg'), None if there's no frame number
+    match = SEQUENCE_PATTERN.match(filename)
+    if not match:
+        return None
+    return match.group('prefix'), match.group('frame'), match.group('ext')
+
+
+def format_ranges(frames):
+    # [1, 2, 3, 5] -> '1-3,5'
+    ranges = []
+    start = end = None
+    for frame in sorted(frames):
+        if start is None:
+            start = end = frame
+        elif frame == end + 1:
+            end = frame
+        else:
+            ranges.append((start, end))
+            start = end = frame
+    if start is not None:
+        ranges.append((start, end))
+    return ','.join(str(s) if s == e else '{}-{}'.format(s, e) for s, e in ranges)
+
+
+def parse_ranges(text):
+    # '1-3,5' -> [(1, 3), (5, 5)]
+    ranges = []
+    for part in text.split(','):
+        if '-' in part[1:]:
+            start, end = part.rsplit('-', 1)
+            ranges.append((int(start), int(end)))
+        else:
+            ranges.append((int(part), int(part)))
+    return ranges
+
+
+def get_padding(numbers):
+    # one padding that writes every frame number back as it was, None if there's none
+    widths = set(len(number) for number in numbers)
+    if len(widths) == 1:
+        return widths.pop()
+    paddings = set(len(number) for number in numbers if len(number) > 1 and number.startswith('0')) or set([1])
+    if len(paddings) != 1:
+        return None
+    padding = paddings.pop()
+    if all(str(int(number)).zfill(padding) == number for number in numbers):
+        return padding
+    return None
+
+
+def group_frames(numbers):
+    # frame numbers of one prefix / ext -> {padding: [numbers]}, split by width if no padding fits them all
+    padding = get_padding(numbers)
+    if padding is not None:
+        return {padding: numbers}
+    groups = {}
+    for number in numbers:
+        groups.setdefault(len(number), []).append(number)
+    return groups
+
+
+def make_entry(directory, prefix, padding, ext, frames):
+    pattern = '{}{}{}'.format(prefix, PADDING_CHAR * padding, ext)
+    return '{}/{} [{}]'.format(directory, pattern, format_ranges(frames))
+
+
+def is_sequence(entry):
+    return entry.endswith(']') and ' [' in entry
+
+
+def split_entry(entry):
+    # sequence entry -> (pattern path, [(first, last)]), a file -> (path, None)
+    if not is_sequence(entry):
+        return entry, None
+    pattern_path, ranges = entry[:-1].rsplit(' [', 1)
+    return pattern_path, parse_ranges(ranges)
+
+
+def get_extension(entry):
+    return os.path.splitext(split_entry(entry)[0])[-1].lower()
+
+
+def count(entry):
+    pattern_path, ranges = split_entry(entry)
+    if ranges is None:
+        return 1
+    return sum(end - start + 1 for start, end in ranges)
+
+
+def iter_paths(entry):
+    # every file path of an entry, frames are generated one at a time
+    pattern_path, ranges = split_entry(entry)
+    if ranges is None:
+        yield entry
+        return
+    # only the file name is a pattern, folders may have # in their name
+    directory, filename = os.path.split(pattern_path)
+    match = PADDING_PATTERN.match(filename)
+    head = '{}/{}'.format(directory, match.group('head')) if directory else match.group('head')
+    padding = len(match.group('padding'))
+    tail = match.group('tail')
+    for start, end in ranges:
+        for frame in range(start, end + 1):
+            yield '{}{}{}'.format(head, str(frame).zfill(padding), tail)
+
+
+def scan_directory(root, formats):
+    # walk a folder lazily, one folder at a time, yields (entry, relative output dir)
+    root = root.replace('\\', '/').rstrip('/')
+    base = os.path.dirname(root)
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        dirpath = dirpath.replace('\\', '/')
+        rel_dir = os.path.relpath(dirpath, base).replace('\\', '/')
+        groups = {}
+        singles = []
+        for filename in sorted(filenames):
+            if os.path.splitext(filename)[-1].lower() not in formats:
+                continue
+            frame = split_frame(filename)
+            if frame is None:
+                singles.append(filename)
+                continue
+            prefix, number, ext = frame
+            groups.setdefault((prefix, ext), []).append(number)
+
+        for (prefix, ext), numbers in sorted(groups.items()):
+            for padding, frames in sorted(group_frames(numbers).items()):
+                if len(frames) < MIN_SEQUENCE_LENGTH:
+                    singles.extend('{}{}{}'.format(prefix, number, ext) for number in frames)
+                    continue
+                yield make_entry(dirpath, prefix, padding, ext, [int(number) for number in frames]), rel_dir
+        for filename in sorted(singles):
+            yield '{}/{}'.format(dirpath, filename), rel_dir
+
+
+def scan(paths, formats):
+    # dropped paths -> (entry, relative output dir), files dropped directly go to the top of the output
+    for path in paths:
+        if os.path.isdir(path):
+            for result in scan_directory(path, formats):
+                yield result
+        elif os.path.splitext(path)[-1].lower() in formats:
+            yield path, ''
+
+
+def get_size(entry):
+    return sum(os.path.getsize(path) for path in iter_paths(entry))
+
+
+def get_readable_size(num_bytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if num_bytes < 1024.0:
+            return '{:.1f} {}'.format(num_bytes, unit)
+        num_bytes /= 1024.0
+    return '{:.1f} TB'.format(num_bytes)
@@ -0,0 +1,660 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Job queue, every Stamp press is a job with its own receiver, task and stamp settings.
+# Jobs run at the same time on one shared pool of worker processes. A free worker always takes
+# the next file of the next job in turn, so a small job isn't stuck behind a big one.
+# A submitted job is prepared on its own thread (files listed, deduplicated, costed, planned),
+# the scheduler keeps the running jobs going meanwhile and takes the job once it is ready.
+# A file is only sent while the estimated memory of the files being stamped fits the memory budget.
+# Outputs are moved to a share by the write-behind of their job, the scheduler never waits for it,
+# a job whose write-behind is full sends no new files until it drains, the other jobs go on.
+# A farm job is split into units on the farm queue instead, farm nodes stamp it and the scheduler
+# collects their results like the ones of the pool.
+# A cancel reaches the files being stamped too, they stop at their next frame, page or band.
+# Every job with a manifest has a checkpoint until it is done, a job cancelled or left by a crash
+# is made again from it and resumes where it left off, the manifest skips what was already stamped.
+# Kept free of any Qt import, events are sent to callback_func from the scheduler thread.
+
+import os
+import time
+import logging
+import itertools
+import threading
+import traceback
+import multiprocessing
+from collections import OrderedDict
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import engine
+import cost
+import report
+import manifest
+import pipeline
+import farm
+import recovery
+
+logger = logging.getLogger(__name__)
+
+# job states
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+CANCELLED = 'cancelled'
+FAILED = 'failed'
+
+# events sent to callback_func(job, event)
+STARTED = 'started'
+FILE_DONE = 'file'
+PROGRESS = 'progress'
+FINISHED = 'finished'
+
+POLL_INTERVAL = engine.POLL_INTERVAL  # sec, how long the scheduler waits for results before checking again
+SHUTDOWN_WAIT = 3.0  # sec, files being stamped get to stop and clean up before the pool is terminated
+
+_job_ids = itertools.count(1)
+
+
+def _job_task(args):
+    # engine task that returns the error instead of raising it, one bad file doesn't stop its job
+    try:
+        return engine._stamp_task(args) + (None, )
+    except engine.StampCancelled:
+        return args[0], None, None, engine.CANCELLED
+    except Exception:
+        return args[0], None, None, traceback.format_exc()
+
+
+class Job(object):
+    def __init__(self, name, input_paths, output_paths, text, overlay_path, opacity, resize, blend_mode=engine.DEFAULT_BLEND_MODE, tile_threshold=engine.tiled.TILE_PIXEL_THRESHOLD, flatten_pdf=False, job_manifest=None, force=False, report_dir=None, pipelined=None, dedup=False, order=cost.DEFAULT_ORDER, farm_dir=None, profile=engine.DEFAULT_PROFILE):
+        self.id = next(_job_ids)
+        self.name = name
+        self.input_paths = input_paths
+        self.output_paths = output_paths
+        self.stamp_kwargs = {'text': text,
+                            'overlay_path': overlay_path,
+                            'opacity': opacity,
+                            'resize': resize,
+                            'blend_mode': blend_mode,
+                            'tile_threshold': tile_threshold,
+                            'flatten_pdf': flatten_pdf,
+                            'profile': profile}
+        self.job_manifest = job_manifest
+        self.force = force
+        self.report_dir = report_dir
+        self.pipelined = pipelined
+        self.dedup = dedup
+        self.order = order
+        self.farm_dir = farm_dir  # stamped by the farm nodes watching this queue folder
+
+        self.state = QUEUED
+        self.num_files = engine.count_files(input_paths)
+        self.num_done = 0
+        self.num_skipped = 0
+        self.num_cancelled = 0  # files stopped while being stamped
+        self.errors = []  # (input path, traceback)
+        self.sub_progress = None  # callback result of the file in progress that started first
+        self.file_progress = OrderedDict()  # index -> latest callback result, in the order the files started
+        self.last_file = None  # (input, output) of the latest file done
+        self.costs = {}  # index -> estimated cost of the files to stamp
+        self.total_cost = 0.0
+        self.done_cost = 0.0
+        self.memory = {}  # index -> estimated peak bytes of the files to stamp
+        self.waiting_memory = False  # next file waits for memory to be freed
+        self.report = report.JobReport()
+        self.start_time = None
+        self.end_time = None
+        self.cancel_requested = False
+
+        # scheduler side
+        self.files = []
+        self.params = None
+        self.feed = None  # iterator of tasks, through read-ahead when pipelined
+        self.num_left = 0  # tasks not sent to the pool yet
+        self.in_flight = set()
+        self.next_task = None  # taken from feed, waiting for memory
+        self.io_pipeline = None
+        self.duplicates = {}  # stamped index -> indexes linked to its output
+        self.input_hashes = {}  # index -> content hash the worker read, for the manifest
+        self.farm = None  # farm.Coordinator of a farm job
+        self.cancel_sent = False  # the workers were told
+        self.feed_failed = False  # tasks couldn't be read any further, the job fails
+        self.checkpoint_path = None  # set when resumed from a checkpoint, else once it starts
+
+    def cancel(self):
+        # files being stamped stop at their next frame, page or band, the rest are dropped
+        self.cancel_requested = True
+
+    def is_finished(self):
+        return self.state in (DONE, CANCELLED, FAILED)
+
+    def get_progress(self):
+        # 0.0 - 1.0 weighted by estimated cost, by file count when nothing has a cost
+        if self.total_cost:
+            return min(1.0, self.done_cost / self.total_cost)
+        return self.num_done / float(max(self.num_files, 1))
+
+    def get_time_taken(self):
+        if self.start_time is None:
+            return 0
+        return (self.end_time or time.time()) - self.start_time
+
+    def get_checkpoint(self):
+        # what it takes to make the job again, files already stamped are in its manifest
+        return {'name': self.name,
+                'inputs': self.input_paths,
+                'outputs': self.output_paths,
+                'stamp': self.stamp_kwargs,
+                'manifest_dir': self.job_manifest.output_dir,
+                'report_dir': self.report_dir,
+                'pipelined': self.pipelined,
+                'dedup': self.dedup,
+                'order': self.order,
+                'farm_dir': self.farm_dir}
+
+
+def make_job(name, task, input_paths, output_dir, overlay_path, opacity, resize, rel_dirs=None, blend_mode=engine.DEFAULT_BLEND_MODE, tile_threshold=engine.tiled.TILE_PIXEL_THRESHOLD, flatten_pdf=False, force=False, report=True, pipelined=None, dedup=False, order=cost.DEFAULT_ORDER, farm_dir=None, profile=engine.DEFAULT_PROFILE):
+    # job for a receiver, outputs go to output_dir/{name}_{yymmdd} with its manifest and report
+    overlay_text = engine.get_overlay_text(name, task)
+    output_name_dir = engine.get_output_name_dir(output_dir, name)
+    if not os.path.exists(output_name_dir):
+        os.makedirs(output_name_dir)
+    output_paths = engine.get_output_paths(input_paths, output_name_dir, rel_dirs=rel_dirs)
+    return Job(name='{} - {}'.format(name, task),
+            input_paths=input_paths,
+            output_paths=output_paths,
+            text=overlay_text,
+            overlay_path=overlay_path,
+            opacity=opacity,
+            resize=resize,
+            blend_mode=blend_mode,
+            tile_threshold=tile_threshold,
+            flatten_pdf=flatten_pdf,
+            job_manifest=manifest.JobManifest(output_name_dir),
+            force=force,
+            report_dir=output_name_dir if report else None,
+            pipelined=pipelined,
+            dedup=dedup,
+            order=order,
+            farm_dir=farm_dir,
+            profile=profile)
+
+
+def resume_job(checkpoint_path, checkpoint):
+    # job made again from a checkpoint of recovery.list_checkpoints(), None if another process resumed it first.
+    # It isn't forced, whatever the first run was, outputs stamped by it are up to date now
+    claimed_path = recovery.claim_checkpoint(checkpoint_path)
+    if claimed_path is None:
+        return None
+    stamp = dict(checkpoint['stamp'])
+    for key in ('opacity', 'resize'):
+        if isinstance(stamp[key], list):
+            stamp[key] = tuple(stamp[key])
+    job = Job(name=checkpoint['name'],
+              input_paths=checkpoint['inputs'],
+              output_paths=checkpoint['outputs'],
+              job_manifest=manifest.JobManifest(checkpoint['manifest_dir']),
+              report_dir=checkpoint['report_dir'],
+              pipelined=checkpoint['pipelined'],
+              dedup=checkpoint['dedup'],
+              order=checkpoint['order'],
+              farm_dir=checkpoint['farm_dir'],
+              **stamp)
+    job.checkpoint_path = claimed_path
+    return job
+
+
+# Shared pool + scheduler thread, jobs run in the order they were submitted but side by side.
+# The pool is started with the first job and kept warm until shutdown().
+class JobQueue(object):
+    def __init__(self, workers=None, video_workers=None, callback_func=None, memory_budget=None):
+        self.workers = max(1, workers or engine.DEFAULT_WORKERS)
+        self.video_workers = max(1, min(video_workers or engine.DEFAULT_VIDEO_WORKERS, self.workers))
+        self.callback_func = callback_func
+        self.memory_budget = cost.get_memory_budget(memory_budget)
+        self.memory_used = 0  # estimated bytes of the files being stamped
+        self.jobs = OrderedDict()  # id -> job, finished jobs are kept
+        self._submitted = queue.Queue()
+        self._ready = queue.Queue()  # (job, tasks, skipped, error) prepared for the scheduler
+        self._results = queue.Queue()
+        self._progress_queue = None
+        self._cancelled_jobs = None  # engine.make_cancel_slots() of the pool
+        self._cancel_slot = 0
+        self._last_touch = time.time()
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._thread = None
+        self._prepare_thread = None
+        self._shutdown = False
+        self._warm = False
+        self._turn = 0
+
+    def start(self, warm=False):
+        # warm starts the worker processes now instead of with the first job
+        self._warm = self._warm or warm
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='JobQueue')
+            self._thread.daemon = True
+            self._thread.start()
+        if self._prepare_thread is None:
+            self._prepare_thread = threading.Thread(target=self._run_prepare, name='JobQueue-prepare')
+            self._prepare_thread.daemon = True
+            self._prepare_thread.start()
+
+    def submit(self, job):
+        self.jobs[job.id] = job
+        self._submitted.put(job)
+        self.start()
+        return job
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is not None:
+            job.cancel()
+
+    def get_active_jobs(self):
+        return [job for job in self.jobs.values() if not job.is_finished()]
+
+    def shutdown(self):
+        self._shutdown = True
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._prepare_thread is not None:
+            # a job being prepared is left to it, it isn't started anymore
+            self._prepare_thread.join(SHUTDOWN_WAIT)
+            self._prepare_thread = None
+
+    def _emit(self, job, event):
+        if not self.callback_func:
+            return
+        try:
+            self.callback_func(job, event)
+        except Exception:
+            logger.error(traceback.format_exc())
+
+    def _start_pool(self):
+        # forked from the prepare thread between two jobs, a fork while a job is prepared would copy
+        # the locks it holds (e.g. of an import) into the workers, locked for good
+        with self._pool_lock:
+            if self._pool is not None or self._shutdown:
+                return
+            self._progress_queue = multiprocessing.Queue()
+            self._cancelled_jobs = engine.make_cancel_slots()
+            self._pool = multiprocessing.Pool(processes=self.workers,
+                                            initializer=engine._init_worker,
+                                            initargs=(multiprocessing.Semaphore(self.video_workers), self._progress_queue, self._cancelled_jobs))
+
+    def _run(self):
+        active = []  # running jobs, in order of submission
+        try:
+            while not self._shutdown:
+                self._take_ready(active, wait=not active)
+                self._send_cancel(active)
+                self._dispatch(active)
+                self._collect(active)
+                self._forward_progress(active)
+                self._finish(active)
+                self._touch_checkpoints(active)
+        finally:
+            self._stop_in_flight(active)
+            for job in active:
+                if job.io_pipeline is not None:
+                    job.io_pipeline.close()
+                if job.farm is not None:
+                    job.farm.cancel()
+                    job.farm.close()
+            with self._pool_lock:
+                pool, self._pool = self._pool, None
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def _run_prepare(self):
+        # one job at a time, in order of submission, the pool is started before the first job that needs it
+        if self._warm:
+            self._start_pool()
+        while not self._shutdown:
+            try:
+                job = self._submitted.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            prepared = self._prepare(job)
+            if prepared[1] and job.farm is None:
+                self._start_pool()
+            self._ready.put(prepared)
+
+    def _prepare(self, job):
+        # files, dedup, costs, memory and order of a job, runs on the prepare thread.
+        # returns (job, tasks, skipped, error traceback)
+        if job.cancel_requested:
+            return job, [], [], None
+        job.start_time = time.time()
+        try:
+            job.files, tasks, skipped, job.params = engine.build_tasks(job.input_paths, job.output_paths, job.stamp_kwargs,
+                                                                    job_manifest=job.job_manifest, force=job.force)
+            if job.dedup and len(tasks) > 1:
+                tasks, job.duplicates = engine.dedup_tasks(tasks)
+            job.costs = cost.estimate_tasks(tasks)
+            job.total_cost = sum(job.costs.values())
+            if job.farm_dir:
+                # nodes fit the memory of the files to their own budget
+                tasks = cost.plan(tasks, job.costs, self.workers, self.video_workers, order=job.order)
+                if not self._shutdown:
+                    job.farm = farm.Coordinator(job.farm_dir, job.name, tasks, job.costs, job.stamp_kwargs)
+                tasks = []
+            else:
+                job.memory = cost.fit_memory(tasks, self.memory_budget)
+                # the job gets its turns on the shared pool, its own share is packed as if it had all of it
+                tasks = cost.plan(tasks, job.costs, self.workers, self.video_workers, order=job.order)
+        except Exception:
+            return job, [], [], traceback.format_exc()
+        if job.job_manifest is not None:
+            self._save_checkpoint(job)
+        return job, tasks, skipped, None
+
+    def _take_ready(self, active, wait=False):
+        while True:
+            try:
+                job, tasks, skipped, error = self._ready.get(timeout=POLL_INTERVAL) if wait else self._ready.get_nowait()
+            except queue.Empty:
+                return
+            wait = False
+            if error is not None:
+                job.errors.append((None, error))
+                job.state = FAILED
+                job.end_time = time.time()
+                logger.error('Job {} failed to start: {}'.format(job.name, error))
+                if job.checkpoint_path is not None:
+                    recovery.remove_checkpoint(job.checkpoint_path)
+                self._emit(job, FINISHED)
+                continue
+            if job.cancel_requested:
+                # cancelled before or while it was prepared
+                if job.farm is not None:
+                    job.farm.cancel()
+                    job.farm.close()
+                job.state = CANCELLED
+                job.end_time = time.time() if job.start_time else None
+                self._emit(job, FINISHED)
+                continue
+
+            job.num_files = len(job.files)
+            job.num_skipped = job.num_done = len(skipped)
+            job.report.num_skipped = len(skipped)
+            job.num_left = len(tasks)
+            pipelined = job.pipelined
+            if pipelined is None and tasks:
+                input_path, output_path = job.files[tasks[0][0]]
+                pipelined = pipeline.is_remote(input_path) or pipeline.is_remote(output_path)
+            if pipelined and tasks:
+                job.io_pipeline = pipeline.IOPipeline()
+                job.feed = job.io_pipeline.prefetch(tasks)
+            else:
+                job.feed = iter(tasks)
+            job.state = RUNNING
+            active.append(job)
+            self._emit(job, STARTED)
+
+    def _save_checkpoint(self, job):
+        if job.checkpoint_path is None:
+            job.checkpoint_path = recovery.get_checkpoint_path(job.id)
+        try:
+            recovery.write_checkpoint(job.checkpoint_path, job.get_checkpoint())
+        except (IOError, OSError) as e:
+            logger.warning('Failed to write the checkpoint of {}, it can\'t be resumed: {}'.format(job.name, e))
+
+    def _touch_checkpoints(self, active):
+        # tells the checkpoints of running jobs from the ones of a crash where the pid can't be checked
+        if time.time() - self._last_touch < recovery.CHECKPOINT_INTERVAL:
+            return
+        self._last_touch = time.time()
+        for job in active:
+            if job.checkpoint_path is not None:
+                recovery.touch_checkpoint(job.checkpoint_path)
+
+    def _send_cancel(self, active):
+        # job ids in the shared slots, the workers check them at every progress callback
+        for job in active:
+            if job.cancel_requested and not job.cancel_sent:
+                job.cancel_sent = True
+                if job.in_flight and self._cancelled_jobs is not None:
+                    self._cancelled_jobs[self._cancel_slot] = job.id
+                    self._cancel_slot = (self._cancel_slot + 1) % engine.CANCEL_SLOTS
+
+    def _stop_in_flight(self, active):
+        # on shutdown the files being stamped are cancelled and waited for a moment, so their ffmpeg,
+        # page renderers and partial outputs are cleaned up before the workers are terminated
+        for job in active:
+            job.cancel()
+        self._send_cancel(active)
+        deadline = time.time() + SHUTDOWN_WAIT
+        while any(job.in_flight for job in active) and time.time() < deadline:
+            try:
+                (job_id, i), result, record, error = self._results.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            self.jobs[job_id].in_flight.discard(i)
+
+    def _next_task(self, job):
+        # None while the read-ahead of the next input isn't done yet.
+        # A feed that breaks fails the rest of its job, the other jobs go on
+        try:
+            if job.io_pipeline is None:
+                return next(job.feed)
+            return job.feed.next(0)
+        except multiprocessing.TimeoutError:
+            return None
+        except Exception:
+            job.errors.append((None, traceback.format_exc()))
+            logger.error('Failed to read the next file of {}: {}'.format(job.name, job.errors[-1][1]))
+            job.num_left = 0
+            job.feed_failed = True
+            return None
+
+    def _set_waiting(self, job, waiting):
+        if job.waiting_memory != waiting:
+            job.waiting_memory = waiting
+            self._emit(job, PROGRESS)
+
+    def _dispatch(self, active):
+        # one free worker at a time, jobs take turns
+        if self._pool is None:
+            return  # shutting down before it was started
+        num_busy = sum(len(job.in_flight) for job in active)
+        while num_busy < self.workers:
+            candidates = [job for job in active if job.num_left and not job.cancel_requested and
+                          (job.io_pipeline is None or not job.io_pipeline.is_full())]
+            if not candidates:
+                return
+            sent = False
+            for n in range(len(candidates)):
+                job = candidates[(self._turn + n) % len(candidates)]
+                if job.next_task is None:
+                    job.next_task = self._next_task(job)
+                if job.next_task is None:
+                    continue
+                i, kwargs = job.next_task
+                memory = job.memory.get(i, 0)
+                if self.memory_used and self.memory_used + memory > self.memory_budget:
+                    # nothing else goes first, a big file can't be starved by small ones
+                    self._set_waiting(job, True)
+                    return
+                self._set_waiting(job, False)
+                job.next_task = None
+                self.memory_used += memory
+                job.num_left -= 1
+                job.in_flight.add(i)
+                self._pool.apply_async(_job_task, (((job.id, i), kwargs), ), callback=self._results.put)
+                self._turn = (self._turn + n + 1) % len(candidates)
+                num_busy += 1
+                sent = True
+                break
+            if not sent:
+                return
+
+    def _collect(self, active):
+        wait = any(job.in_flight or job.farm is not None or job.io_pipeline is not None and job.io_pipeline.is_writing()
+                   for job in active)
+        while True:
+            try:
+                (job_id, i), result, record, error = self._results.get(timeout=POLL_INTERVAL) if wait else self._results.get_nowait()
+            except queue.Empty:
+                break
+            wait = False
+            job = self.jobs[job_id]
+            job.in_flight.discard(i)
+            self.memory_used = max(0, self.memory_used - job.memory.pop(i, 0))
+            self._task_done(job, i, result, record, error)
+
+        for job in active:
+            if job.io_pipeline is not None:
+                self._collect_written(job)
+            if job.farm is not None:
+                if job.cancel_requested and not job.farm.cancelled:
+                    job.farm.cancel()
+                for i, record, error in job.farm.poll():
+                    self._task_done(job, i, None, record, error)
+
+    def _task_done(self, job, i, result, record, error):
+        if error == engine.CANCELLED:
+            # not done, the next run stamps it and its duplicates
+            if job.io_pipeline is not None:
+                job.io_pipeline.computed(i)
+            job.num_cancelled += 1
+            job.duplicates.pop(i, None)
+            return
+        if error is not None:
+            if job.io_pipeline is not None:
+                job.io_pipeline.computed(i)
+            logger.error('Failed to stamp {}: {}'.format(job.files[i][0], error))
+            self._file_failed(job, i, error)
+            return
+        job.input_hashes[i] = engine.pop_input_hash(record)
+        if record is not None:
+            record['input'], record['output'] = job.files[i]
+            job.report.add(record)
+        if job.io_pipeline is not None:
+            job.io_pipeline.write(i, result, wait=False)
+        else:
+            self._file_done(job, i)
+
+    def _collect_written(self, job):
+        # outputs moved to their destination by the write-behind, a move that failed fails its file only
+        for i, result, error in job.io_pipeline.iter_written():
+            if error is None:
+                self._file_done(job, i)
+                continue
+            job.input_hashes.pop(i, None)
+            logger.error('Failed to write {}: {}'.format(job.files[i][1], error))
+            self._file_failed(job, i, 'Failed to write {}: {}'.format(job.files[i][1], error))
+
+    def _file_failed(self, job, i, error):
+        job.num_done += 1
+        job.done_cost += job.costs.get(i, 0.0)
+        job.last_file = job.files[i]
+        job.errors.append((job.files[i][0], error))
+        self._emit(job, FILE_DONE)
+        for j in job.duplicates.pop(i, ()):
+            job.num_done += 1
+            job.last_file = job.files[j]
+            job.errors.append((job.files[j][0], 'Identical to {}, which failed'.format(job.files[i][0])))
+            self._emit(job, FILE_DONE)
+
+    def _file_done(self, job, i):
+        input_path, output_path = job.files[i]
+        job.num_done += 1
+        job.done_cost += job.costs.get(i, 0.0)
+        job.last_file = job.files[i]
+        content_hash = job.input_hashes.pop(i, None)
+        if job.job_manifest is not None and os.path.exists(output_path):
+            # the output is fine without its entry, the next run only stamps it again
+            try:
+                job.job_manifest.update(input_path, output_path, job.params, content_hash=content_hash)
+                job.job_manifest.save(force=False)
+            except (IOError, OSError) as e:
+                logger.warning('Failed to update the manifest of {}: {}'.format(output_path, e))
+        self._emit(job, FILE_DONE)
+        for j in job.duplicates.pop(i, ()):
+            job.input_hashes[j] = content_hash
+            try:
+                engine.link_output(output_path, job.files[j][1])
+            except (IOError, OSError):
+                job.num_done += 1
+                job.last_file = job.files[j]
+                job.errors.append((job.files[j][0], traceback.format_exc()))
+                logger.error('Failed to link {}: {}'.format(job.files[j][1], job.errors[-1][1]))
+                self._emit(job, FILE_DONE)
+                continue
+            job.report.add_duplicate(job.files[j], output_path)
+            self._file_done(job, j)
+
+    def _forward_progress(self, active):
+        # sub progress of each job follows the file that started first among the ones still stamping,
+        # when it is done the next one takes over from its latest progress
+        if self._progress_queue is None:
+            return
+        while not self._progress_queue.empty():
+            try:
+                (job_id, i), callback_result = self._progress_queue.get_nowait()
+            except Exception:
+                break
+            job = self.jobs.get(job_id)
+            if job is not None and i in job.in_flight:
+                job.file_progress[i] = callback_result
+        for job in active:
+            for i in [i for i in job.file_progress if i not in job.in_flight]:
+                del job.file_progress[i]
+            followed = next(iter(job.file_progress), None)
+            if followed is None:
+                continue
+            if job.sub_progress is not job.file_progress[followed]:  # new progress or another file
+                job.sub_progress = job.file_progress[followed]
+                self._emit(job, PROGRESS)
+
+    def _finish(self, active):
+        for job in list(active):
+            if job.in_flight or (job.num_left and not job.cancel_requested):
+                continue
+            if job.farm is not None and not job.farm.is_finished():
+                continue
+            if job.io_pipeline is not None:
+                if job.io_pipeline.is_writing():
+                    continue  # last outputs still being moved, _collect takes them as they are
+                job.io_pipeline.close()
+                job.io_pipeline = None
+            active.remove(job)
+            job.next_task = None
+            job.waiting_memory = False
+            if job.feed_failed:
+                job.state = FAILED
+            elif job.cancel_requested and (job.num_left or job.num_cancelled or job.farm is not None and job.farm.num_dropped):
+                job.state = CANCELLED
+            else:
+                job.state = DONE
+            if job.farm is not None:
+                if job.farm.num_reclaimed:
+                    logger.info('{} units of {} were stamped again after their node stopped'.format(job.farm.num_reclaimed, job.name))
+                job.farm.close()
+            job.end_time = time.time()
+            job.report.finish()
+            job.report.log(logger)
+            if job.job_manifest is not None:
+                try:
+                    job.job_manifest.save()
+                except (IOError, OSError) as e:
+                    logger.warning('Failed to save the manifest of {}: {}'.format(job.name, e))
+            if job.report_dir and job.report.records:
+                # nothing stamped keeps the report of the run that did
+                try:
+                    job.report.write(job.report_dir)
+                except (IOError, OSError) as e:
+                    logger.warning('Failed to write report: {}'.format(e))
+            if job.checkpoint_path is not None and job.state == DONE:
+                # a cancelled job keeps it and can be resumed
+                recovery.remove_checkpoint(job.checkpoint_path)
+            self._emit(job, FINISHED)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Job manifest, written into the output folder to remember what each output was stamped from.
+# A re-run only stamps inputs that changed, outputs that are missing or stamp settings that differ.
+# Inputs are compared by size and mtime, a touched input by the md5 of its whole content,
+# an edit that keeps the size can be anywhere in the file.
+
+import os
+import json
+import time
+import hashlib
+import logging
+
+import recovery
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = '.watermarkr_manifest.json'
+MANIFEST_VERSION = 1
+QUICK_HASH_CHUNK = 1024 * 1024  # bytes read from the start and the end of a file for its quick hash
+SAVE_INTERVAL = 2.0  # sec, minimum time between manifest writes while stamping
+
+
+def quick_hash(path):
+    # md5 of size + first and last chunk, cheap enough for files on the network share
+    size = os.path.getsize(path)
+    md5 = hashlib.md5(str(size).encode('utf-8'))
+    with open(path, 'rb') as f:
+        md5.update(f.read(QUICK_HASH_CHUNK))
+        if size > QUICK_HASH_CHUNK:
+            f.seek(max(QUICK_HASH_CHUNK, size - QUICK_HASH_CHUNK))
+            md5.update(f.read(QUICK_HASH_CHUNK))
+    return md5.hexdigest()
+
+
+def file_hash(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(QUICK_HASH_CHUNK), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def get_params(text, overlay_path, opacity, resize, **kwargs):
+    # stamp settings of a job, json round trip so tuples compare equal to what was loaded
+    params = {'text': text,
+            'overlay': file_hash(overlay_path) if os.path.exists(overlay_path) else overlay_path,
+            'opacity': opacity,
+            'resize': resize}
+    params.update(kwargs)
+    return json.loads(json.dumps(params, sort_keys=True))
+
+
+class JobManifest(object):
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.path = '{}/{}'.format(output_dir, MANIFEST_NAME)
+        self.entries = {}
+        self._last_save = 0
+        self._dirty = False
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except ValueError:
+            logger.warning('Corrupted manifest, ignored: {}'.format(self.path))
+            return
+        if data.get('version') == MANIFEST_VERSION:
+            self.entries = data.get('entries', {})
+
+    def save(self, force=True):
+        if not self._dirty or (not force and time.time() - self._last_save < SAVE_INTERVAL):
+            return
+        data = {'version': MANIFEST_VERSION, 'entries': self.entries}
+        temp_path = '{}.tmp'.format(self.path)
+        with open(temp_path, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        recovery.replace(temp_path, self.path)
+        self._last_save = time.time()
+        self._dirty = False
+
+    def get_key(self, output_path):
+        # outputs are keyed relative to the manifest, outputs of dropped folders sit in sub folders
+        return os.path.relpath(output_path, self.output_dir).replace('\\', '/')
+
+    def is_up_to_date(self, input_path, output_path, params):
+        entry = self.entries.get(self.get_key(output_path))
+        if not entry or entry['input'] != input_path or entry['params'] != params:
+            return False
+        if not os.path.exists(output_path) or os.path.getsize(output_path) != entry['output_size']:
+            return False
+        stat = os.stat(input_path)
+        if stat.st_size != entry['size']:
+            return False
+        if stat.st_mtime != entry['mtime']:
+            # touched but maybe not changed, compare the whole content.
+            # hashes of older manifests only covered the ends of the file, they never match and the input is stamped again
+            if file_hash(input_path) != entry['hash']:
+                return False
+            entry['mtime'] = stat.st_mtime
+            self._dirty = True
+        return True
+
+    def update(self, input_path, output_path, params, content_hash=None):
+        # content_hash is the file_hash of the input when the worker already read it
+        stat = os.stat(input_path)
+        self.entries[self.get_key(output_path)] = {'input': input_path,
+                                                   'size': stat.st_size,
+                                                   'mtime': stat.st_mtime,
+                                                   'hash': content_hash or file_hash(input_path),
+                                                   'params': params,
+                                                   'output_size': os.path.getsize(output_path)}
+        self._dirty = True
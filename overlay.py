@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Prepared overlay, the watermark image + text layer rendered once per job and reused
+# for every still of the same resolution.
+
+import os
+import logging
+from collections import OrderedDict
+
+import composite
+import report
+from defaults import DEFAULT_PROFILE
+
+try:
+    from PIL import Image, ImageDraw, ImageFont, ImageStat
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+STILL_FORMAT = ('.jpg', '.tif', '.tiff', '.png')
+STILL_MODES = ('RGB', 'RGBA', 'L', 'LA')  # modes we can composite, anything else goes to rf watermark
+OVERLAY_CACHE_SIZE = 8  # number of prepared overlays kept per process
+OPACITY_STEP = 0.005  # auto opacity is rounded to this step so similar images share an overlay
+FONT_NAME = 'arial.ttf'
+FONT_RATIO = 0.025  # text height relative to image height
+TEXT_MARGIN_RATIO = 0.02  # text margin relative to image height
+SAVE_OPTIONS = {'fast': {'.jpg': {'quality': 85, 'subsampling': 2},  # 4:2:0
+                         '.tif': {},
+                         '.tiff': {},
+                         '.png': {'compress_level': 1}},
+                'balanced': {'.jpg': {'quality': 95, 'subsampling': 0},
+                             '.tif': {},
+                             '.tiff': {},
+                             '.png': {}},  # zlib level 6
+                'archive': {'.jpg': {'quality': 95, 'subsampling': 0, 'optimize': True},
+                            '.tif': {'compression': 'tiff_adobe_deflate'},
+                            '.tiff': {'compression': 'tiff_adobe_deflate'},
+                            '.png': {'compress_level': 9}}}  # profile -> extension -> PIL save options
+
+
+def is_available():
+    return Image is not None
+
+
+def is_still(path):
+    return os.path.splitext(path)[-1].lower() in STILL_FORMAT
+
+
+def get_save_options(path, profile=DEFAULT_PROFILE):
+    return SAVE_OPTIONS[profile].get(os.path.splitext(path)[-1].lower(), {})
+
+
+def get_auto_opacity(luminance, opacity_range):
+    # brighter image needs stronger overlay to be visible
+    min_opacity, max_opacity = opacity_range
+    opacity = min_opacity + ((max_opacity - min_opacity) * luminance)
+    return round(opacity / OPACITY_STEP) * OPACITY_STEP
+
+
+def auto_opacity(image, opacity_range):
+    thumb = image.convert('L')
+    thumb.thumbnail((256, 256))
+    luminance = ImageStat.Stat(thumb).mean[0] / 255.0
+    return get_auto_opacity(luminance, opacity_range)
+
+
+def get_limited_size(size, limit):
+    # scale down so the longest side fits the limit, keep aspect ratio
+    width, height = size
+    longest = max(width, height)
+    if not limit or longest <= limit:
+        return width, height
+    scale = limit / float(longest)
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+
+def load_font(size):
+    if size not in _fonts:
+        try:
+            _fonts[size] = ImageFont.truetype(FONT_NAME, size)
+        except IOError:
+            _fonts[size] = ImageFont.load_default()
+    return _fonts[size]
+
+
+def get_text_height(draw, text, font):
+    # textsize was removed in newer Pillow
+    if hasattr(draw, 'textbbox'):
+        return draw.textbbox((0, 0), text, font=font)[3]
+    return draw.textsize(text, font=font)[1]
+
+
+def render_layer(source, text, opacity, size, top=0, bottom=None):
+    # render rows top - bottom of the overlay layer for a frame of this size, whole frame by default
+    width, height = size
+    bottom = height if bottom is None else bottom
+    layer = Image.new('RGBA', (width, bottom - top), (0, 0, 0, 0))
+
+    # overlay image, fit into the frame and center
+    scale = min(width / float(source.size[0]), height / float(source.size[1]))
+    fit_size = (max(1, int(source.size[0] * scale)), max(1, int(source.size[1] * scale)))
+    fit_left = (width - fit_size[0]) // 2
+    fit_top = (height - fit_size[1]) // 2
+    band_top = max(top, fit_top)
+    band_bottom = min(bottom, fit_top + fit_size[1])
+    if band_bottom > band_top:
+        # only resize the source rows that land in this band
+        source_scale = source.size[1] / float(fit_size[1])
+        box = (0, (band_top - fit_top) * source_scale, source.size[0], (band_bottom - fit_top) * source_scale)
+        fitted = source.resize((fit_size[0], band_bottom - band_top), Image.BILINEAR, box=box)
+        layer.paste(fitted, (fit_left, band_top - top))
+
+    # text, bottom left corner
+    if text:
+        font = load_font(max(10, int(height * FONT_RATIO)))
+        margin = int(height * TEXT_MARGIN_RATIO)
+        draw = ImageDraw.Draw(layer)
+        text_height = get_text_height(draw, text, font)
+        draw.text((margin, height - text_height - margin - top), text, font=font, fill=(255, 255, 255, 255))
+
+    # opacity
+    alpha = layer.split()[-1].point(lambda a: int(a * opacity))
+    layer.putalpha(alpha)
+    return layer
+
+
+class PreparedOverlay(object):
+    def __init__(self, source, text, opacity, size):
+        self.text = text
+        self.opacity = opacity
+        self.size = size
+        self.layer = render_layer(source, text, opacity, size)
+        self._arrays = None
+
+    def get_arrays(self):
+        # (bbox, rgb, alpha) of the layer for numpy compositing, built on first use
+        if self._arrays is None:
+            self._arrays = composite.split_layer(self.layer)
+        return self._arrays
+
+    def composite_array(self, array, blend_mode=composite.DEFAULT_BLEND_MODE):
+        bbox, over_rgb, over_alpha = self.get_arrays()
+        return composite.composite(array, bbox, over_rgb, over_alpha, mode=blend_mode)
+
+    def composite(self, image):
+        mode = image.mode
+        result = Image.alpha_composite(image.convert('RGBA'), self.layer)
+        if mode != 'RGBA':
+            result = result.convert(mode)
+        return result
+
+
+# Least recently used cache of prepared overlays, keyed by overlay path/mtime, text, opacity and size.
+# The decoded overlay source is also kept so mixed resolution batches read it only once.
+class OverlayCache(object):
+    def __init__(self, maxsize=OVERLAY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.overlays = OrderedDict()
+        self.sources = {}
+
+    def get_source(self, overlay_path):
+        key = (overlay_path, os.path.getmtime(overlay_path))
+        if key not in self.sources:
+            self.sources.clear()
+            self.sources[key] = Image.open(overlay_path).convert('RGBA')
+        return key, self.sources[key]
+
+    def get(self, overlay_path, text, opacity, size):
+        source_key, source = self.get_source(overlay_path)
+        key = (source_key, text, opacity, tuple(size))
+        if key in self.overlays:
+            prepared = self.overlays.pop(key)
+        else:
+            logger.debug('Prepare overlay: {} {}'.format(size, opacity))
+            prepared = PreparedOverlay(source, text, opacity, size)
+            while len(self.overlays) >= self.maxsize:
+                self.overlays.popitem(last=False)
+        self.overlays[key] = prepared
+        return prepared
+
+    def clear(self):
+        self.overlays.clear()
+        self.sources.clear()
+
+
+# Overlay rendered band by band for images too big to hold a full frame layer in memory
+class TiledOverlay(object):
+    def __init__(self, source, text, opacity, size):
+        self.source = source
+        self.text = text
+        self.opacity = opacity
+        self.size = size
+
+    def band(self, top, bottom):
+        return render_layer(self.source, self.text, self.opacity, self.size, top=top, bottom=bottom)
+
+
+# one cache per process, shared by all the files a worker stamps
+_cache = OverlayCache()
+_fonts = {}
+
+
+def get_prepared_overlay(overlay_path, text, opacity, size):
+    return _cache.get(overlay_path, text, opacity, size)
+
+
+def get_tiled_overlay(overlay_path, text, opacity, size):
+    source_key, source = _cache.get_source(overlay_path)
+    return TiledOverlay(source, text, opacity, size)
+
+
+def can_stamp(path):
+    return is_available() and is_still(path)
+
+
+def stamp_image(input_path, output_path, overlay_path, text, opacity, resize=None, blend_mode=composite.DEFAULT_BLEND_MODE, profile=DEFAULT_PROFILE, callback_func=None):
+    # resize (optional) and stamp a still with the cached overlay in memory,
+    # returns output path or None if the image mode isn't supported
+    with report.stage('read') as counts:
+        image = Image.open(input_path)
+        if image.mode not in STILL_MODES:
+            return None
+        image.load()
+        counts['pixels'] = image.size[0] * image.size[1]
+    size = get_limited_size(image.size, resize)
+    if size != image.size:
+        with report.stage('resize'):
+            image = image.resize(size, Image.LANCZOS)
+
+    with report.stage('composite'):
+        if composite.is_available():
+            result = composite_image(image, overlay_path, text, opacity, blend_mode)
+        else:
+            if blend_mode != composite.DEFAULT_BLEND_MODE:
+                logger.warning('numpy is not available, {} blend mode falls back to normal'.format(blend_mode))
+            if isinstance(opacity, (tuple, list)):
+                opacity = auto_opacity(image, opacity)
+            prepared = get_prepared_overlay(overlay_path, text, opacity, image.size)
+            result = prepared.composite(image)
+
+    with report.stage('write'):
+        result.save(output_path, **get_save_options(output_path, profile))
+    if callback_func:
+        callback_func((1, 1))
+    return output_path
+
+
+def composite_image(image, overlay_path, text, opacity, blend_mode=composite.DEFAULT_BLEND_MODE):
+    # numpy path, luminance analysis on the whole array, blend modes with integer math.
+    # normal mode still composites with PIL, alpha_composite is faster than any numpy version
+    mode = image.mode
+    if mode in ('L', 'LA'):
+        image = image.convert(mode.replace('L', 'RGB'))
+    is_normal = blend_mode == composite.DEFAULT_BLEND_MODE
+    array = None
+    if not is_normal:
+        array = composite.np.array(image)
+    if isinstance(opacity, (tuple, list)):
+        luminance = composite.mean_luminance(array if array is not None else composite.np.asarray(image))
+        opacity = get_auto_opacity(luminance, opacity)
+    prepared = get_prepared_overlay(overlay_path, text, opacity, image.size)
+    if is_normal:
+        result = prepared.composite(image)
+    else:
+        prepared.composite_array(array, blend_mode=blend_mode)
+        result = Image.fromarray(array)
+    if result.mode != mode:
+        result = result.convert(mode)
+    return result
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# PDF path, the overlay (image + text) is added once as an image XObject per page size
+# and referenced from every page of that size, so output size and write time stay close to the original.
+# Flatten mode rasterizes the pages with the overlay burnt in, pages are rendered in parallel,
+# on processes or, from a pool worker that can't start any, on threads of the worker.
+
+import os
+import io
+import shutil
+import logging
+import functools
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+try:
+    import fitz
+except ImportError:
+    fitz = None
+
+import overlay
+import report
+import recovery
+from defaults import DEFAULT_PROFILE
+
+logger = logging.getLogger(__name__)
+
+PDF_FORMAT = ('.pdf', )
+OVERLAY_DPI = 150  # resolution of the shared overlay image
+FLATTEN_DPI = 200  # resolution of rasterized pages
+FLATTEN_QUALITY = {'fast': 80, 'balanced': 90, 'archive': 95}  # jpeg quality of rasterized pages per profile
+SAVE_OPTIONS = {'fast': {'deflate': True},  # overlay streams still compressed, no object cleanup
+                'balanced': {'garbage': 3, 'deflate': True},  # + merge duplicate objects
+                'archive': {'garbage': 4, 'deflate': True}}  # + duplicate streams, slow on big documents
+FLATTEN_CHUNK = 4  # pages rendered per task
+LUMINANCE_ZOOM = 0.1  # zoom of the first page render used for auto opacity
+MIN_FITZ_VERSION = (1, 18, 13)  # sharing an image xref between pages
+
+
+def is_available():
+    if fitz is None or not overlay.is_available():
+        return False
+    version = tuple(int(v) for v in fitz.VersionBind.split('.')[:3])
+    return version >= MIN_FITZ_VERSION
+
+
+def can_stamp(path):
+    return os.path.splitext(path)[-1].lower() in PDF_FORMAT and is_available()
+
+
+def page_to_image(page, zoom):
+    pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    return overlay.Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+
+
+def get_opacity(doc, opacity):
+    # auto opacity from a tiny render of the first page, one overlay is shared by all pages
+    if not isinstance(opacity, (tuple, list)):
+        return opacity
+    if not len(doc):
+        return opacity[0]
+    image = page_to_image(doc[0], LUMINANCE_ZOOM)
+    return overlay.auto_opacity(image, opacity)
+
+
+def get_pixel_size(rect, dpi):
+    return max(1, int(rect.width * dpi / 72.0)), max(1, int(rect.height * dpi / 72.0))
+
+
+def get_overlay_png(overlay_path, text, opacity, size):
+    buf = io.BytesIO()
+    overlay.get_prepared_overlay(overlay_path, text, opacity, size).layer.save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def stamp_pdf(input_path, output_path, overlay_path, text, opacity, flatten=False, profile=DEFAULT_PROFILE, callback_func=None):
+    if flatten:
+        return flatten_pdf(input_path, output_path, overlay_path, text, opacity, profile=profile, callback_func=callback_func)
+
+    with report.stage('read'):
+        doc = fitz.open(input_path)
+    try:
+        num_pages = len(doc)
+        with report.stage('composite', frames=num_pages):
+            opacity = get_opacity(doc, opacity)
+            xrefs = {}  # page size -> xref of its overlay image
+            for i, page in enumerate(doc):
+                rect = page.rect
+                key = (int(round(rect.width)), int(round(rect.height)))
+                if key not in xrefs:
+                    png = get_overlay_png(overlay_path, text, opacity, get_pixel_size(rect, OVERLAY_DPI))
+                    xrefs[key] = page.insert_image(rect, stream=png, overlay=True)
+                else:
+                    page.insert_image(rect, xref=xrefs[key], overlay=True)
+                if callback_func:
+                    callback_func((i + 1, num_pages))
+        with report.stage('write'):
+            doc.save(output_path, **SAVE_OPTIONS[profile])
+    finally:
+        doc.close()
+    return output_path
+
+
+def _rasterize_pages(args, lock=None):
+    # render + stamp a range of pages to jpeg files, runs in its own process or on a thread.
+    # on threads fitz and the overlay cache are used under the shared lock, they aren't thread safe,
+    # compositing and jpeg encoding release the GIL and run side by side
+    input_path, page_numbers, overlay_path, text, opacity, quality, temp_dir = args
+    lock = lock or threading.Lock()
+    with lock:
+        doc = fitz.open(input_path)
+    paths = []
+    try:
+        for page_number in page_numbers:
+            with lock:
+                image = page_to_image(doc[page_number], FLATTEN_DPI / 72.0)
+                prepared = overlay.get_prepared_overlay(overlay_path, text, opacity, image.size)
+            image = prepared.composite(image)
+            path = os.path.join(temp_dir, 'page_{:05d}.jpg'.format(page_number))
+            image.save(path, quality=quality)
+            paths.append((page_number, path))
+    finally:
+        with lock:
+            doc.close()
+    return paths
+
+
+def flatten_pdf(input_path, output_path, overlay_path, text, opacity, profile=DEFAULT_PROFILE, callback_func=None):
+    with report.stage('read'):
+        doc = fitz.open(input_path)
+        opacity = get_opacity(doc, opacity)
+        page_rects = [page.rect for page in doc]
+        doc.close()
+    num_pages = len(page_rects)
+
+    temp_dir = recovery.mkdtemp('pdf')
+    try:
+        page_numbers = list(range(num_pages))
+        tasks = [(input_path, page_numbers[i:i + FLATTEN_CHUNK], overlay_path, text, opacity, FLATTEN_QUALITY[profile], temp_dir)
+                for i in range(0, num_pages, FLATTEN_CHUNK)]
+        num_workers = max(1, min(multiprocessing.cpu_count(), len(tasks)))
+        rasterize = _rasterize_pages
+        with report.stage('composite', frames=num_pages):
+            if num_workers == 1:
+                pool = None
+            elif multiprocessing.current_process().daemon:
+                # processes can't be started from a pool worker (daemon), threads of it render the pages
+                pool = ThreadPool(num_workers)
+                rasterize = functools.partial(_rasterize_pages, lock=threading.Lock())
+            else:
+                pool = multiprocessing.Pool(num_workers)
+            page_paths = {}
+            try:
+                results = pool.imap_unordered(rasterize, tasks) if pool else (rasterize(task) for task in tasks)
+                for paths in results:
+                    page_paths.update(paths)
+                    if callback_func:
+                        callback_func((len(page_paths), num_pages))
+            finally:
+                if pool:
+                    # a callback that raised (cancel) doesn't wait for the pages left
+                    if len(page_paths) < num_pages:
+                        pool.terminate()
+                    else:
+                        pool.close()
+                    pool.join()
+
+        with report.stage('write'):
+            out = fitz.open()
+            for page_number, rect in enumerate(page_rects):
+                page = out.new_page(width=rect.width, height=rect.height)
+                page.insert_image(page.rect, filename=page_paths[page_number])
+            out.save(output_path, **SAVE_OPTIONS[profile])
+            out.close()
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return output_path
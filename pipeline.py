@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Pipelined I/O for inputs and outputs on network shares.
+# Read-ahead copies the next inputs to local scratch while the workers stamp the current ones,
+# write-behind moves finished outputs from scratch to their destination while the next ones are stamped.
+# Both sides are bounded by bytes so the share and the CPU stay busy at the same time
+# without filling the scratch disk.
+
+import sys
+import os
+import shutil
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import recovery
+
+logger = logging.getLogger(__name__)
+
+READ_AHEAD_BYTES = 1024 * 1024 * 1024  # input bytes copied ahead of the workers
+WRITE_BEHIND_BYTES = 1024 * 1024 * 1024  # output bytes waiting to be moved to their destination
+IO_THREADS = 4  # copies running at once, each way
+WAIT_INTERVAL = 0.1  # sec, how often waiting loops check again
+DRIVE_REMOTE = 4  # GetDriveType result of a mapped network drive
+
+
+def is_remote(path):
+    # UNC path or a mapped network drive on Windows
+    path = path.replace('\\', '/')
+    if path.startswith('//'):
+        return True
+    if sys.platform == 'win32':
+        import ctypes
+        drive = os.path.splitdrive(os.path.abspath(path))[0]
+        if drive:
+            return ctypes.windll.kernel32.GetDriveTypeW(u'{}\\'.format(drive)) == DRIVE_REMOTE
+    return False
+
+
+def get_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+# Counting semaphore on bytes. A request larger than the whole limit still
+# goes through once nothing else is held, so one huge file can't block forever.
+# A caller that can't wait takes the bytes at once and holds back while is_full().
+class ByteBudget(object):
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.closed = False
+        self._cond = threading.Condition()
+
+    def acquire(self, size, wait=True):
+        with self._cond:
+            while wait and not self.closed and self.used and self.used + size > self.limit:
+                self._cond.wait(WAIT_INTERVAL)
+            if self.closed:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size):
+        with self._cond:
+            self.used = max(0, self.used - size)
+            self._cond.notify_all()
+
+    def is_full(self):
+        return self.used >= self.limit
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+# Read-ahead / write-behind around the engine tasks, tasks are (index, stamp_media kwargs).
+# prefetch() swaps input and output paths of each task for scratch paths,
+# write() queues the scratch output to be moved where it belongs, a caller that can't wait for the
+# write-behind (job queue) passes wait=False and sends no new files while is_full(),
+# iter_written() yields (index, result, error) of the outputs that reached their destination or failed to.
+class IOPipeline(object):
+    def __init__(self, scratch_dir=None, read_ahead=READ_AHEAD_BYTES, write_behind=WRITE_BEHIND_BYTES, threads=IO_THREADS):
+        self.scratch_dir = recovery.mkdtemp('io', dir=scratch_dir)
+        self.read_budget = ByteBudget(read_ahead)
+        self.write_budget = ByteBudget(write_behind)
+        self.read_pool = ThreadPool(threads)
+        self.write_pool = ThreadPool(threads)
+        self._inputs = {}  # index -> (scratch input or None, bytes held)
+        self._outputs = {}  # index -> destination output path
+        self._written = queue.Queue()
+        self._num_writing = 0
+
+    def get_scratch_path(self, kind, index, path):
+        # basename is kept, some stamp paths pick their format from it
+        return os.path.join(self.scratch_dir, '{}_{:06d}'.format(kind, index), os.path.basename(path))
+
+    def _reserve(self, tasks):
+        # budget is taken in task order, a later input can never hold the bytes an earlier one waits for
+        for index, kwargs in tasks:
+            size = get_size(kwargs['input_path'])
+            if not self.read_budget.acquire(size):
+                return
+            yield index, kwargs, size
+
+    def _fetch(self, args):
+        # a file that can't go through scratch is read or written where it is, the task itself never fails here
+        index, kwargs, size = args
+        kwargs = dict(kwargs)
+        scratch_input = self.get_scratch_path('in', index, kwargs['input_path'])
+        try:
+            os.makedirs(os.path.dirname(scratch_input))
+            shutil.copyfile(kwargs['input_path'], scratch_input)
+            kwargs['input_path'] = scratch_input
+        except (IOError, OSError) as e:
+            logger.warning('Read-ahead failed, reading from source: {} ({})'.format(kwargs['input_path'], e))
+            scratch_input = None
+        self._inputs[index] = (scratch_input, size)
+        self._outputs[index] = kwargs['output_path']
+        scratch_output = self.get_scratch_path('out', index, kwargs['output_path'])
+        try:
+            os.makedirs(os.path.dirname(scratch_output))
+            kwargs['output_path'] = scratch_output
+        except (IOError, OSError) as e:
+            logger.warning('Write-behind failed, writing to destination: {} ({})'.format(kwargs['output_path'], e))
+        return index, kwargs
+
+    def prefetch(self, tasks):
+        # tasks in order with their input on scratch, waits while read_ahead bytes are ahead of the workers
+        return self.read_pool.imap(self._fetch, self._reserve(tasks))
+
+    def computed(self, index):
+        # the worker is done with the scratch input, free its read-ahead
+        scratch_input, size = self._inputs.pop(index, (None, 0))
+        if scratch_input:
+            shutil.rmtree(os.path.dirname(scratch_input), ignore_errors=True)
+        self.read_budget.release(size)
+
+    def write(self, index, result, wait=True):
+        # queue the move of the scratch output, waits while write_behind bytes are not written yet
+        self.computed(index)
+        output_path = self._outputs.pop(index)
+        scratch_output = self.get_scratch_path('out', index, output_path)
+        size = get_size(scratch_output)
+        self.write_budget.acquire(size, wait=wait)
+        self._num_writing += 1
+        self.write_pool.apply_async(self._flush, ((index, result, scratch_output, output_path, size), ))
+
+    def _flush(self, args):
+        index, result, scratch_output, output_path, size = args
+        try:
+            if os.path.exists(scratch_output):
+                # copied next to the destination first, the rename over it is what makes it visible
+                partial_path = recovery.get_partial_path(output_path)
+                try:
+                    shutil.move(scratch_output, partial_path)
+                    recovery.replace(partial_path, output_path)
+                finally:
+                    if os.path.exists(partial_path):
+                        os.remove(partial_path)
+            if result == scratch_output:
+                result = output_path
+            self._written.put((index, result, None))
+        except Exception as e:
+            self._written.put((index, None, e))
+        finally:
+            self.write_budget.release(size)
+            shutil.rmtree(os.path.dirname(scratch_output), ignore_errors=True)
+
+    def is_full(self):
+        # write_behind bytes are waiting to be moved, no more outputs should be made for now
+        return self.write_budget.is_full()
+
+    def is_writing(self):
+        return self._num_writing > 0
+
+    def iter_written(self, wait=False):
+        # (index, result, error) of outputs already at their destination or that failed to get there,
+        # with wait until all of them are
+        while self._num_writing:
+            try:
+                index, result, error = self._written.get(timeout=WAIT_INTERVAL) if wait else self._written.get_nowait()
+            except queue.Empty:
+                if wait:
+                    continue
+                return
+            self._num_writing -= 1
+            yield index, result, error
+
+    def close(self):
+        self.read_budget.close()
+        self.write_budget.close()
+        self.read_pool.terminate()
+        self.read_pool.join()
+        self.write_pool.close()
+        self.write_pool.join()
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Preview of the stamped result, rendered on a small proxy of the input so it can follow the sliders.
+# Proxies (first frame of a video or a sequence, first page of a pdf) are decoded once and kept
+# in a least recently used cache keyed by path and mtime, the overlay for the proxy size
+# comes from the overlay cache of this process.
+# Kept free of any Qt import, the UI renders on its own thread.
+
+import os
+import logging
+import threading
+import subprocess
+from collections import OrderedDict
+
+import overlay
+import composite
+import intake
+import video
+import pdf
+
+logger = logging.getLogger(__name__)
+
+PROXY_SIZE = 640  # longest side of a proxy
+PROXY_CACHE_SIZE = 32  # number of proxies kept
+
+
+def get_source_path(entry):
+    # first frame of a sequence, the file itself otherwise
+    return next(intake.iter_paths(entry))
+
+
+def load_still(path, size):
+    image = overlay.Image.open(path)
+    full_size = image.size
+    image.draft('RGB', (size, size))  # jpeg decodes straight to a smaller scale
+    image.thumbnail((size, size), overlay.Image.BILINEAR)
+    return image, full_size
+
+
+def load_video_frame(path, size):
+    info = video.probe(path)
+    width, height = overlay.get_limited_size((info['width'], info['height']), size)
+    cmd = [video.FFMPEG, '-v', 'error', '-i', path, '-frames:v', '1',
+        '-vf', 'scale={}:{}'.format(width, height), '-pix_fmt', 'rgb24', '-f', 'rawvideo', 'pipe:1']
+    data = subprocess.check_output(cmd)
+    return overlay.Image.frombytes('RGB', (width, height), data), (info['width'], info['height'])
+
+
+def load_pdf_page(path, size):
+    doc = pdf.fitz.open(path)
+    try:
+        rect = doc[0].rect
+        image = pdf.page_to_image(doc[0], size / float(max(rect.width, rect.height)))
+    finally:
+        doc.close()
+    return image, pdf.get_pixel_size(rect, pdf.OVERLAY_DPI)
+
+
+def load_proxy(entry, size=PROXY_SIZE):
+    # (proxy image, full resolution size) of an entry
+    path = get_source_path(entry)
+    if video.is_video(path):
+        image, full_size = load_video_frame(path, size)
+    elif pdf.can_stamp(path):
+        image, full_size = load_pdf_page(path, size)
+    else:
+        image, full_size = load_still(path, size)
+    if image.mode not in overlay.STILL_MODES:
+        image = image.convert('RGB')
+    return image, full_size
+
+
+# Least recently used cache of proxies, a file changed on disk gets a new proxy.
+# Shared by the render thread and whoever warms it, loading happens outside of the lock.
+class ProxyCache(object):
+    def __init__(self, maxsize=PROXY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.proxies = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, entry):
+        key = (entry, os.path.getmtime(get_source_path(entry)))
+        with self._lock:
+            if key in self.proxies:
+                proxy = self.proxies.pop(key)
+                self.proxies[key] = proxy
+                return proxy
+        proxy = load_proxy(entry)
+        with self._lock:
+            self.proxies[key] = proxy
+            while len(self.proxies) > self.maxsize:
+                self.proxies.popitem(last=False)
+        return proxy
+
+    def clear(self):
+        with self._lock:
+            self.proxies.clear()
+
+
+def get_opacity(image, opacity):
+    # auto opacity from the proxy, close to what the full resolution gets
+    if not isinstance(opacity, (tuple, list)):
+        return opacity
+    if composite.is_available():
+        return overlay.get_auto_opacity(composite.mean_luminance(composite.np.asarray(image)), opacity)
+    return overlay.auto_opacity(image, opacity)
+
+
+def get_output_size(entry, full_size, resize=None):
+    # size the stamp would write, pdf pages keep their size
+    if pdf.can_stamp(get_source_path(entry)):
+        return full_size
+    return overlay.get_limited_size(full_size, resize)
+
+
+def render(image, overlay_path, text, opacity, blend_mode=composite.DEFAULT_BLEND_MODE, still=True):
+    # stamped copy of a proxy, returns (RGB image, opacity used).
+    # videos and pdf are composited in normal mode only, like the real stamp
+    opacity = get_opacity(image, opacity)
+    if still and composite.is_available():
+        result = overlay.composite_image(image, overlay_path, text, opacity, blend_mode)
+    else:
+        result = overlay.get_prepared_overlay(overlay_path, text, opacity, image.size).composite(image)
+    if result.mode != 'RGB':
+        result = result.convert('RGB')
+    return result, opacity
+
+
+def render_entry(cache, entry, overlay_path, text, opacity, resize=None, blend_mode=composite.DEFAULT_BLEND_MODE):
+    # (stamped proxy, opacity used, full resolution size, output size) of an entry
+    image, full_size = cache.get(entry)
+    still = overlay.is_still(get_source_path(entry))
+    result, opacity = render(image, overlay_path, text, opacity, blend_mode=blend_mode, still=still)
+    return result, opacity, full_size, get_output_size(entry, full_size, resize)
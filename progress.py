@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Progress stream, job events coalesced and published at a fixed rate with throughput and ETA.
+# Workers report every file and every few frames, consumers (UI, daemon clients, CLI log) get at most
+# one snapshot per job every 1 / rate sec, the latest state wins, the finished one is never dropped.
+# Snapshots are plain dicts so they can be sent as json as they are.
+# Kept free of any Qt import, callback_func is called from the publisher thread.
+
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+PUBLISH_RATE = 20.0  # snapshots per second per consumer, at most
+RATE_WINDOW = 10.0  # sec of recent progress the throughput is measured over
+FINAL_STATES = ('done', 'cancelled', 'failed')  # jobs.DONE, CANCELLED and FAILED
+
+
+def get_job_fields(job, event=None):
+    # snapshot fields of a jobs.Job, read from any thread
+    return {'job': job.id,
+            'event': event,
+            'name': job.name,
+            'state': job.state,
+            'done': job.num_done,
+            'total': job.num_files,
+            'skipped': job.num_skipped,
+            'errors': len(job.errors),
+            'done_cost': job.done_cost,
+            'total_cost': job.total_cost,
+            'progress': round(job.get_progress(), 4),
+            'sub': job.sub_progress,
+            'waiting_memory': job.waiting_memory,
+            'last_file': job.last_file,
+            'time': job.get_time_taken()}
+
+
+def format_eta(sec):
+    if sec is None:
+        return '--:--'
+    minutes, sec = divmod(int(sec + 0.5), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, sec) if hours else '{:02d}:{:02d}'.format(minutes, sec)
+
+
+def format_snapshot(snapshot):
+    # one log line, (12/480, 3%, 4.2 files/s, ETA 01:52) last output
+    text = '({}/{}, {:.0%}, {:.1f} files/s, ETA {})'.format(snapshot.get('done', 0), snapshot.get('total', 0), snapshot['progress'],
+                                                           snapshot['files_per_sec'], format_eta(snapshot['eta']))
+    if snapshot.get('waiting_memory'):
+        text += ' waiting for memory'
+    if snapshot.get('last_file'):
+        text += ' {}'.format(snapshot['last_file'][1])
+    return text
+
+
+# Throughput of one job over the last RATE_WINDOW sec, sampled at publish time.
+class RateMeter(object):
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self.samples = deque()  # (time, files done, cost done)
+
+    def add(self, now, done, done_cost):
+        self.samples.append((now, done, done_cost))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= self.window:
+            self.samples.popleft()
+
+    def get_rates(self):
+        # (files per sec, cost per sec) over the window, zeros until there is time between samples
+        if len(self.samples) < 2:
+            return 0.0, 0.0
+        start_time, start_done, start_cost = self.samples[0]
+        end_time, end_done, end_cost = self.samples[-1]
+        elapsed = end_time - start_time
+        if elapsed <= 0:
+            return 0.0, 0.0
+        return (end_done - start_done) / elapsed, (end_cost - start_cost) / elapsed
+
+
+# Coalesces updates of any number of jobs, keyed by job id, and publishes them from its own thread.
+# update() takes snapshot fields from any producer, job_event() is a JobQueue callback_func.
+class ProgressStream(object):
+    def __init__(self, callback_func, rate=PUBLISH_RATE):
+        self.callback_func = callback_func
+        self.interval = 1.0 / rate
+        self._fields = {}  # key -> latest fields, published or not
+        self._dirty = OrderedDict()  # keys with fields not published yet
+        self._meters = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._closed = False
+
+    def update(self, key, **fields):
+        with self._lock:
+            self._fields.setdefault(key, {}).update(fields)
+            self._dirty[key] = True
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, name='ProgressStream')
+                self._thread.daemon = True
+                self._thread.start()
+        self._wake.set()
+
+    def job_event(self, job, event):
+        self.update(job.id, **get_job_fields(job, event))
+
+    def flush(self):
+        # publish what is pending now, from the calling thread
+        self._publish(time.time())
+
+    def close(self):
+        # pending updates are published before it returns
+        self._closed = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait()
+            self._wake.clear()
+            if self._closed:
+                break
+            start = time.time()
+            self._publish(start)
+            # the rest of the slot, updates in the meantime wait for the next one
+            time.sleep(max(0.0, self.interval - (time.time() - start)))
+
+    def _publish(self, now):
+        with self._lock:
+            keys = list(self._dirty)
+            self._dirty.clear()
+            snapshots = [self._get_snapshot(key, now) for key in keys]
+        for snapshot in snapshots:
+            try:
+                self.callback_func(snapshot)
+            except Exception:
+                logger.exception('Progress consumer failed')
+
+    def _get_snapshot(self, key, now):
+        snapshot = dict(self._fields[key])
+        done = snapshot.get('done', 0)
+        total = snapshot.get('total', 0)
+        done_cost = snapshot.get('done_cost', 0.0)
+        total_cost = snapshot.get('total_cost', 0.0)
+        meter = self._meters.setdefault(key, RateMeter())
+        meter.add(now, done, done_cost)
+        files_per_sec, cost_per_sec = meter.get_rates()
+        if total_cost:
+            progress = min(1.0, done_cost / total_cost)
+            eta = (total_cost - done_cost) / cost_per_sec if cost_per_sec else None
+        else:
+            progress = done / float(max(total, 1))
+            eta = (total - done) / files_per_sec if files_per_sec else None
+        snapshot['progress'] = round(progress, 4)
+        snapshot['files_per_sec'] = round(files_per_sec, 2)
+        snapshot['eta'] = None if eta is None else round(max(0.0, eta), 1)
+        if snapshot.get('state') in FINAL_STATES:
+            snapshot['eta'] = 0.0
+            del self._fields[key]
+            del self._meters[key]
+        return snapshot
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Crash recovery, what a stamp leaves behind when its process dies or its job is cancelled.
+# Temp dirs and partial outputs carry the host and pid of the process that made them, so the ones
+# of a dead process can be told from the ones still in use and removed on the next start.
+# Outputs are written to a partial file next to them and renamed into place when complete,
+# an output is either the old one, the new one or missing, never half written.
+# Job checkpoints remember the settings of every unfinished job, the job manifest remembers
+# the files already stamped, together a job resumes where it left off.
+# Kept free of the stamping backends, the UI reads checkpoints before they are loaded.
+
+import sys
+import os
+import re
+import json
+import time
+import errno
+import shutil
+import socket
+import logging
+import tempfile
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+TEMP_PREFIX = 'watermarkr_'
+PARTIAL_TAG = 'partial'
+CHECKPOINT_DIR = os.environ.get('WATERMARKR_CHECKPOINT_DIR') or os.path.join(os.path.expanduser('~'), '.watermarkr', 'checkpoints')
+CHECKPOINT_VERSION = 1
+STALE_AGE = 24 * 3600.0  # sec, temp of another host or of a process that can't be checked is removed after this
+CHECKPOINT_INTERVAL = 30.0  # sec between touches of the checkpoint of a running job, tells it is alive when the pid can't
+HOST = re.sub(r'[^A-Za-z0-9-]', '-', socket.gethostname())  # no dots or underscores, they separate the name parts
+
+OWNER_RE = re.compile(r'^(?P<host>[A-Za-z0-9-]+)_(?P<pid>\d+)$')
+TEMP_RE = re.compile(r'^{}(?P<kind>[a-z]+)_(?P<owner>[A-Za-z0-9-]+_\d+)\.'.format(TEMP_PREFIX))
+PARTIAL_RE = re.compile(r'^\.(?P<name>.*)\.(?P<owner>[A-Za-z0-9-]+_\d+)\.{}(\.[^.]*)?$'.format(PARTIAL_TAG))
+
+
+def get_owner():
+    # host_pid of this process
+    return '{}_{}'.format(HOST, os.getpid())
+
+
+def parse_owner(owner):
+    match = OWNER_RE.match(owner)
+    if not match:
+        return None
+    return match.group('host'), int(match.group('pid'))
+
+
+def is_running(pid):
+    # None when it can't be told, os.kill would terminate the process on Windows
+    if pid == os.getpid():
+        return True
+    if psutil is not None:
+        return psutil.pid_exists(pid)
+    if sys.platform == 'win32':
+        return None
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def is_stale(owner, mtime):
+    # left behind by a process that is gone, anything too old or without an owner counts as gone too
+    if time.time() - mtime > STALE_AGE:
+        return True
+    parsed = parse_owner(owner) if owner else None
+    if parsed is None or parsed[0] != HOST:
+        return False
+    return is_running(parsed[1]) is False
+
+
+def mkdtemp(kind, dir=None):
+    # temp dir of this process, e.g. watermarkr_video_host_1234.xyz
+    return tempfile.mkdtemp(prefix='{}{}_{}.'.format(TEMP_PREFIX, kind, get_owner()), dir=dir)
+
+
+def cleanup_temp(temp_dir=None):
+    # removes the temp dirs of dead processes, returns how many
+    temp_dir = temp_dir or tempfile.gettempdir()
+    try:
+        names = os.listdir(temp_dir)
+    except OSError:
+        return 0
+    num_removed = 0
+    for name in names:
+        if not name.startswith(TEMP_PREFIX):
+            continue
+        path = os.path.join(temp_dir, name)
+        match = TEMP_RE.match(name)
+        try:
+            if not os.path.isdir(path) or not is_stale(match and match.group('owner'), os.path.getmtime(path)):
+                continue
+        except OSError:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        if not os.path.exists(path):
+            num_removed += 1
+    if num_removed:
+        logger.info('Removed {} temp folders left by a previous run'.format(num_removed))
+    return num_removed
+
+
+def get_partial_path(output_path):
+    # hidden file next to the output with the same extension, the encoders pick the format from it
+    directory, filename = os.path.split(output_path)
+    name, ext = os.path.splitext(filename)
+    return os.path.join(directory, '.{}.{}.{}{}'.format(name, get_owner(), PARTIAL_TAG, ext))
+
+
+def get_output_path(path):
+    # output a partial file is written for, any other path as it is
+    directory, filename = os.path.split(path)
+    match = PARTIAL_RE.match(filename)
+    if not match:
+        return path
+    return os.path.join(directory, '{}{}'.format(match.group('name'), match.group(3) or ''))
+
+
+def replace(source_path, path):
+    # rename over an existing file, windows doesn't do it in one go
+    try:
+        os.rename(source_path, path)
+    except OSError:
+        if not os.path.exists(path):
+            raise
+        os.remove(path)
+        os.rename(source_path, path)
+
+
+def remove_partials(directory):
+    # partial outputs of dead processes in an output folder, returns how many were removed
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return 0
+    num_removed = 0
+    for name in names:
+        match = PARTIAL_RE.match(name)
+        if not match:
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if is_stale(match.group('owner'), os.path.getmtime(path)):
+                os.remove(path)
+                num_removed += 1
+        except OSError:
+            continue
+    if num_removed:
+        logger.info('Removed {} partial outputs left in {}'.format(num_removed, directory))
+    return num_removed
+
+
+def get_checkpoint_path(key):
+    return os.path.join(CHECKPOINT_DIR, '{}_{}.json'.format(get_owner(), key))
+
+
+def write_checkpoint(path, data):
+    # written aside then renamed, a crash while saving keeps the previous one
+    if not os.path.exists(CHECKPOINT_DIR):
+        try:
+            os.makedirs(CHECKPOINT_DIR)
+        except OSError:
+            if not os.path.isdir(CHECKPOINT_DIR):
+                raise
+    data = dict(data, version=CHECKPOINT_VERSION, saved=time.time())
+    temp_path = '{}.tmp'.format(path)
+    with open(temp_path, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    replace(temp_path, path)
+
+
+def touch_checkpoint(path):
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+def remove_checkpoint(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def get_checkpoint_owner(path):
+    # host_pid part of host_pid_key.json
+    return os.path.basename(path).rsplit('_', 1)[0]
+
+
+def list_checkpoints():
+    # [(path, data)] of jobs that didn't finish, oldest first, the ones of running processes are left out
+    try:
+        names = sorted(os.listdir(CHECKPOINT_DIR))
+    except OSError:
+        return []
+    checkpoints = []
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(CHECKPOINT_DIR, name)
+        parsed = parse_owner(get_checkpoint_owner(path))
+        if parsed is None or parsed[0] != HOST:
+            continue  # jobs of other machines resume there
+        try:
+            running = is_running(parsed[1])
+            if running or (running is None and time.time() - os.path.getmtime(path) < CHECKPOINT_INTERVAL * 3):
+                continue
+            with open(path, 'r') as f:
+                text = f.read()
+        except (IOError, OSError) as e:
+            if not os.path.exists(path):
+                continue  # claimed by another process meanwhile
+            logger.warning('Unreadable checkpoint, removed: {} ({})'.format(path, e))
+            remove_checkpoint(path)
+            continue
+        try:
+            data = json.loads(text)
+        except ValueError as e:
+            logger.warning('Corrupted checkpoint, removed: {} ({})'.format(path, e))
+            remove_checkpoint(path)
+            continue
+        if data.get('version') != CHECKPOINT_VERSION:
+            continue
+        checkpoints.append((path, data))
+    checkpoints.sort(key=lambda checkpoint: checkpoint[1].get('saved', 0))
+    return checkpoints
+
+
+def claim_checkpoint(path):
+    # renamed to this process, returns the new path or None if another process was faster
+    owner, key = os.path.splitext(os.path.basename(path))[0].rsplit('_', 1)
+    claimed_path = get_checkpoint_path('{}-{}'.format(parse_owner(owner)[1], key))
+    try:
+        os.rename(path, claimed_path)
+    except OSError:
+        return None
+    return claimed_path
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Job report, wall time, CPU time, bytes, pixels/frames and peak RSS of every stamped file and its stages.
+# Stamping code wraps its stages in report.stage(), which only records while a file is tracked
+# by report.track() in the same process, so the stamp functions work the same without a report.
+# peak_rss is sampled while the file is stamped (psutil), process_peak_rss is the peak of the whole
+# worker process so far, which a big file stamped earlier by the same worker keeps high.
+
+import sys
+import os
+import csv
+import json
+import time
+import logging
+import threading
+import cProfile
+import pstats
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('read', 'copy', 'resize', 'composite', 'encode', 'write')  # stage columns of the csv, in order
+COUNTS = ('bytes_read', 'bytes_written', 'pixels', 'frames')
+REPORT_NAME = '.watermarkr_report'  # .json and .csv written next to the outputs
+PROFILE_LINES = 25  # lines of profile stats logged
+RSS_INTERVAL = 0.05  # sec between samples of the resident memory of a tracked file
+
+# record of the file being stamped in this process, set by track()
+_current = None
+
+
+def get_cpu_time():
+    # user + system time of this process and its finished children (ffmpeg)
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+def get_peak_rss():
+    # peak resident memory of this process since it started in bytes, None if it can't be read
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss)
+    return None
+
+
+# Peak resident memory of this process while one file is stamped, sampled on a thread.
+class RssSampler(object):
+    def __init__(self, interval=RSS_INTERVAL):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak = self.process.memory_info().rss
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='RssSampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.process.memory_info().rss)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+        return self.peak
+
+
+def get_size(path):
+    return os.path.getsize(path) if path and os.path.isfile(path) else 0
+
+
+class FileRecord(object):
+    def __init__(self, input_path, output_path):
+        self.input_path = input_path
+        self.output_path = output_path
+        self.status = 'done'
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.peak_rss = None  # while this file was stamped, None without psutil
+        self.process_peak_rss = None
+        self.input_hash = None  # full content hash, only when the job manifest needs it
+        self.counts = OrderedDict((key, 0) for key in COUNTS)
+        self.stages = OrderedDict()  # name -> {'wall', 'cpu', counts...}
+
+    def add_stage(self, name, wall, cpu, counts):
+        # a stage can run more than once per file (segments, pages), times add up
+        stage = self.stages.setdefault(name, OrderedDict([('wall', 0.0), ('cpu', 0.0)]))
+        stage['wall'] += wall
+        stage['cpu'] += cpu
+        for key, value in counts.items():
+            stage[key] = stage.get(key, 0) + value
+            if key in self.counts:
+                self.counts[key] += value
+
+    def to_dict(self):
+        data = OrderedDict([('input', self.input_path),
+                            ('output', self.output_path),
+                            ('status', self.status),
+                            ('wall', round(self.wall, 4)),
+                            ('cpu', round(self.cpu, 4)),
+                            ('peak_rss', self.peak_rss),
+                            ('process_peak_rss', self.process_peak_rss)])
+        if self.input_hash:
+            data['input_hash'] = self.input_hash
+        data.update(self.counts)
+        data['stages'] = OrderedDict((name, OrderedDict((k, round(v, 4) if isinstance(v, float) else v)
+                                                        for k, v in stage.items()))
+                                    for name, stage in self.stages.items())
+        return data
+
+
+@contextmanager
+def track(input_path, output_path):
+    # record a whole file, bytes read and written default to the file sizes
+    # when no stage counted them
+    global _current
+    record = FileRecord(input_path, output_path)
+    previous = _current
+    _current = record
+    sampler = RssSampler() if psutil is not None else None
+    start_wall = time.time()
+    start_cpu = get_cpu_time()
+    try:
+        yield record
+    except Exception:
+        record.status = 'error'
+        raise
+    finally:
+        _current = previous
+        record.wall = time.time() - start_wall
+        record.cpu = get_cpu_time() - start_cpu
+        if sampler is not None:
+            record.peak_rss = sampler.stop()
+        record.process_peak_rss = get_peak_rss()
+        if not record.counts['bytes_read']:
+            record.counts['bytes_read'] = get_size(input_path)
+        if not record.counts['bytes_written']:
+            record.counts['bytes_written'] = get_size(output_path)
+
+
+@contextmanager
+def stage(name, **counts):
+    # time a stage of the tracked file, the yielded dict takes counts known only inside the stage,
+    # e.g. counts['pixels'] = width * height
+    counts = dict(counts)
+    record = _current
+    if record is None:
+        yield counts
+        return
+    start_wall = time.time()
+    start_cpu = get_cpu_time()
+    try:
+        yield counts
+    finally:
+        record.add_stage(name, time.time() - start_wall, get_cpu_time() - start_cpu, counts)
+
+
+def format_bytes(num_bytes):
+    return '{:.1f} MB'.format((num_bytes or 0) / 1048576.0)
+
+
+class JobReport(object):
+    def __init__(self):
+        self.records = []  # FileRecord.to_dict() of every stamped file
+        self.num_skipped = 0
+        self.num_linked = 0  # identical inputs linked to a stamped output instead of stamped again
+        self.saved_wall = 0.0  # worker time those would have taken
+        self.saved_bytes = 0  # input bytes they didn't read
+        self._by_output = {}  # output path -> record
+        self.start_time = time.time()
+        self.end_time = None
+
+    def add(self, record):
+        self.records.append(record)
+        self._by_output[record['output']] = record
+
+    def add_duplicate(self, files, source_path):
+        # (input, output) linked to the output at source_path, saved work is what stamping that one took
+        source = self._by_output.get(source_path)
+        record = FileRecord(*files)
+        record.status = 'linked'
+        data = record.to_dict()
+        data['source'] = source_path
+        self.records.append(data)
+        self.num_linked += 1
+        if source is not None:
+            self.saved_wall += source['wall']
+            self.saved_bytes += source['bytes_read']
+
+    def finish(self):
+        self.end_time = time.time()
+
+    def get_summary(self):
+        wall = (self.end_time or time.time()) - self.start_time
+        summary = OrderedDict([('files', len(self.records)),
+                               ('skipped', self.num_skipped),
+                               ('errors', sum(1 for r in self.records if r['status'] == 'error')),
+                               ('linked', self.num_linked),
+                               ('saved_wall', round(self.saved_wall, 4)),
+                               ('saved_bytes', self.saved_bytes),
+                               ('wall', round(wall, 4)),
+                               ('cpu', round(sum(r['cpu'] for r in self.records), 4))])
+        for key in COUNTS:
+            summary[key] = sum(r[key] for r in self.records)
+        for key in ('peak_rss', 'process_peak_rss'):
+            peaks = [r.get(key) for r in self.records if r.get(key)]
+            summary[key] = max(peaks) if peaks else None
+        stages = OrderedDict()
+        for record in self.records:
+            for name, values in record['stages'].items():
+                stages[name] = round(stages.get(name, 0.0) + values['wall'], 4)
+        summary['stage_wall'] = stages
+        return summary
+
+    def log(self, log=None):
+        log = log or logger
+        for record in self.records:
+            stages = ', '.join('{} {:.3f}s'.format(name, values['wall']) for name, values in record['stages'].items())
+            log.debug('{} - wall {:.3f}s, cpu {:.3f}s, read {}, written {}, peak rss {} ({})'.format(
+                record['output'], record['wall'], record['cpu'], format_bytes(record['bytes_read']),
+                format_bytes(record['bytes_written']), format_bytes(record['peak_rss']), stages))
+        summary = self.get_summary()
+        stages = ', '.join('{} {:.3f}s'.format(name, wall) for name, wall in summary['stage_wall'].items())
+        log.info('Report: {} files ({} skipped, {} errors) in {:.3f}s, cpu {:.3f}s, read {}, written {} ({})'.format(
+            summary['files'], summary['skipped'], summary['errors'], summary['wall'], summary['cpu'],
+            format_bytes(summary['bytes_read']), format_bytes(summary['bytes_written']), stages))
+        if summary['linked']:
+            log.info('Dedup: {} identical files linked, saved {:.3f}s of stamping and {} read'.format(
+                summary['linked'], summary['saved_wall'], format_bytes(summary['saved_bytes'])))
+
+    def write(self, output_dir):
+        # json with every stage, csv with one row per file, returns both paths
+        base_path = '{}/{}'.format(output_dir, REPORT_NAME)
+        json_path = '{}.json'.format(base_path)
+        csv_path = '{}.csv'.format(base_path)
+        with open(json_path, 'w') as f:
+            json.dump(OrderedDict([('summary', self.get_summary()), ('files', self.records)]), f, indent=1)
+
+        columns = ['input', 'output', 'status', 'wall', 'cpu', 'peak_rss', 'process_peak_rss'] + list(COUNTS)
+        columns += ['{}_wall'.format(name) for name in STAGES]
+        mode = 'wb' if sys.version_info[0] < 3 else 'w'
+        kwargs = {} if sys.version_info[0] < 3 else {'newline': ''}
+        with open(csv_path, mode, **kwargs) as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for record in self.records:
+                row = [record.get(key) for key in columns[:7 + len(COUNTS)]]
+                row += [record['stages'].get(name, {}).get('wall', '') for name in STAGES]
+                writer.writerow(row)
+        return json_path, csv_path
+
+
+def profile(func, profile_path, *args, **kwargs):
+    # run func under cProfile, dump the stats to profile_path and log the slowest calls
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        profiler.dump_stats(profile_path)
+        stats = pstats.Stats(profile_path)
+        stats.sort_stats('cumulative')
+        logger.info('Profile written to {}'.format(profile_path))
+        stats.print_stats(PROFILE_LINES)
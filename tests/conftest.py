@@ -0,0 +1,11 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The modules import each other by name (import engine), like python -m watermarkr runs them.
+
+import os
+import sys
+
+moduleDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if moduleDir not in sys.path:
+    sys.path.insert(0, moduleDir)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import cost
+import overlay
+
+
+@pytest.fixture
+def plates(tmpdir):
+    # frames of one sequence name at two resolutions
+    if not overlay.is_available():
+        pytest.skip('PIL not available')
+    paths = []
+    for frame, size in ((1, (64, 32)), (2, (1024, 512))):
+        path = str(tmpdir.join('plate_{}.tif'.format(frame)))
+        overlay.Image.new('RGB', size).save(path)
+        paths.append(path)
+    cost._probes.clear()
+    cost._sequence_infos.clear()
+    return paths
+
+
+def test_frames_of_other_resolution_are_probed(plates):
+    small, large = [cost.probe(path) for path in plates]
+    assert (small['width'], small['height']) == (64, 32)
+    assert (large['width'], large['height']) == (1024, 512)
+    assert cost.estimate_memory(plates[1]) > cost.estimate_memory(plates[0])
+
+
+def test_probe_cache_is_bounded():
+    cache = cost.ProbeCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert len(cache.items) == 2
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+
+import intake
+
+FORMATS = ('.jpg', '.tif')
+
+
+def touch(directory, names):
+    if not directory.check():
+        directory.ensure(dir=True)
+    for name in names:
+        directory.join(name).write('')
+
+
+def scan(tmpdir):
+    return [(entry.replace(str(tmpdir).replace('\\', '/'), ''), rel_dir) for entry, rel_dir in intake.scan([str(tmpdir)], FORMATS)]
+
+
+def test_padded_sequence(tmpdir):
+    touch(tmpdir, ['shot_{:04d}.jpg'.format(frame) for frame in list(range(1001, 1051)) + list(range(1052, 1101))])
+    assert scan(tmpdir) == [('/shot_####.jpg [1001-1050,1052-1100]', tmpdir.basename)]
+
+
+def test_unpadded_sequence_is_one_entry(tmpdir):
+    touch(tmpdir, ['f_{}.jpg'.format(frame) for frame in range(8, 101)])
+    assert scan(tmpdir) == [('/f_#.jpg [8-100]', tmpdir.basename)]
+
+
+def test_padding_overflow_is_one_entry(tmpdir):
+    touch(tmpdir, ['x_098.jpg', 'x_099.jpg', 'x_100.jpg', 'x_1000.jpg'])
+    assert scan(tmpdir) == [('/x_###.jpg [98-100,1000]', tmpdir.basename)]
+
+
+def test_versions_stay_files(tmpdir):
+    touch(tmpdir, ['render_v001.jpg', 'render_v002.jpg'])
+    assert [entry for entry, rel_dir in scan(tmpdir)] == ['/render_v001.jpg', '/render_v002.jpg']
+
+
+def test_single_numbered_file_and_other_formats(tmpdir):
+    touch(tmpdir, ['plate_1.jpg', 'plate_1.tif', 'plate_2.tif', 'notes_1.txt', 'notes_2.txt'])
+    assert [entry for entry, rel_dir in scan(tmpdir)] == ['/plate_#.tif [1-2]', '/plate_1.jpg']
+
+
+def test_mixed_padding_splits(tmpdir):
+    touch(tmpdir, ['y_1.jpg', 'y_2.jpg', 'y_01.jpg', 'y_02.jpg'])
+    assert [entry for entry, rel_dir in scan(tmpdir)] == ['/y_#.jpg [1-2]', '/y_##.jpg [1-2]']
+
+
+def test_sub_folders_keep_structure(tmpdir):
+    touch(tmpdir.join('a'), ['s.1.jpg', 's.2.jpg'])
+    touch(tmpdir.join('b'), ['one.jpg'])
+    assert scan(tmpdir) == [('/a/s.#.jpg [1-2]', '{}/a'.format(tmpdir.basename)),
+                            ('/b/one.jpg', '{}/b'.format(tmpdir.basename))]
+
+
+def test_entries_expand_to_their_files(tmpdir):
+    names = ['f_{}.jpg'.format(frame) for frame in range(8, 101)] + ['x_098.jpg', 'x_099.jpg', 'x_100.jpg', 'x_1000.jpg']
+    touch(tmpdir.join('shots#2'), names)
+    paths = []
+    for entry, rel_dir in intake.scan([str(tmpdir)], FORMATS):
+        assert intake.count(entry) == len(list(intake.iter_paths(entry)))
+        paths += intake.iter_paths(entry)
+    assert sorted(os.path.basename(path) for path in paths) == sorted(names)
+    assert all(os.path.isfile(path) for path in paths)
+
+
+def test_ranges_round_trip():
+    frames = [1, 2, 3, 5, 7, 8]
+    text = intake.format_ranges(frames)
+    assert text == '1-3,5,7-8'
+    assert intake.parse_ranges(text) == [(1, 3), (5, 5), (7, 8)]
+
+
+def test_file_entry():
+    assert not intake.is_sequence('/a/b.jpg')
+    assert list(intake.iter_paths('/a/b.jpg')) == ['/a/b.jpg']
+    assert intake.count('/a/b.jpg') == 1
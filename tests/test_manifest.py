@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+import manifest
+
+PARAMS = manifest.get_params('Vendor - Comp', 'missing_overlay.png', 0.1, None)
+
+
+@pytest.fixture
+def stamped(tmpdir):
+    # an input stamped once, with its output and saved manifest
+    input_path = str(tmpdir.join('input.tif'))
+    output_dir = tmpdir.join('out').ensure(dir=True)
+    output_path = str(output_dir.join('input.tif'))
+    with open(input_path, 'wb') as f:
+        f.write(b'a' * 4096)
+    with open(output_path, 'wb') as f:
+        f.write(b'stamped')
+    job_manifest = manifest.JobManifest(str(output_dir))
+    job_manifest.update(input_path, output_path, PARAMS)
+    job_manifest.save()
+    return input_path, output_path, str(output_dir)
+
+
+def set_mtime(path, offset):
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + offset))
+
+
+def test_up_to_date_after_reload(stamped):
+    input_path, output_path, output_dir = stamped
+    assert manifest.JobManifest(output_dir).is_up_to_date(input_path, output_path, PARAMS)
+
+
+def test_other_params(stamped):
+    input_path, output_path, output_dir = stamped
+    params = manifest.get_params('Vendor - Comp', 'missing_overlay.png', 0.2, None)
+    assert not manifest.JobManifest(output_dir).is_up_to_date(input_path, output_path, params)
+
+
+def test_missing_or_changed_output(stamped):
+    input_path, output_path, output_dir = stamped
+    with open(output_path, 'wb') as f:
+        f.write(b'half')
+    assert not manifest.JobManifest(output_dir).is_up_to_date(input_path, output_path, PARAMS)
+    os.remove(output_path)
+    assert not manifest.JobManifest(output_dir).is_up_to_date(input_path, output_path, PARAMS)
+
+
+def test_touched_input_is_up_to_date(stamped):
+    input_path, output_path, output_dir = stamped
+    set_mtime(input_path, 10)
+    job_manifest = manifest.JobManifest(output_dir)
+    assert job_manifest.is_up_to_date(input_path, output_path, PARAMS)
+    # the new mtime is remembered, the next check doesn't read the file again
+    job_manifest.save()
+    entry = manifest.JobManifest(output_dir).entries['input.tif']
+    assert entry['mtime'] == os.stat(input_path).st_mtime
+
+
+def test_edit_of_same_size_is_found(stamped):
+    input_path, output_path, output_dir = stamped
+    with open(input_path, 'r+b') as f:
+        f.seek(2048)
+        f.write(b'b')
+    set_mtime(input_path, 10)
+    assert not manifest.JobManifest(output_dir).is_up_to_date(input_path, output_path, PARAMS)
+
+
+def test_content_hash_is_stored(stamped):
+    input_path, output_path, output_dir = stamped
+    job_manifest = manifest.JobManifest(output_dir)
+    job_manifest.update(input_path, output_path, PARAMS, content_hash='given')
+    assert job_manifest.entries['input.tif']['hash'] == 'given'
+
+
+def test_corrupted_manifest_is_ignored(stamped):
+    input_path, output_path, output_dir = stamped
+    with open(os.path.join(output_dir, manifest.MANIFEST_NAME), 'w') as f:
+        f.write('{not json')
+    job_manifest = manifest.JobManifest(output_dir)
+    assert job_manifest.entries == {}
+    assert not job_manifest.is_up_to_date(input_path, output_path, PARAMS)
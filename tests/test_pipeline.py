@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import pipeline
+
+
+def acquire_later(budget, size):
+    # thread waiting for the budget, its event is set once it got it
+    acquired = threading.Event()
+    results = []
+
+    def run():
+        results.append(budget.acquire(size))
+        acquired.set()
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return acquired, results
+
+
+def test_acquire_within_limit():
+    budget = pipeline.ByteBudget(100)
+    assert budget.acquire(60)
+    assert budget.acquire(40)
+    assert budget.used == 100
+    assert budget.is_full()
+
+
+def test_acquire_waits_for_release():
+    budget = pipeline.ByteBudget(100)
+    budget.acquire(80)
+    acquired, results = acquire_later(budget, 50)
+    assert not acquired.wait(0.3)
+    budget.release(80)
+    assert acquired.wait(2.0)
+    assert results == [True]
+    assert budget.used == 50
+
+
+def test_oversize_goes_through_alone():
+    budget = pipeline.ByteBudget(100)
+    assert budget.acquire(500)
+    acquired, results = acquire_later(budget, 10)
+    assert not acquired.wait(0.3)
+    budget.release(500)
+    assert acquired.wait(2.0)
+
+
+def test_close_wakes_waiters():
+    budget = pipeline.ByteBudget(100)
+    budget.acquire(100)
+    acquired, results = acquire_later(budget, 10)
+    time.sleep(0.1)
+    budget.close()
+    assert acquired.wait(2.0)
+    assert results == [False]
+
+
+def test_acquire_without_wait_goes_over():
+    budget = pipeline.ByteBudget(100)
+    budget.acquire(80)
+    assert budget.acquire(50, wait=False)
+    assert budget.used == 130
+    assert budget.is_full()
+    budget.release(130)
+    assert not budget.is_full()
+
+
+def test_release_never_below_zero():
+    budget = pipeline.ByteBudget(100)
+    budget.release(10)
+    assert budget.used == 0
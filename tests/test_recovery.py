@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+import recovery
+
+
+@pytest.mark.parametrize('output_path', ['/out/shot_1001.jpg',
+                                         '/out/doc.v2.pdf',
+                                         '/out/no_extension',
+                                         '/out/.hidden.png',
+                                         '/out/sub dir/with space.tif',
+                                         'relative.mov'])
+def test_partial_path_round_trip(output_path):
+    partial_path = recovery.get_partial_path(output_path)
+    assert os.path.dirname(partial_path) == os.path.dirname(output_path)
+    ext = os.path.splitext(output_path)[1]
+    if ext:
+        assert os.path.splitext(partial_path)[1] == ext  # encoders pick the format from it
+    match = recovery.PARTIAL_RE.match(os.path.basename(partial_path))
+    assert match and match.group('owner') == recovery.get_owner()
+    assert recovery.get_output_path(partial_path) == output_path
+
+
+@pytest.mark.parametrize('path', ['/out/shot_1001.jpg', '/out/.hidden.png', '/out/.name.partial'])
+def test_output_path_of_other_files(path):
+    assert not recovery.PARTIAL_RE.match(os.path.basename(path))
+    assert recovery.get_output_path(path) == path
+
+
+def test_owner_round_trip():
+    host, pid = recovery.parse_owner(recovery.get_owner())
+    assert host == recovery.HOST
+    assert pid == os.getpid()
+    assert recovery.parse_owner('host.with.dots_12') is None
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The window paints within the startup budget and before any stamping backend is imported.
+# Timed in fresh interpreters by the startup benchmark, offscreen so it runs on a headless build node.
+
+import os
+
+import pytest
+
+import benchmark
+
+
+@pytest.fixture
+def qt_env():
+    if not os.environ.get('RFSCRIPT'):
+        pytest.skip('RFSCRIPT not set, app.py needs rf_utils')
+    os.environ.setdefault('QT_PREFERRED_BINDING', os.pathsep.join(['PySide', 'PySide2']))
+    pytest.importorskip('Qt')
+
+
+def test_first_paint_within_budget(qt_env):
+    result = benchmark.bench_startup(benchmark.STARTUP_BUDGET, repeat=3)[0]
+    assert result['eager'] == '-', 'backends imported before the first paint: {}'.format(result['eager'])
+    assert result['paint_sec'] <= benchmark.STARTUP_BUDGET, 'first paint in {} sec'.format(result['paint_sec'])
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import validate
+
+
+@pytest.fixture
+def inputs(tmpdir):
+    overlay_path = tmpdir.join('overlay.png')
+    overlay_path.write('')
+    tmpdir.join('a.jpg').write('')
+    return str(overlay_path), [str(tmpdir.join('a.jpg'))]
+
+
+def test_valid_inputs(inputs):
+    overlay_path, paths = inputs
+    assert validate.check_inputs('Vendor', 'Comp', paths, overlay_path) == []
+
+
+@pytest.mark.parametrize('name', ['../x', 'a/b', 'a\\b', 'C:x', '..', '.', '', u'ก'])
+def test_name_must_be_a_folder_name(inputs, name):
+    overlay_path, paths = inputs
+    assert validate.check_inputs(name, 'Comp', paths, overlay_path)
+
+
+def test_missing_task_paths_and_overlay():
+    assert len(validate.check_inputs('Vendor', '', [], 'missing.png')) == 3
+
+
+def test_check_paths(inputs, tmpdir):
+    overlay_path, paths = inputs
+    output_dir = str(tmpdir)
+    assert validate.check_paths(paths, rel_dirs=['sub/dir'], output_dir=output_dir) == []
+    assert validate.check_paths(paths + [str(tmpdir.join('missing.jpg'))], output_dir=output_dir)
+    assert validate.check_paths(paths, rel_dirs=['../up'], output_dir=output_dir)
+    assert validate.check_paths(paths, rel_dirs=['/abs'], output_dir=output_dir)
+    assert validate.check_paths(paths, output_dir=str(tmpdir.join('missing')))
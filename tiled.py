@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Tiled TIFF path, stamps very large plates in bands of rows so peak memory is bound by the band size.
+# The input is copied to the output as is, then the pixel data of the output is memory mapped and
+# each band is composited in place. Works on uncompressed 8-bit RGB/RGBA TIFFs with contiguous strips,
+# anything else goes through the in-memory path.
+
+import os
+import shutil
+import logging
+
+import overlay
+import composite
+import report
+import recovery
+
+logger = logging.getLogger(__name__)
+
+TIFF_FORMAT = ('.tif', '.tiff')
+TILE_PIXEL_THRESHOLD = 100 * 1000 * 1000  # images with more pixels than this are stamped in bands
+TILE_BAND_ROWS = 256  # rows per band
+TILED_MODES = {'RGB': 3, 'RGBA': 4}
+
+# tiff tags
+COMPRESSION = 259
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+STRIP_BYTE_COUNTS = 279
+PLANAR_CONFIGURATION = 284
+TILE_OFFSETS = 324
+
+
+def get_pixel_offset(image):
+    # byte offset of the pixel data if it is one uncompressed block, otherwise None
+    channels = TILED_MODES.get(image.mode)
+    tags = getattr(image, 'tag_v2', None)
+    if not channels or tags is None:
+        return None
+    if tags.get(COMPRESSION, 1) != 1 or tags.get(PLANAR_CONFIGURATION, 1) != 1 or TILE_OFFSETS in tags:
+        return None
+    offsets = tags.get(STRIP_OFFSETS)
+    counts = tags.get(STRIP_BYTE_COUNTS)
+    if not offsets or not counts:
+        return None
+    offsets = list(offsets) if isinstance(offsets, (tuple, list)) else [offsets]
+    counts = list(counts) if isinstance(counts, (tuple, list)) else [counts]
+    for i in range(len(offsets) - 1):
+        if offsets[i] + counts[i] != offsets[i + 1]:
+            return None
+    width, height = image.size
+    if sum(counts) < width * height * channels:
+        return None
+    return offsets[0]
+
+
+def can_stamp(path, resize=None, tile_threshold=TILE_PIXEL_THRESHOLD):
+    # only reads the tiff header
+    if os.path.splitext(path)[-1].lower() not in TIFF_FORMAT or not overlay.is_available() or not composite.is_available():
+        return False
+    image = overlay.Image.open(path)
+    try:
+        if image.size[0] * image.size[1] <= tile_threshold:
+            return False
+        if overlay.get_limited_size(image.size, resize) != image.size:
+            return False
+        return get_pixel_offset(image) is not None
+    finally:
+        image.close()
+
+
+def stamp_tiled(input_path, output_path, overlay_path, text, opacity, blend_mode=composite.DEFAULT_BLEND_MODE, band_rows=TILE_BAND_ROWS, callback_func=None):
+    np = composite.np
+    image = overlay.Image.open(input_path)
+    width, height = image.size
+    channels = TILED_MODES[image.mode]
+    offset = get_pixel_offset(image)
+    image.close()
+
+    with report.stage('copy', bytes_written=os.path.getsize(input_path)):
+        shutil.copyfile(input_path, output_path)
+    pixels = np.memmap(output_path, dtype=np.uint8, mode='r+', offset=offset, shape=(height, width, channels))
+    try:
+        if isinstance(opacity, (tuple, list)):
+            opacity = overlay.get_auto_opacity(composite.mean_luminance(pixels), opacity)
+        tiled_overlay = overlay.get_tiled_overlay(overlay_path, text, opacity, (width, height))
+
+        num_bands = (height + band_rows - 1) // band_rows
+        peak_memory = 0
+        with report.stage('composite', pixels=width * height):
+            for i in range(num_bands):
+                top = i * band_rows
+                bottom = min(top + band_rows, height)
+                bbox, over_rgb, over_alpha = composite.split_layer(tiled_overlay.band(top, bottom))
+                if bbox is not None:
+                    composite.composite(pixels[top:bottom], bbox, over_rgb, over_alpha, mode=blend_mode)
+                    # band pixels + RGBA layer + overlay arrays + uint16 blend buffers
+                    region = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+                    band_memory = (width * (bottom - top) * (channels + 4)) + (region * 4) + (min(region, width * composite.BAND_ROWS) * 3 * 2 * 3)
+                    peak_memory = max(peak_memory, band_memory)
+                if callback_func:
+                    callback_func((i + 1, num_bands))
+        with report.stage('write'):
+            pixels.flush()
+    finally:
+        del pixels
+
+    # output_path is the partial file the engine writes to, the log names the output
+    logger.info('Tiled stamp: {} {}x{}, {} bands, peak memory {:.1f} MB'.format(recovery.get_output_path(output_path), width, height, num_bands, peak_memory / 1048576.0))
+    return output_path
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Checks of the user inputs of a stamp, before anything is written, shared by the UI, the CLI and the daemon.
+# The receiver name is a folder of the output, it can't be a path that leads out of it.
+# Kept free of the stamping backends so the UI checks the inputs while they are still loading.
+
+import os
+
+import intake
+from defaults import SUPPORT_FORMAT
+
+NAME_INVALID_CHARS = '/\\:'  # would make the name folder a path
+MAX_LISTED_PATHS = 5  # paths named in an error, the rest are counted
+
+
+def is_ascii(text):
+    try:
+        text.encode('ascii')
+    except UnicodeError:
+        return False
+    return True
+
+
+def check_inputs(name, task, paths, overlay_path):
+    # [error lines], empty when the inputs are fine
+    errors = []
+    if not name or not is_ascii(name):
+        errors.append('Please fill the name of reciever in English')
+    elif not is_folder_name(name):
+        errors.append('Name of reciever can\'t contain {} or be only dots'.format(' '.join(NAME_INVALID_CHARS)))
+    if not task or not is_ascii(task):
+        errors.append('Please fill task name in English')
+    if not paths:
+        errors.append('No files to stamp watermark')
+    if not overlay_path or not os.path.exists(overlay_path):
+        errors.append('Overlay image doesn\'t exist')
+    return errors
+
+
+def is_folder_name(name):
+    return not any(c in name for c in NAME_INVALID_CHARS) and bool(name.strip('.'))
+
+
+def is_input(entry, formats=SUPPORT_FORMAT):
+    # a file or every frame of a sequence entry there, in a format that can be stamped
+    if intake.get_extension(entry) not in formats:
+        return False
+    return all(os.path.isfile(path) for path in intake.iter_paths(entry))
+
+
+def is_rel_dir(rel_dir):
+    # relative output folder that stays under the output
+    rel_dir = rel_dir.replace('\\', '/')
+    return not os.path.isabs(rel_dir) and not os.path.splitdrive(rel_dir)[0] and '..' not in rel_dir.split('/')
+
+
+def format_paths(paths):
+    text = ', '.join(paths[:MAX_LISTED_PATHS])
+    if len(paths) > MAX_LISTED_PATHS:
+        text += ' and {} more'.format(len(paths) - MAX_LISTED_PATHS)
+    return text
+
+
+def check_paths(paths, rel_dirs=None, output_dir=None):
+    # [error lines] of paths sent by another process, which the UI and CLI found themselves
+    errors = []
+    missing_paths = [path for path in paths if not is_input(path)]
+    if missing_paths:
+        errors.append('Missing or unsupported: {}'.format(format_paths(missing_paths)))
+    bad_dirs = [rel_dir for rel_dir in rel_dirs or () if rel_dir and not is_rel_dir(rel_dir)]
+    if bad_dirs:
+        errors.append('Sub folders outside the output: {}'.format(format_paths(bad_dirs)))
+    if rel_dirs and len(rel_dirs) != len(paths):
+        errors.append('{} sub folders for {} files'.format(len(rel_dirs), len(paths)))
+    if output_dir is not None and not os.path.isdir(output_dir):
+        errors.append('Output folder doesn\'t exist: {}'.format(output_dir))
+    return errors
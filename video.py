@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# ffmpeg video path, resize + overlay in a single filter graph.
+# decode -> scale -> overlay -> encode in one pass, no resized temp media written.
+# Long clips are split on keyframes, the segments encoded in parallel then concatenated
+# without re-encoding, audio is always stream copied.
+
+import os
+import json
+import shutil
+import logging
+import threading
+import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import overlay
+import report
+import recovery
+from defaults import VIDEO_FORMAT, DEFAULT_PROFILE
+
+logger = logging.getLogger(__name__)
+
+FFMPEG = os.environ.get('FFMPEG_PATH', 'ffmpeg')
+FFPROBE = os.environ.get('FFPROBE_PATH', 'ffprobe')
+# x264 per profile, the preset sets the speed, crf the quality. Slower presets give a smaller file at the same crf
+VIDEO_ENCODE_OPTIONS = {'fast': ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-pix_fmt', 'yuv420p'],
+                        'balanced': ['-c:v', 'libx264', '-preset', 'medium', '-crf', '18', '-pix_fmt', 'yuv420p'],
+                        'archive': ['-c:v', 'libx264', '-preset', 'slow', '-crf', '18', '-pix_fmt', 'yuv420p']}
+LUMINANCE_SAMPLE_SIZE = 64  # width of the frame sampled for auto opacity
+CPU_COUNT = multiprocessing.cpu_count()
+SEGMENT_WORKERS = CPU_COUNT  # max segments of one clip encoded at the same time
+MIN_SEGMENT_DURATION = 10.0  # sec, shorter clips are encoded in one go
+SEGMENT_EXT = '.mp4'
+
+_available = None
+
+
+def is_available():
+    global _available
+    if _available is None:
+        try:
+            subprocess.check_output([FFMPEG, '-version'], stderr=subprocess.STDOUT)
+            subprocess.check_output([FFPROBE, '-version'], stderr=subprocess.STDOUT)
+            _available = overlay.is_available()
+        except (OSError, subprocess.CalledProcessError):
+            _available = False
+    return _available
+
+
+def is_video(path):
+    return os.path.splitext(path)[-1].lower() in VIDEO_FORMAT
+
+
+def can_stamp(path):
+    return is_video(path) and is_available()
+
+
+def probe(path):
+    cmd = [FFPROBE, '-v', 'error', '-print_format', 'json',
+        '-show_entries', 'stream=codec_type,width,height,nb_frames,avg_frame_rate:format=duration', path]
+    data = json.loads(subprocess.check_output(cmd).decode('utf-8'))
+    info = {'width': 0, 'height': 0, 'frames': 0, 'fps': 0.0, 'duration': 0.0, 'has_audio': False}
+    info['duration'] = float(data.get('format', {}).get('duration') or 0.0)
+    for stream in data.get('streams', []):
+        if stream.get('codec_type') == 'audio':
+            info['has_audio'] = True
+        elif stream.get('codec_type') == 'video' and not info['width']:
+            info['width'] = int(stream['width'])
+            info['height'] = int(stream['height'])
+            num, den = (stream.get('avg_frame_rate') or '0/1').split('/')
+            info['fps'] = float(num) / float(den) if float(den) else 0.0
+            info['frames'] = int(stream.get('nb_frames') or 0)
+    if not info['frames']:
+        info['frames'] = int(info['duration'] * info['fps'])
+    return info
+
+
+def get_output_size(width, height, resize=None):
+    # yuv420p needs even dimensions
+    if resize:
+        width, height = overlay.get_limited_size((width, height), resize)
+    return width - (width % 2), height - (height % 2)
+
+
+def sample_luminance(path, duration):
+    # mean luminance (0.0 - 1.0) of a tiny gray frame from the middle of the clip
+    width = LUMINANCE_SAMPLE_SIZE
+    cmd = [FFMPEG, '-v', 'error', '-ss', str(duration * 0.5), '-i', path, '-frames:v', '1',
+        '-vf', 'scale={}:{},format=gray'.format(width, width), '-f', 'rawvideo', 'pipe:1']
+    data = bytearray(subprocess.check_output(cmd))
+    if not data:
+        return 0.5
+    return sum(data) / (255.0 * len(data))
+
+
+def get_opacity(path, opacity, info):
+    if not isinstance(opacity, (tuple, list)):
+        return opacity
+    min_opacity, max_opacity = opacity
+    luminance = sample_luminance(path, info['duration'])
+    opacity = min_opacity + ((max_opacity - min_opacity) * luminance)
+    return round(opacity / overlay.OPACITY_STEP) * overlay.OPACITY_STEP
+
+
+def build_command(input_path, overlay_image, output_path, size, resize_input, start=None, frames=None, audio=True, threads=None, profile=DEFAULT_PROFILE):
+    width, height = size
+    if resize_input:
+        filter_graph = '[0:v]scale={}:{}[base];[base][1:v]overlay=0:0:format=auto[out]'.format(width, height)
+    else:
+        filter_graph = '[0:v][1:v]overlay=0:0:format=auto[out]'
+    cmd = [FFMPEG, '-y', '-v', 'error', '-nostats', '-progress', 'pipe:1']
+    if start:
+        cmd += ['-ss', '{:.6f}'.format(start)]
+    cmd += ['-i', input_path, '-i', overlay_image,
+        '-filter_complex', filter_graph,
+        '-map', '[out]']
+    if audio:
+        cmd += ['-map', '0:a?', '-c:a', 'copy']
+    else:
+        cmd.append('-an')
+    if frames:
+        cmd += ['-frames:v', str(frames)]
+    if threads:
+        cmd += ['-threads', str(threads)]
+    cmd += VIDEO_ENCODE_OPTIONS[profile]
+    cmd.append(output_path)
+    return cmd
+
+
+def run_ffmpeg(cmd, total_frames, callback_func=None):
+    # ffmpeg reports progress every half second, a callback that raises (cancel) kills it
+    logger.debug(' '.join(cmd))
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    try:
+        for line in iter(process.stdout.readline, ''):
+            if line.startswith('frame=') and callback_func and total_frames:
+                frame = int(line.strip().split('=')[-1] or 0)
+                callback_func((min(frame, total_frames), total_frames))
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    error = process.stderr.read()
+    if process.wait() != 0:
+        raise RuntimeError('ffmpeg failed: {}'.format(error))
+
+
+def get_keyframes(path, fps):
+    # [(frame index, time in sec from the first frame)] of every keyframe, only keyframes are decoded
+    cmd = [FFPROBE, '-v', 'error', '-select_streams', 'v:0', '-skip_frame', 'nokey',
+        '-show_entries', 'frame=pts_time', '-of', 'csv=p=0', path]
+    times = []
+    for line in subprocess.check_output(cmd).decode('utf-8').splitlines():
+        line = line.strip().strip(',')
+        if line and line != 'N/A':
+            times.append(float(line))
+    if not times:
+        return []
+    times.sort()
+    first = times[0]
+    return [(int(round((t - first) * fps)), t - first) for t in times]
+
+
+def get_segments(path, info, num_segments):
+    # split on keyframes into about equal parts, [(start time, start frame, number of frames)]
+    total = info['frames']
+    if num_segments <= 1 or not total or not info['fps']:
+        return [(0.0, 0, total)]
+    keyframes = get_keyframes(path, info['fps'])
+    boundaries = [(0, 0.0)]
+    for i in range(1, num_segments):
+        target = total * i // num_segments
+        candidates = [kf for kf in keyframes if boundaries[-1][0] < kf[0] < total]
+        if not candidates:
+            break
+        boundaries.append(min(candidates, key=lambda kf: abs(kf[0] - target)))
+    segments = []
+    for i, (frame, time) in enumerate(boundaries):
+        end = boundaries[i + 1][0] if i + 1 < len(boundaries) else total
+        segments.append((time, frame, end - frame))
+    return segments
+
+
+def concat_segments(segment_paths, input_path, output_path, list_path):
+    # lossless concat of the encoded segments, audio copied from the original
+    with open(list_path, 'w') as f:
+        for path in segment_paths:
+            f.write("file '{}'\n".format(path.replace('\\', '/').replace("'", "'\\''")))
+    cmd = [FFMPEG, '-y', '-v', 'error', '-f', 'concat', '-safe', '0', '-i', list_path, '-i', input_path,
+        '-map', '0:v', '-map', '1:a?', '-c', 'copy', output_path]
+    logger.debug(' '.join(cmd))
+    subprocess.check_call(cmd)
+
+
+def stamp_segments(input_path, output_path, overlay_image, size, resize_input, segments, temp_dir, profile=DEFAULT_PROFILE, callback_func=None):
+    # encode every segment on its own ffmpeg process, progress is the frames done across all of them
+    total_frames = sum(frames for start, first_frame, frames in segments)
+    threads = max(1, CPU_COUNT // len(segments))
+    done_frames = [0] * len(segments)
+    lock = threading.Lock()
+
+    def encode(args):
+        i, (start, first_frame, frames) = args
+        segment_path = os.path.join(temp_dir, 'segment_{:03d}{}'.format(i, SEGMENT_EXT))
+
+        def segment_progress(callback_result):
+            with lock:
+                done_frames[i] = callback_result[0]
+                if callback_func:
+                    callback_func((sum(done_frames), total_frames))
+
+        cmd = build_command(input_path, overlay_image, segment_path, size, resize_input,
+                            start=start, frames=frames, audio=False, threads=threads, profile=profile)
+        run_ffmpeg(cmd, frames, callback_func=segment_progress)
+        return segment_path
+
+    pool = ThreadPool(len(segments))
+    try:
+        segment_paths = pool.map(encode, list(enumerate(segments)))
+    finally:
+        pool.close()
+        pool.join()
+    concat_segments(segment_paths, input_path, output_path, os.path.join(temp_dir, 'segments.txt'))
+
+
+def stamp_video(input_path, output_path, overlay_path, text, opacity, resize=None, segment_workers=None, profile=DEFAULT_PROFILE, callback_func=None):
+    # long clips are split on keyframes and the segments encoded in parallel
+    with report.stage('read'):
+        info = probe(input_path)
+        size = get_output_size(info['width'], info['height'], resize=resize)
+        opacity = get_opacity(input_path, opacity, info)
+    prepared = overlay.get_prepared_overlay(overlay_path, text, opacity, size)
+
+    temp_dir = recovery.mkdtemp('video')
+    try:
+        overlay_image = os.path.join(temp_dir, 'overlay.png')
+        prepared.layer.save(overlay_image)
+        resize_input = size != (info['width'], info['height'])
+
+        segment_workers = segment_workers or SEGMENT_WORKERS
+        num_segments = min(segment_workers, int(info['duration'] // MIN_SEGMENT_DURATION))
+        segments = get_segments(input_path, info, num_segments)
+        with report.stage('encode', frames=info['frames'], pixels=size[0] * size[1] * info['frames']):
+            if len(segments) > 1:
+                logger.debug('Split {} into {} segments'.format(input_path, len(segments)))
+                stamp_segments(input_path, output_path, overlay_image, size, resize_input, segments, temp_dir, profile=profile, callback_func=callback_func)
+            else:
+                cmd = build_command(input_path, overlay_image, output_path, size, resize_input, profile=profile)
+                run_ffmpeg(cmd, info['frames'], callback_func=callback_func)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return output_path